@@ -521,11 +521,17 @@ const launchNextVideoBatch = async (courseId) => {
 };
 
 const handleVideoWebhook = async (req, res) => {
-    const { jobId, s3Key, status, hlsURL, error } = req.body;
+    const { jobId, s3Key, status, hlsURL, error, posterURL, thumbnailTrackURL } = req.body;
 
     console.log("webhookData: ", req.body);
     console.log(`Webhook: Job ${jobId}): ${status}`);
 
+    // Tiến độ encode: chỉ ghi log, không thay đổi bộ đếm của batch
+    if (status === "progress") {
+        console.log(`Video ${s3Key}: ${req.body.progress?.percent}% (speed ${req.body.progress?.speed}x)`);
+        return res.status(200).json({ success: true });
+    }
+
     try {
         const batch = await VideoConversion.findById(jobId);
 
@@ -550,8 +556,28 @@ const handleVideoWebhook = async (req, res) => {
             });
         }
 
-        if (status === "success") {
+        // Fast publish: rung thấp nhất đã xem được, các rung cao hơn vẫn đang encode.
+        // Gán hlsURL ngay (master.m3u8 sẽ được ghi lại khi có thêm rung), không đổi bộ đếm batch;
+        // mọi video của course đã xem được → phát hành course sớm
+        if (status === "playable") {
             await Lecture.findByIdAndUpdate(lecture._id, { "content.hlsURL": hlsURL });
+            console.log(`Video ${lecture._id} playable`);
+
+            const pendingKeys = await getAllVideoS3KeysByCourse(batch.courseId);
+            if (pendingKeys && pendingKeys.length === 0 && course.status !== "published") {
+                console.log(`🎊 Course ${batch.courseId} playable, publishing`);
+                course.status = "published";
+                await course.save();
+            }
+            return res.json({ success: true });
+        }
+
+        if (status === "success") {
+            await Lecture.findByIdAndUpdate(lecture._id, {
+                "content.hlsURL": hlsURL,
+                ...(posterURL && { "content.posterURL": posterURL }),
+                ...(thumbnailTrackURL && { "content.thumbnailTrackURL": thumbnailTrackURL }),
+            });
             console.log(`Video ${lecture._id} converted successfully`);
             batch.completedVideos += 1;
         } else if (status === "error") {
@@ -25,6 +25,8 @@ const LectureSchema = new mongoose.Schema({
         text: { type: String },
         thumbnailS3Key : { type: String },
         thumbnailURL: { type: String },
+        posterURL: { type: String }, // Poster tự tạo khi convert HLS
+        thumbnailTrackURL: { type: String }, // WebVTT thumbnails (seek preview)
         fileName: { type: String },
         captions: [
             {
@@ -2,76 +2,528 @@ import os
 import sys
 import json
 import boto3
-import whisper
 import requests
 import time
+import hashlib
 import subprocess
 import tempfile
+import threading
+import resource
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, Dict, List
+from job_store import get_job_store
 
 # AWS Clients
 s3_client = boto3.client('s3')
 
 # Load model
 MODEL_SIZE = os.environ.get('WHISPER_MODEL', 'small')
+# Engine transcribe (mọi engine trả về cùng dạng segment dict như whisper.transcribe()):
+#   whisper        - openai-whisper float32 trên CPU (mặc định)
+#   whisper-int8   - openai-whisper, Linear quantize int8 động (torch) khi load
+#   faster-whisper - CTranslate2 int8 (package faster-whisper); không dùng được BILINGUAL_MODE=shared
+#                    chỉ có trong image build với --build-arg FASTER_WHISPER_MODELS
+TRANSCRIBE_ENGINE = os.environ.get('TRANSCRIBE_ENGINE', 'whisper')
+# Thư mục model CTranslate2 (tải sẵn trong image); không có → tải từ Hugging Face Hub theo WHISPER_MODEL
+FASTER_WHISPER_DIR = os.environ.get('FASTER_WHISPER_DIR', '/app/models/faster-whisper')
+# Checkpoint convert sẵn trong image ({MODEL_SIZE}.pt, xem Dockerfile) → load kiểu mmap.
+# Không có file → whisper.load_model() như cũ
+WHISPER_MMAP_DIR = os.environ.get('WHISPER_MMAP_DIR', '/app/models')
+# Phụ đề 2 ngôn ngữ (gốc + tiếng Anh):
+#   shared   - mỗi cửa sổ 30s chạy encoder 1 lần, decoder transcribe + translate dùng chung (mặc định)
+#   separate - 2 lượt model.transcribe() độc lập
+BILINGUAL_MODE = os.environ.get('BILINGUAL_MODE', 'shared')
+DECODE_OPTIONS = dict(fp16=False, temperature=0.0, best_of=5, beam_size=5)
+NO_SPEECH_THRESHOLD = 0.6   # Giống mặc định của whisper.transcribe()
+LOGPROB_THRESHOLD = -1.0
 
-model = whisper.load_model(MODEL_SIZE)
-print("Model loaded successfully")
+# Cách đọc video nguồn:
+#   auto     - stream thẳng từ S3 (presigned URL) nếu đọc tuần tự được, ngược lại download
+#   stream   - luôn stream từ S3
+#   download - luôn download về /tmp
+INPUT_MODE = os.environ.get('INPUT_MODE', 'auto')
+PRESIGN_EXPIRES = int(os.environ.get('PRESIGN_EXPIRES', '21600'))  # 6 giờ
 
+# Cache theo nội dung video: video trùng dùng lại phụ đề đã tạo thay vì transcribe lại
+DEDUP_CACHE = os.environ.get('DEDUP_CACHE', '1') == '1'
+CACHE_PREFIX = os.environ.get('CACHE_PREFIX', '.media-cache')
+CACHE_HASH = os.environ.get('CACHE_HASH', 'metadata')  # metadata | full
 
-def main():
+# Metrics mỗi job: 1 dòng JSON (CloudWatch EMF) ra stdout; có METRICS_PREFIX → ghi thêm lên S3
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CaptionGenerator')
+METRICS_PREFIX = os.environ.get('METRICS_PREFIX', '')
+
+# Worker mode: 1 task xử lý nhiều video liên tiếp, model Whisper chỉ load 1 lần
+#   JOBS          - JSON list job do dispatcher gom sẵn: [{"s3Key": ..., "bucket": ..., "batchId": ..., "language": ...}]
+#   JOB_QUEUE_URL - lấy job từ SQS (hoặc service tương thích qua SQS_ENDPOINT_URL) tới khi queue rỗng
+# Không có cả 2 → 1 job từ S3_KEY/S3_BUCKET như cũ
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL', '')
+SQS_ENDPOINT_URL = os.environ.get('SQS_ENDPOINT_URL') or None
+QUEUE_WAIT_SECONDS = 20          # Long polling
+QUEUE_IDLE_POLLS = int(os.environ.get('QUEUE_IDLE_POLLS', '2'))  # Số lần poll rỗng liên tiếp → thoát
+QUEUE_VISIBILITY_TIMEOUT = 300   # Gia hạn định kỳ trong lúc job chạy
+
+# Cách lấy audio cho Whisper:
+#   pcm - ffmpeg xuất PCM 16kHz mono qua pipe thẳng vào numpy, không encode/decode lại (mặc định)
+#   mp3 - ghi file MP3 64k rồi Whisper decode lại bằng ffmpeg (cách cũ)
+AUDIO_MODE = os.environ.get('AUDIO_MODE', 'pcm')
+# Audio dài hơn → ffmpeg ghi float32 ra file tạm và memory-map thay vì giữ trong RAM
+PCM_MEMMAP_SECONDS = float(os.environ.get('PCM_MEMMAP_SECONDS', '3600'))
+
+# Video dài: VAD (theo năng lượng) bỏ đoạn không có tiếng nói, gom speech thành chunk
+# rồi transcribe song song nhiều process → thời gian theo số core thay vì theo độ dài video
+#   CHUNKED_TRANSCRIBE: auto (audio >= CHUNK_MIN_AUDIO giây) | 1 (luôn) | 0 (tắt)
+CHUNKED_TRANSCRIBE = os.environ.get('CHUNKED_TRANSCRIBE', 'auto')
+CHUNK_MIN_AUDIO = float(os.environ.get('CHUNK_MIN_AUDIO', '600'))
+CHUNK_SECONDS = float(os.environ.get('CHUNK_SECONDS', '120'))  # Độ dài tối đa 1 chunk
+CHUNK_MAX_GAP = 3.0   # Khoảng lặng dài hơn → cắt chunk tại đó, bỏ phần lặng
+DEFAULT_BITRATE = 2500000  # bps - ước lượng thời lượng theo dung lượng video khi chưa probe
+TRANSCRIBE_THREADS = int(os.environ.get('TRANSCRIBE_THREADS', '2'))  # torch threads mỗi process
+TRANSCRIBE_WORKERS = int(os.environ.get('TRANSCRIBE_WORKERS', '0'))  # 0 = theo CPU budget và RAM còn trống
+# RAM riêng mỗi process con (MB); 0 = ước lượng theo model + engine
+TRANSCRIBE_WORKER_MEMORY_MB = int(os.environ.get('TRANSCRIBE_WORKER_MEMORY_MB', '0'))
+WORKER_OVERHEAD_MB = 700  # torch runtime + activation (beam search) + audio chunk mỗi process
+# Số tham số model Whisper, dùng ước lượng RAM khi không có checkpoint mmap
+WHISPER_PARAMS = {'tiny': 39e6, 'base': 74e6, 'small': 244e6, 'medium': 769e6, 'large': 1550e6, 'turbo': 809e6}
+CPU_BUDGET = int(os.environ.get('CPU_BUDGET', '0'))  # 0 = tự đọc từ cgroup
+VAD_FRAME_MS = 30
+VAD_MARGIN_DB = float(os.environ.get('VAD_MARGIN_DB', '12'))  # Ngưỡng = nền nhiễu + margin
+VAD_MAX_THRESHOLD_DB = -40.0  # Ngưỡng không cao hơn mức này (giọng nhỏ / audio ít khoảng lặng)
+VAD_MIN_SILENCE = 0.5  # Khoảng lặng ngắn hơn → coi như vẫn đang nói
+VAD_MIN_SPEECH = 0.25  # Đoạn tiếng ngắn hơn → bỏ (tiếng click, gõ phím)
+VAD_PAD = 0.2          # Đệm 2 đầu mỗi đoạn speech
+
+
+class JobMetrics:
+    """
+    Đo từng stage của job: wall time, bytes, CPU time + max RSS của process con
+    (ffmpeg) và peak RSS của chính process Python (Whisper chạy trong process này).
+    emit() in ra 1 record JSON duy nhất theo CloudWatch Embedded Metric Format.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.started = time.time()
+        self.properties = {}
+        self.stages = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        # Worker mode chạy nhiều job/process: CPU chỉ tính phần phát sinh từ lúc này
+        self._self_before = resource.getrusage(resource.RUSAGE_SELF)
+        self._children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def set(self, **properties):
+        self.properties.update(properties)
+
+    def count(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, stage: str, **values):
+        with self._lock:
+            self.stages.append({'stage': stage, **values})
+
+    @contextmanager
+    def stage(self, name: str, **values):
+        """Đo 1 stage. Caller có thể thêm field vào dict được yield (vd. bytes)"""
+        values = dict(values)
+        before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        before_self = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        try:
+            yield values
+        except BaseException:
+            values['error'] = True
+            raise
+        finally:
+            after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            after_self = resource.getrusage(resource.RUSAGE_SELF)
+            values['wall_s'] = round(time.time() - started, 3)
+            values['cpu_s'] = round(
+                (after_self.ru_utime + after_self.ru_stime) - (before_self.ru_utime + before_self.ru_stime), 3
+            )
+            values['child_cpu_s'] = round(
+                (after_children.ru_utime + after_children.ru_stime)
+                - (before_children.ru_utime + before_children.ru_stime), 3
+            )
+            # ru_maxrss (KB trên Linux): max của mọi process con đã kết thúc / peak của process này
+            values['child_max_rss_mb'] = round(after_children.ru_maxrss / 1024, 1)
+            values['peak_rss_mb'] = round(after_self.ru_maxrss / 1024, 1)
+            self.record(name, **values)
+
+    def to_emf(self) -> Dict:
+        """Record EMF: tổng theo loại stage là metric, chi tiết từng stage nằm trong 'stages'"""
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self_before, children_before = self._self_before, self._children_before
+        metrics = {
+            'JobWallTime': (round(time.time() - self.started, 3), 'Seconds'),
+            'CPUTime': (round(
+                (usage.ru_utime + usage.ru_stime) - (self_before.ru_utime + self_before.ru_stime), 3
+            ), 'Seconds'),
+            'ChildCPUTime': (round(
+                (children.ru_utime + children.ru_stime) - (children_before.ru_utime + children_before.ru_stime), 3
+            ), 'Seconds'),
+            'ChildMaxRSS': (round(children.ru_maxrss / 1024, 1), 'Megabytes'),
+            'PeakRSS': (round(usage.ru_maxrss / 1024, 1), 'Megabytes'),
+        }
+        with self._lock:
+            stages = list(self.stages)
+            counters = dict(self.counters)
+        for record in stages:
+            name = ''.join(part.capitalize() for part in record['stage'].split('_')) + 'Time'
+            total = metrics.get(name, (0, 'Seconds'))[0] + record['wall_s']
+            metrics[name] = (round(total, 3), 'Seconds')
+        for name, value in counters.items():
+            metrics[''.join(part.capitalize() for part in name.split('_'))] = (value, 'Bytes')
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[]],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+                }],
+            },
+            **{name: value for name, (value, _) in metrics.items()},
+            **self.properties,
+            'stages': stages,
+        }
+
+    def emit(self, bucket: Optional[str] = None, key: Optional[str] = None):
+        """In record ra stdout (CloudWatch Logs nhận EMF), tuỳ chọn ghi lên S3"""
+        record = self.to_emf()
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+        if bucket and key:
+            try:
+                s3_client.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=json.dumps(record, ensure_ascii=False).encode('utf-8'),
+                    ContentType='application/json'
+                )
+            except Exception as e:
+                print(f"Warning: failed to save metrics: {str(e)}")
+
+
+METRICS = JobMetrics(METRICS_NAMESPACE)
+
+
+def load_mmap_model(path: str):
+    """
+    Load checkpoint đã convert: {'dims', 'model_state_dict' (fp32), 'alignment_heads'} lưu bằng torch.save.
+    torch.load(mmap=True) + dựng model trên meta device + load_state_dict(assign=True)
+    → weight chính là vùng mmap của file: không copy, page chỉ nạp khi dùng tới,
+    nhiều process đọc cùng file dùng chung page cache. Cần torch >= 2.1.
+    """
+    import numpy as np
+    import torch
+    from torch import nn
+    from whisper.model import ModelDimensions, Whisper, AudioEncoder, TextDecoder
+
+    checkpoint = torch.load(path, mmap=True, map_location='cpu', weights_only=True)
+    dims = ModelDimensions(**checkpoint['dims'])
+    # Như Whisper.__init__ nhưng encoder/decoder trên meta device (không cấp phát + random init weight);
+    # to_sparse() của alignment_heads không chạy được trên meta nên tự dựng bên dưới
+    model = Whisper.__new__(Whisper)
+    nn.Module.__init__(model)
+    model.dims = dims
+    with torch.device('meta'):
+        model.encoder = AudioEncoder(
+            dims.n_mels, dims.n_audio_ctx, dims.n_audio_state, dims.n_audio_head, dims.n_audio_layer
+        )
+        model.decoder = TextDecoder(
+            dims.n_vocab, dims.n_text_ctx, dims.n_text_state, dims.n_text_head, dims.n_text_layer
+        )
+    model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+
+    # Buffer không nằm trong state_dict (persistent=False) → tạo trên CPU
+    n_ctx = dims.n_text_ctx
+    model.decoder.register_buffer(
+        'mask', torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1), persistent=False
+    )
+    if checkpoint.get('alignment_heads'):
+        model.set_alignment_heads(checkpoint['alignment_heads'])
+    else:
+        all_heads = torch.zeros(dims.n_text_layer, dims.n_text_head, dtype=torch.bool)
+        all_heads[dims.n_text_layer // 2:] = True
+        model.register_buffer('alignment_heads', all_heads.to_sparse(), persistent=False)
+    return model
+
+
+class WhisperEngine:
+    """openai-whisper float32. model: whisper.model.Whisper (SharedEncoderModel bọc trực tiếp)"""
+    name = 'whisper'
+    shared_encoder = True  # Dùng được transcribe_bilingual (BILINGUAL_MODE=shared)
+
+    def __init__(self, model, format: str):
+        self.model = model
+        self.format = format
+
+    @classmethod
+    def load(cls, model_name: str) -> 'WhisperEngine':
+        path = os.path.join(WHISPER_MMAP_DIR, f"{model_name}.pt") if WHISPER_MMAP_DIR else None
+        if path and os.path.exists(path):
+            return cls(load_mmap_model(path), 'mmap')
+        import whisper
+        return cls(whisper.load_model(model_name), 'checkpoint')
+
+    def transcribe(self, audio, language: str, task: str) -> Dict:
+        return self.model.transcribe(
+            audio,
+            language=None if language == 'auto' else language,
+            task=task,
+            **DECODE_OPTIONS
+        )
+
+    def detect_language(self, audio) -> str:
+        """Ngôn ngữ của 30s đầu"""
+        from whisper.audio import log_mel_spectrogram, pad_or_trim
+
+        if not self.model.is_multilingual:
+            return 'en'
+        mel = log_mel_spectrogram(pad_or_trim(audio), self.model.dims.n_mels).to(self.model.device)
+        _, probs = self.model.detect_language(mel)
+        return max(probs, key=probs.get)
+
+
+class QuantizedWhisperEngine(WhisperEngine):
+    """
+    openai-whisper với nn.Linear (attention + MLP của encoder/decoder) quantize int8 động:
+    weight int8, activation quantize lúc chạy. Weight nhỏ ~4 lần nên quantize copy ra khỏi mmap.
+    Embedding / conv / projection ra logits giữ float32 → decode y hệt engine whisper.
+    """
+    name = 'whisper-int8'
+
+    @classmethod
+    def load(cls, model_name: str) -> 'QuantizedWhisperEngine':
+        import torch
+        from torch import nn
+        from whisper.model import Linear
+
+        base = WhisperEngine.load(model_name)
+        # whisper.model.Linear chỉ khác nn.Linear ở chỗ cast weight theo dtype input (fp16),
+        # quantize_dynamic chỉ nhận đúng class nn.Linear → đổi class trước khi quantize
+        for module in base.model.modules():
+            if type(module) is Linear:
+                module.__class__ = nn.Linear
+        model = torch.ao.quantization.quantize_dynamic(base.model, {nn.Linear}, dtype=torch.qint8)
+        return cls(model, f"{base.format}+int8")
+
+
+class FasterWhisperEngine:
+    """CTranslate2 (faster-whisper), compute_type int8 trên CPU"""
+    name = 'faster-whisper'
+    shared_encoder = False
+
+    # Các field segment của whisper.transcribe()
+    SEGMENT_FIELDS = (
+        'id', 'seek', 'start', 'end', 'text', 'tokens',
+        'temperature', 'avg_logprob', 'compression_ratio', 'no_speech_prob',
+    )
+
+    def __init__(self, model, format: str):
+        self.model = model
+        self.format = format
+
+    @classmethod
+    def load(cls, model_name: str) -> 'FasterWhisperEngine':
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError(
+                "TRANSCRIBE_ENGINE=faster-whisper cần image build với --build-arg FASTER_WHISPER_MODELS"
+            )
+
+        local = os.path.join(FASTER_WHISPER_DIR, model_name) if FASTER_WHISPER_DIR else None
+        model = WhisperModel(
+            local if local and os.path.isdir(local) else model_name,
+            device='cpu',
+            compute_type='int8',
+            # Chunk worker set OMP_NUM_THREADS; process chính dùng hết CPU budget
+            cpu_threads=int(os.environ.get('OMP_NUM_THREADS') or get_cpu_budget()),
+        )
+        return cls(model, 'ctranslate2-int8')
+
+    def transcribe(self, audio, language: str, task: str) -> Dict:
+        temperature = DECODE_OPTIONS['temperature']
+        segments, info = self.model.transcribe(
+            audio,
+            language=None if language == 'auto' else language,
+            task=task,
+            beam_size=DECODE_OPTIONS['beam_size'],
+            best_of=DECODE_OPTIONS['best_of'],
+            temperature=temperature,
+            log_prob_threshold=LOGPROB_THRESHOLD,
+            no_speech_threshold=NO_SPEECH_THRESHOLD,
+        )
+        # segments là generator: decode thật sự chạy khi duyệt
+        result_segments = []
+        for segment in segments:
+            values = {field: getattr(segment, field, None) for field in self.SEGMENT_FIELDS}
+            if values['temperature'] is None:
+                values['temperature'] = temperature
+            values['tokens'] = list(values['tokens'] or [])
+            result_segments.append(values)
+        return {
+            'text': ''.join(segment['text'] for segment in result_segments),
+            'segments': result_segments,
+            'language': info.language,
+        }
+
+    def detect_language(self, audio) -> str:
+        # Ngôn ngữ được detect ngay khi gọi transcribe(), segment không cần duyệt
+        _, info = self.model.transcribe(audio[:30 * 16000], beam_size=1)
+        return info.language
+
+
+ENGINES = {engine.name: engine for engine in (WhisperEngine, QuantizedWhisperEngine, FasterWhisperEngine)}
+
+
+def get_engine_class(name: str):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown TRANSCRIBE_ENGINE: {name} (expected one of {', '.join(ENGINES)})")
+    return ENGINES[name]
+
+
+class ModelLoader:
     """
-    Main entry point - Xử lý transcription
+    Load engine transcribe ở thread nền thay vì lúc import: job bắt đầu load khi cần transcribe (cache miss),
+    song song với download + extract audio; transcribe chờ ở get().
+    Job lỗi env / cache hit không tốn thời gian và RAM cho model. Worker mode dùng lại model đã load.
     """
 
-    s3_key = os.environ.get('S3_KEY')
-    bucket = os.environ.get('S3_BUCKET')
-    batch_id = os.environ.get('BATCH_ID')
-    source_language = os.environ.get('LANGUAGE', "auto")
+    def __init__(self, name: str, engine: str = 'whisper'):
+        self.name = name
+        self.engine_class = get_engine_class(engine)
+        self.engine = None
+        self.load_seconds = None
+        self._error = None
+        self._thread = None
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def start(self) -> 'ModelLoader':
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, daemon=True)
+                self._thread.start()
+        return self
+
+    def _load(self):
+        started = time.time()
+        try:
+            self.engine = self.engine_class.load(self.name)
+            print(f"Model {self.name} loaded ({self.engine.name}, {self.engine.format}) in {time.time() - started:.1f}s")
+        except Exception as e:
+            self._error = e
+        finally:
+            self.load_seconds = time.time() - started
+
+    def wait(self):
+        """Chờ load xong (không ghi metrics, không raise lỗi load - get() sẽ báo)"""
+        self.start()._thread.join()
+
+    def get(self):
+        """Engine đã load (WhisperEngine / QuantizedWhisperEngine / FasterWhisperEngine)"""
+        self.start()
+        if self._thread.is_alive():
+            with METRICS.stage('model_wait', model=self.name):
+                self._thread.join()
+        if self._error:
+            error, self._error = self._error, None
+            with self._lock:
+                self._thread = None  # Job sau thử load lại
+            raise RuntimeError(f"Cannot load {self.engine_class.name} model {self.name}: {error}")
+        if not self._reported:
+            # Chỉ job đầu tiên của process trả chi phí load
+            self._reported = True
+            METRICS.set(ModelLoadSeconds=round(self.load_seconds, 2), ModelFormat=self.engine.format)
+        return self.engine
+
+
+MODEL = ModelLoader(MODEL_SIZE, TRANSCRIBE_ENGINE)
+
+
+def process_job(bucket: str, s3_key: str, batch_id: str, source_language: str = 'auto') -> bool:
+    """
+    Xử lý transcription 1 video. Trả về True nếu thành công (lỗi đã được báo qua webhook)
+    """
     if not all([ bucket, s3_key, batch_id]):
-        print("ERROR: Missing required environment variables")
+        print("ERROR: Missing required job parameters")
         print(f"S3_BUCKET: {bucket}")
         print(f"S3_KEY: {s3_key}")
         print(f"BATCH_ID: {batch_id}")
-        sys.exit(1)
+        return False
     
     print(f"S3 Location: s3://{bucket}/{s3_key}")
     print(f"Language: {source_language}")
+    METRICS.set(BatchId=batch_id, S3Key=s3_key, Language=source_language, Model=MODEL_SIZE, Engine=TRANSCRIBE_ENGINE)
     
+    video_path = None
+    audio = None
+    is_local = False
     try:
-        video_path = download_from_s3(bucket, s3_key)
+        cache_key = None
+        uploaded_files = None
+        if DEDUP_CACHE:
+            try:
+                cache_key = get_cache_key(bucket, s3_key, source_language)
+                with METRICS.stage('cache_restore'):
+                    uploaded_files = restore_from_cache(cache_key, bucket, s3_key)
+                METRICS.set(CacheHit=bool(uploaded_files))
+            except Exception as e:
+                print(f"Warning: cache lookup failed: {str(e)}")
+
+        if not uploaded_files:
+            # Load model chạy nền trong lúc download/probe/extract audio. Chunked transcribe (process pool,
+            # process chính không cần model) hay không: chưa probe → đoán theo dung lượng, sửa lại sau probe
+            start_transcriber(estimate_duration(bucket, s3_key) if CHUNKED_TRANSCRIBE == 'auto' else None)
+            video_path, is_local = resolve_input(bucket, s3_key)
+
+            # ffprobe 1 lần: video không có audio → báo lỗi ngay thay vì đợi ffmpeg/Whisper lỗi
+            with METRICS.stage('probe'):
+                media = probe_media(video_path).validate()
+            print(f"Source: {media.summary()}")
+            METRICS.set(Duration=media.duration)
+            start_transcriber(media.duration)
         
-        # Step 2: Extract audio
-        print("Step 2: Extracting audio...")
-        audio_path = extract_audio(video_path)
+            # Step 2: Extract audio
+            print("Step 2: Extracting audio...")
+            audio = extract_audio(video_path, media)
         
-        # Step 3: Transcribe with Whisper
-        print("Step 3: Transcribing audio...")
-        results = generatel_captions(audio_path, Path(s3_key).stem, source_language)
+            # Step 3: Transcribe with Whisper
+            print("Step 3: Transcribing audio...")
+            results = generatel_captions(audio, Path(s3_key).stem, source_language)
         
-        # Upload captions lên S3
-        uploaded_files = {}
+            # Upload captions lên S3
+            uploaded_files = {}
         
-        for lang, caption_data in results.items():
-            vtt_content = convert_to_vtt(caption_data['segments'])
-            video_name = Path(s3_key).stem
-            original_dir = os.path.dirname(s3_key)
-            # Tạo S3 key cho caption
-            if lang == source_language:
-                caption_key = f"{original_dir}/captions/{lang}/{video_name}.vtt"
-            else:
-                caption_key = f"{original_dir}/captions/{lang}/{video_name}.vtt"
+            for lang, caption_data in results.items():
+                with METRICS.stage('vtt', language=lang):
+                    vtt_content = convert_to_vtt(caption_data['segments'])
+                video_name = Path(s3_key).stem
+                original_dir = os.path.dirname(s3_key)
+                # Tạo S3 key cho caption
+                if lang == source_language:
+                    caption_key = f"{original_dir}/captions/{lang}/{video_name}.vtt"
+                else:
+                    caption_key = f"{original_dir}/captions/{lang}/{video_name}.vtt"
             
-            # Upload
+                # Upload
             
-            upload_to_s3(bucket, caption_key, vtt_content.encode('utf-8'), 'text/vtt')
-            uploaded_files[lang] = {
-                's3_key': caption_key,
-                'public_url': f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{caption_key}",
-                'is_translation': caption_data.get('is_translation', False)
-            }
+                upload_to_s3(bucket, caption_key, vtt_content.encode('utf-8'), 'text/vtt')
+                uploaded_files[lang] = {
+                    's3_key': caption_key,
+                    'public_url': f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{caption_key}",
+                    'is_translation': caption_data.get('is_translation', False)
+                }
+
+            if cache_key:
+                save_cache_entry(cache_key, bucket, uploaded_files)
         
         print(f"✅ Successfully created bilingual captions")
         
@@ -85,7 +537,9 @@ def main():
 
         print(result)
         
-        notify_webhook(batch_id=batch_id, data=result)
+        METRICS.set(Status='success')
+        with METRICS.stage('webhook'):
+            notify_webhook(batch_id=batch_id, data=result)
         
         
         # # Send SNS notification
@@ -108,7 +562,9 @@ def main():
             'original_video': s3_key
         }
 
-        notify_webhook(batch_id=batch_id, data=result)
+        METRICS.set(Status='error', Error=str(e))
+        with METRICS.stage('webhook'):
+            notify_webhook(batch_id=batch_id, data=result)
         
         # Send failure notification
         # if SNS_TOPIC_ARN:
@@ -118,13 +574,151 @@ def main():
         #         'error': str(e)
         #     })
         
-        sys.exit(1)
+        return False
     finally:
         # Cleanup temporary files
-        if video_path and os.path.exists(video_path):
+        if is_local and video_path and os.path.exists(video_path):
             os.unlink(video_path)
-        if audio_path and os.path.exists(audio_path):
-            os.unlink(audio_path)
+        # AUDIO_MODE=mp3: file tạm; PCM là numpy array (file memmap đã unlink sẵn)
+        if isinstance(audio, str) and os.path.exists(audio):
+            os.unlink(audio)
+        METRICS.emit(
+            bucket,
+            f"{METRICS_PREFIX}/captions/{batch_id}/{Path(s3_key).stem}.json" if METRICS_PREFIX else None
+        )
+    return True
+
+
+def set_job_status(job_key: Optional[str], **fields):
+    """Cập nhật job store (JOB_STORE) của dispatcher; lỗi store không làm hỏng job"""
+    try:
+        store = get_job_store()
+        if store and job_key:
+            store.update(job_key, **fields)
+        elif job_key:
+            # Dispatcher có store (job có jobKey) nhưng task không có JOB_STORE → trạng thái không được cập nhật
+            print(f"Warning: JOB_STORE is not configured, job {job_key} status stays as dispatched")
+    except Exception as e:
+        print(f"Warning: cannot update job store: {str(e)}")
+
+
+def is_job_done(job_key: Optional[str]) -> bool:
+    """Message SQS giao lại sau khi job đã xong (chưa kịp xoá) → không transcribe + webhook lần 2"""
+    try:
+        store = get_job_store()
+        record = store.get(job_key) if store and job_key else None
+        return bool(record) and record.get('status') == 'success'
+    except Exception as e:
+        print(f"Warning: cannot read job store: {str(e)}")
+        return False
+
+
+def run_job(job) -> bool:
+    """1 job của worker: dict (s3Key, bucket, batchId, language, jobKey), thiếu field → lấy từ env"""
+    global METRICS
+    if isinstance(job, str):
+        job = {'s3Key': job}
+    print('\n' + '-' * 60)
+    print(f"▶️  Job: {job.get('s3Key')}")
+    key = job.get('jobKey')
+    if is_job_done(key):
+        print("⏭️  Job already completed, skipping")
+        return True
+    set_job_status(key, status='processing')
+    ok = False
+    try:
+        ok = process_job(
+            bucket=job.get('bucket') or os.environ.get('S3_BUCKET'),
+            s3_key=job.get('s3Key'),
+            batch_id=job.get('batchId') or os.environ.get('BATCH_ID'),
+            source_language=job.get('language') or os.environ.get('LANGUAGE', 'auto'),
+        )
+        return ok
+    finally:
+        set_job_status(key, status='success' if ok else 'failed')
+        # Metrics theo job; model giữ nguyên cho job sau
+        METRICS = JobMetrics(METRICS_NAMESPACE)
+
+
+def run_job_list(jobs: List) -> int:
+    """Xử lý lần lượt danh sách job (dispatcher đã gom theo thời lượng). Trả về số job lỗi"""
+    failed = 0
+    for index, job in enumerate(jobs):
+        print(f"\n📦 Job {index + 1}/{len(jobs)}")
+        if not run_job(job):
+            failed += 1
+    print(f"\n📦 Worker finished: {len(jobs) - failed}/{len(jobs)} jobs succeeded")
+    return failed
+
+
+def run_queue_worker(queue_url: str) -> int:
+    """
+    Lấy job từ SQS tới khi queue rỗng QUEUE_IDLE_POLLS lần liên tiếp. Trả về số job lỗi.
+    Visibility timeout được gia hạn trong lúc job chạy; message bị xoá sau khi xử lý
+    (kể cả lỗi - đã báo webhook). Task chết giữa chừng → message hiện lại cho worker khác.
+    """
+    sqs = boto3.client('sqs', endpoint_url=SQS_ENDPOINT_URL)
+    processed = failed = idle = 0
+    while idle < QUEUE_IDLE_POLLS:
+        messages = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=QUEUE_WAIT_SECONDS,
+            VisibilityTimeout=QUEUE_VISIBILITY_TIMEOUT,
+        ).get('Messages', [])
+        if not messages:
+            idle += 1
+            continue
+        idle = 0
+        receipt = messages[0]['ReceiptHandle']
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(QUEUE_VISIBILITY_TIMEOUT / 2):
+                try:
+                    sqs.change_message_visibility(
+                        QueueUrl=queue_url, ReceiptHandle=receipt,
+                        VisibilityTimeout=QUEUE_VISIBILITY_TIMEOUT
+                    )
+                except Exception as e:
+                    print(f"Warning: cannot extend message visibility: {str(e)}")
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            ok = run_job(json.loads(messages[0]['Body']))
+        except ValueError as e:
+            print(f"ERROR: invalid job message: {str(e)}")
+            ok = False
+        finally:
+            stop.set()
+            thread.join()
+        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt)
+        processed += 1
+        if not ok:
+            failed += 1
+    print(f"\n📦 Queue empty, worker finished: {processed - failed}/{processed} jobs succeeded")
+    return failed
+
+
+def main():
+    """
+    Main entry point - Xử lý transcription (1 job từ env, danh sách JOBS hoặc queue)
+    """
+    if JOB_QUEUE_URL:
+        failed = run_queue_worker(JOB_QUEUE_URL)
+    elif os.environ.get('JOBS'):
+        failed = run_job_list(json.loads(os.environ['JOBS']))
+    else:
+        failed = not process_job(
+            bucket=os.environ.get('S3_BUCKET'),
+            s3_key=os.environ.get('S3_KEY'),
+            batch_id=os.environ.get('BATCH_ID'),
+            source_language=os.environ.get('LANGUAGE', "auto"),
+        )
+    if failed:
+        sys.exit(1)
 
 
 def download_from_s3(bucket: str, key: str) -> str:
@@ -138,25 +732,244 @@ def download_from_s3(bucket: str, key: str) -> str:
         return video_path
 
 
+def is_streamable_mp4(bucket: str, key: str, size: int) -> bool:
+    """
+    Đọc header các top-level atom bằng range GET.
+    True nếu 'moov' nằm trước 'mdat' (faststart) → ffmpeg đọc tuần tự qua HTTP được
+    """
+    offset = 0
+    while offset + 8 <= size:
+        end = min(offset + 15, size - 1)
+        header = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{end}")['Body'].read()
+        atom_size = int.from_bytes(header[0:4], 'big')
+        atom_type = header[4:8]
+        if atom_type == b'moov':
+            return True
+        if atom_type == b'mdat':
+            return False
+        if atom_size == 1 and len(header) >= 16:  # 64-bit size
+            atom_size = int.from_bytes(header[8:16], 'big')
+        if atom_size < 8:
+            return False
+        offset += atom_size
+    return False
+
+
+def resolve_input(bucket: str, key: str):
+    """
+    Chọn nguồn video theo INPUT_MODE.
+    Trả về: (presigned URL hoặc đường dẫn local, is_local)
+    """
+    mode = INPUT_MODE
+    if mode == 'auto':
+        size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        ext = os.path.splitext(key)[1].lower()
+        if ext in ('.mp4', '.m4v', '.mov') and not is_streamable_mp4(bucket, key, size):
+            print("moov atom at end of file, falling back to download")
+            mode = 'download'
+        else:
+            mode = 'stream'
+
+    if mode == 'stream':
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=PRESIGN_EXPIRES
+        )
+        print(f"Streaming s3://{bucket}/{key} via presigned URL")
+        return url, False
+
+    with METRICS.stage('download') as stage:
+        video_path = download_from_s3(bucket, key)
+        stage['bytes'] = os.path.getsize(video_path)
+    METRICS.count('bytes_downloaded', stage['bytes'])
+    return video_path, True
+
+
+def get_content_id(bucket: str, key: str) -> str:
+    """
+    Định danh nội dung video.
+    metadata: SHA-256 checksum của S3 nếu có, ngược lại ETag + kích thước
+    full: đọc toàn bộ object và tính SHA-256
+    """
+    if CACHE_HASH == 'full':
+        digest = hashlib.sha256()
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        for chunk in iter(lambda: body.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+
+    head = s3_client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    checksum = head.get('ChecksumSHA256')
+    if checksum:
+        return f"sha256:{checksum}"
+    etag = head['ETag'].strip('"')
+    return f"etag:{etag}:{head['ContentLength']}"
+
+
+def get_cache_key(bucket: str, key: str, source_language: str) -> str:
+    """Hash của nội dung video + tham số transcribe"""
+    params = {
+        'content': get_content_id(bucket, key),
+        'model': MODEL_SIZE,
+        'language': source_language,
+        'targets': ['source', 'en'],
+        # Các setting đổi nội dung VTT: engine khác / decode khác → không dùng chung cache
+        'engine': TRANSCRIBE_ENGINE,
+        'bilingual': BILINGUAL_MODE,
+        'audio': AUDIO_MODE,
+        'chunked': [CHUNKED_TRANSCRIBE, CHUNK_MIN_AUDIO, CHUNK_SECONDS],
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def caption_key_for(s3_key: str, lang: str) -> str:
+    video_name = Path(s3_key).stem
+    original_dir = os.path.dirname(s3_key)
+    return f"{original_dir}/captions/{lang}/{video_name}.vtt"
+
+
+def restore_from_cache(cache_key: str, bucket: str, s3_key: str) -> Optional[Dict]:
+    """
+    Cache hit → copy các file VTT cũ sang vị trí caption của video mới.
+    Trả về uploaded_files giống như khi transcribe, hoặc None
+    """
+    try:
+        index_key = f"{CACHE_PREFIX}/captions/{cache_key}.json"
+        entry = json.loads(s3_client.get_object(Bucket=bucket, Key=index_key)['Body'].read())
+        for info in entry['captions'].values():
+            s3_client.head_object(Bucket=bucket, Key=info['s3_key'])
+    except Exception:
+        return None
+
+    uploaded_files = {}
+    for lang, info in entry['captions'].items():
+        caption_key = caption_key_for(s3_key, lang)
+        if caption_key != info['s3_key']:
+            s3_client.copy_object(
+                Bucket=bucket,
+                Key=caption_key,
+                CopySource={'Bucket': bucket, 'Key': info['s3_key']},
+                ContentType='text/vtt',
+                MetadataDirective='REPLACE'
+            )
+        uploaded_files[lang] = {
+            's3_key': caption_key,
+            'public_url': f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{caption_key}",
+            'is_translation': info.get('is_translation', False)
+        }
+    print(f"Cache hit: reused {len(uploaded_files)} captions")
+    return uploaded_files
+
+
+def save_cache_entry(cache_key: str, bucket: str, uploaded_files: Dict):
+    """Ghi index cache (lỗi cache không làm hỏng job)"""
+    entry = {
+        'captions': uploaded_files,
+        'created_at': int(time.time()),
+    }
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"{CACHE_PREFIX}/captions/{cache_key}.json",
+            Body=json.dumps(entry).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Warning: failed to write cache entry: {str(e)}")
+
+
 def upload_to_s3(bucket: str, key: str, data: bytes, content_type: str):
     """Upload file lên S3"""
     print(f"Uploading to s3://{bucket}/{key}")
-    s3_client.put_object(
-        Bucket=bucket,
-        Key=key,
-        Body=data,
-        ContentType=content_type
-    )
+    with METRICS.stage('upload', bytes=len(data)):
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type
+        )
+    METRICS.count('bytes_uploaded', len(data))
     print(f"Uploaded {len(data) / 1024:.2f} KB")
 
 
-def extract_audio(video_path: str) -> str:
-    """Tách audio từ video bằng ffmpeg"""
-    audio_path = video_path.rsplit('.', 1)[0] + '.mp3'
+class MediaInfo:
+    """Thông tin source từ 1 lần ffprobe (JSON): audio stream đầu tiên, thời lượng"""
+
+    def __init__(self, data: Dict):
+        self.data = data
+        streams = data.get('streams', [])
+        self.video = next((st for st in streams if st.get('codec_type') == 'video'), None)
+        self.audio = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+        self.format = data.get('format', {})
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None
+
+    @property
+    def duration(self) -> Optional[float]:
+        for value in (self.format.get('duration'), (self.audio or {}).get('duration')):
+            try:
+                if value and float(value) > 0:
+                    return float(value)
+            except ValueError:
+                pass
+        return None
+
+    def validate(self) -> 'MediaInfo':
+        """Từ chối sớm input không tạo được phụ đề"""
+        if not self.has_audio:
+            raise Exception("Video has no audio stream, nothing to transcribe")
+        if not self.duration:
+            raise Exception("Cannot determine media duration")
+        return self
+
+    def summary(self) -> str:
+        channels = self.audio.get('channels')
+        return (f"{self.duration or 0:.1f}s, audio {self.audio.get('codec_name')}"
+                f" {self.audio.get('sample_rate')}Hz x{channels}")
+
+
+def probe_media(input_path: str) -> MediaInfo:
+    """ffprobe source (file local hoặc presigned URL)"""
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_format',
+        '-show_streams',
+        '-of', 'json',
+        input_path
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, timeout=120)
+    try:
+        data = json.loads(result.stdout or '{}')
+    except ValueError:
+        data = {}
+    if result.returncode != 0 or not data.get('streams'):
+        error = (result.stderr or '').strip()[-300:] or 'no streams'
+        raise Exception(f"Cannot read media info: {error}")
+    return MediaInfo(data)
+
+
+def extract_audio(video_path: str, media: Optional[MediaInfo] = None):
+    """
+    Tách audio từ video bằng ffmpeg (video_path có thể là presigned URL)
+    media: kết quả probe_media (kiểm tra có audio trước khi chạy ffmpeg)
+    AUDIO_MODE=pcm → numpy float32 16kHz mono (như whisper.load_audio), mp3 → đường dẫn file MP3
+    """
+    if media and not media.has_audio:
+        raise Exception("Video has no audio stream, nothing to transcribe")
+    if AUDIO_MODE == 'pcm':
+        return extract_pcm(video_path, media)
+
+    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as f:
+        audio_path = f.name
     
     command = [
         'ffmpeg',
-        '-i', video_path,
+        *ffmpeg_input_args(video_path),
+        '-map', '0:a:0',
         '-vn',
         '-acodec', 'libmp3lame',
         '-ar', '16000',  # 16kHz sample rate (optimal cho Whisper)
@@ -166,13 +979,15 @@ def extract_audio(video_path: str) -> str:
         audio_path
     ]
     
-    print(f"Running: {' '.join(command)}")
-    result = subprocess.run(
-        command,
-        check=True,
-        capture_output=True,
-        text=True
-    )
+    print(f"Running: {' '.join(command).replace(video_path, '<input>')}")
+    with METRICS.stage('extract_audio') as stage:
+        result = subprocess.run(
+            command,
+            check=True,
+            capture_output=True,
+            text=True
+        )
+        stage['bytes'] = os.path.getsize(audio_path)
     
     if result.returncode != 0:
         print(f"ffmpeg stderr: {result.stderr}")
@@ -183,59 +998,601 @@ def extract_audio(video_path: str) -> str:
     
     return audio_path
 
+def ffmpeg_input_args(video_path: str) -> List[str]:
+    input_args = ['-i', video_path]
+    if video_path.startswith(('http://', 'https://')):
+        input_args = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5'] + input_args
+    return input_args
+
+def extract_pcm(video_path: str, media: Optional[MediaInfo] = None):
+    """
+    ffmpeg decode + resample 1 lần ra PCM 16kHz mono, không qua MP3:
+    - mặc định s16le qua stdout → numpy float32 (chia 32768 như whisper.load_audio)
+    - audio dài hơn PCM_MEMMAP_SECONDS: f32le ra file tạm, np.memmap rồi unlink ngay
+      (mapping vẫn dùng được, page do kernel quản lý, không chiếm heap; file tự xoá khi unmap)
+    """
+    import numpy as np
+
+    use_memmap = bool(media and media.duration and media.duration > PCM_MEMMAP_SECONDS)
+    output_args = ['-f', 'f32le', '-acodec', 'pcm_f32le'] if use_memmap else ['-f', 's16le', '-acodec', 'pcm_s16le']
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        *ffmpeg_input_args(video_path),
+        '-map', '0:a:0',
+        '-vn',
+        *output_args,
+        '-ar', '16000',
+        '-ac', '1',
+        '-y',
+    ]
+
+    print(f"Running: {' '.join(command).replace(video_path, '<input>')} {'<memmap>' if use_memmap else 'pipe:1'}")
+    with METRICS.stage('extract_audio', mode='memmap' if use_memmap else 'pcm') as stage:
+        if use_memmap:
+            with tempfile.NamedTemporaryFile(suffix='.f32', delete=False) as f:
+                pcm_path = f.name
+            try:
+                result = subprocess.run(command + [pcm_path], capture_output=True)
+                if result.returncode != 0:
+                    raise Exception(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-2000:]}")
+                # mode 'c' (copy-on-write): array ghi được như array thường, không sửa file
+                audio = np.memmap(pcm_path, dtype=np.float32, mode='c') \
+                    if os.path.getsize(pcm_path) else np.zeros(0, np.float32)
+            finally:
+                os.unlink(pcm_path)
+        else:
+            result = subprocess.run(command + ['pipe:1'], capture_output=True)
+            if result.returncode != 0:
+                raise Exception(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-2000:]}")
+            audio = np.frombuffer(result.stdout, np.int16).astype(np.float32)
+            audio /= 32768.0
+            del result
+        stage['bytes'] = audio.nbytes
+
+    print(f"Audio extracted: {len(audio) / 16000:.1f}s PCM, {audio.nbytes / 1024 / 1024:.2f} MB")
+    return audio
+
 def cleanup_files(file_paths):
     """Dọn dẹp temporary files"""
     for file_path in file_paths:
         if os.path.exists(file_path):
             os.unlink(file_path)
 
-def transcribe_audio(audio_path, language, task="transcribe"):
-
-    result = model.transcribe(
-        audio_path,
-        language=language,
-        task=task,
-        fp16=False,
-        temperature=0.0,
-        best_of=5,
-        beam_size=5
-    )
+def transcribe_audio(audio, language, task="transcribe"):
+    """audio: đường dẫn file hoặc numpy float32 16kHz"""
+    with METRICS.stage(task, language=language) as stage:
+        result = MODEL.get().transcribe(audio, language, task)
+        stage['segments'] = len(result['segments'])
     
     return result
 
-def generatel_captions(audio_path, base_filename, source_language):
-    """Tạo phụ đề 2 ngôn ngữ: gốc + tiếng Anh"""
-    
-    captions = {}
-    
-    # 1. Tạo phụ đề ngôn ngữ gốc
-    print(f"🎯 Creating {source_language} caption...")
-    original_result = transcribe_audio(audio_path, source_language, "transcribe")
-    
-    captions[source_language] = {
-        'segments': original_result['segments'],
-        'text': original_result['text'],
-        'is_translation': False
+
+class SharedEncoderModel:
+    """
+    Bọc model Whisper cho whisper.transcribe(): mỗi cửa sổ 30s chạy encoder 1 lần,
+    decoder transcribe (của whisper.transcribe) và translate dùng chung audio features.
+    Kết quả translate lưu theo nội dung mel của cửa sổ; thuộc tính khác chuyển thẳng cho model gốc.
+    """
+
+    def __init__(self, model, language):
+        self.model = model
+        self.language = language
+        self.translations = {}   # hash mel cửa sổ -> DecodingResult (translate)
+        self.encoder_passes = 0
+        self.encoded = set()     # hash các cửa sổ đã chạy encoder
+        self._prompt = []
+        self._last = (None, None)  # (hash, features) cho decode lại cùng cửa sổ
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    @staticmethod
+    def window_key(mel_segment):
+        return hashlib.blake2b(mel_segment.cpu().numpy().tobytes(), digest_size=16).digest()
+
+    def embed(self, mel_segment):
+        import torch
+        key = self.window_key(mel_segment)
+        if self._last[0] != key:
+            with torch.no_grad():
+                self._last = (key, self.model.embed_audio(mel_segment.unsqueeze(0)))
+            self.encoder_passes += 1
+            self.encoded.add(key)
+        return key, self._last[1]
+
+    def translate(self, key, features, language):
+        from whisper.decoding import DecodingOptions, decode
+        options = {k: v for k, v in DECODE_OPTIONS.items() if k != 'best_of'}  # best_of chỉ dùng khi temperature > 0
+        result = decode(self.model, features, DecodingOptions(
+            task='translate', language=language, prompt=self._prompt, **options
+        ))[0]
+        self.translations[key] = result
+        self._prompt = result.tokens
+
+    def decode(self, mel, options):
+        from whisper.decoding import decode
+        if mel.ndim != 2:
+            return decode(self.model, mel, options)
+        key, features = self.embed(mel)
+        result = decode(self.model, features, options)[0]
+        # Cửa sổ im lặng: whisper.transcribe sẽ bỏ qua → không cần dịch
+        silent = result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob <= LOGPROB_THRESHOLD
+        if options.task == 'transcribe' and options.language != 'en' and not silent:
+            self.translate(key, features, options.language)
+        return result
+
+
+def split_window_segments(tokens, tokenizer, time_precision, duration):
+    """
+    Tách token 1 cửa sổ thành (start, end, tokens, text) theo cặp timestamp, như whisper.transcribe()
+    tokens: phần token của segment, gồm cả timestamp token
+    """
+    segments = []
+    start = None
+    first = 0
+    text = []
+    for index, token in enumerate(tokens):
+        if token >= tokenizer.timestamp_begin:
+            position = (token - tokenizer.timestamp_begin) * time_precision
+            if start is not None and text:
+                segments.append((start, position, list(tokens[first:index + 1]), tokenizer.decode(text)))
+                start, text = None, []
+            if start is None:
+                start, first = position, index
+        elif token < tokenizer.eot:
+            text.append(token)
+    if text:
+        segments.append((start or 0.0, duration, list(tokens[first:]), tokenizer.decode(text)))
+    return segments
+
+
+def transcribe_bilingual(audio, language):
+    """
+    Transcribe + translate trong 1 lượt: whisper.transcribe() chạy task transcribe trên
+    SharedEncoderModel, mỗi cửa sổ được dịch ngay trên cùng encoder output.
+    Cửa sổ (seek) do transcribe quyết định; segment dịch nằm ngoài phần transcribe đã dùng
+    của cửa sổ bị bỏ (cửa sổ sau bắt đầu từ đó), segment vắt qua ranh giới bị cắt.
+    """
+    import whisper
+    from whisper.audio import N_FRAMES, HOP_LENGTH, SAMPLE_RATE, N_SAMPLES, log_mel_spectrogram, pad_or_trim
+    from whisper.tokenizer import get_tokenizer
+
+    model = MODEL.get().model
+    if isinstance(audio, str):
+        audio = whisper.load_audio(audio)
+    shared = SharedEncoderModel(model, language)
+
+    with METRICS.stage('transcribe_translate', language=language) as stage:
+        original = whisper.transcribe(
+            shared, audio, language=None if language == 'auto' else language, task='transcribe',
+            **DECODE_OPTIONS
+        )
+        detected = original['language']
+        if detected == 'en':
+            # Nguồn tiếng Anh (language=auto): không có gì để dịch, caption_pass dùng luôn bản gốc
+            stage['segments'] = len(original['segments'])
+            stage['windows'] = len(shared.encoded)
+            stage['encoder_passes'] = shared.encoder_passes
+            return original, original
+
+        tokenizer = get_tokenizer(
+            model.is_multilingual, num_languages=model.num_languages, language=detected, task='translate'
+        )
+        time_precision = N_FRAMES // model.dims.n_audio_ctx * HOP_LENGTH / SAMPLE_RATE
+
+        # Ghép lại cửa sổ theo seek của segment transcribe (cùng cách whisper.transcribe cắt mel)
+        mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+        content_frames = mel.shape[-1] - N_FRAMES
+        seeks = sorted({segment['seek'] for segment in original['segments']})
+        decoded_windows = len(shared.encoded)
+        segments = []
+        for index, seek in enumerate(seeks):
+            # Cắt giống whisper.transcribe để hash khớp: bản mới cắt theo segment_size rồi pad,
+            # 20231117 lấy nguyên N_FRAMES của mel đã pad (khác nhau ở cửa sổ cuối)
+            segment_size = min(N_FRAMES, content_frames - seek)
+            candidates = [
+                pad_or_trim(mel[:, seek:seek + size], N_FRAMES).to(model.device)
+                for size in (segment_size, N_FRAMES)
+            ]
+            keys = [SharedEncoderModel.window_key(candidate) for candidate in candidates]
+            key = next((k for k in keys if k in shared.translations), None)
+            if key is None:
+                # Cửa sổ không được decode trong lượt transcribe → encode + dịch riêng
+                key = keys[0]
+                shared.translate(key, shared.embed(candidates[0])[1], detected)
+            used = segment_size
+            if index + 1 < len(seeks):
+                used = min(used, seeks[index + 1] - seek)
+            cut = used * HOP_LENGTH / SAMPLE_RATE
+            offset = seek * HOP_LENGTH / SAMPLE_RATE
+            result = shared.translations[key]
+            for start, end, tokens, text in split_window_segments(result.tokens, tokenizer, time_precision, cut):
+                if start < cut:
+                    # Cùng field segment như whisper.transcribe() (xem FasterWhisperEngine.SEGMENT_FIELDS)
+                    segments.append({
+                        'id': len(segments),
+                        'seek': seek,
+                        'start': offset + start,
+                        'end': offset + min(end, cut),
+                        'text': text,
+                        'tokens': tokens,
+                        'temperature': result.temperature,
+                        'avg_logprob': result.avg_logprob,
+                        'compression_ratio': result.compression_ratio,
+                        'no_speech_prob': result.no_speech_prob,
+                    })
+
+        stage['segments'] = len(original['segments'])
+        stage['translated_segments'] = len(segments)
+        stage['windows'] = decoded_windows
+        stage['encoder_passes'] = shared.encoder_passes
+        if shared.encoder_passes > decoded_windows:
+            # Mỗi cửa sổ chỉ được encode 1 lần; nhiều hơn → cách cắt mel lệch với whisper.transcribe
+            print(f"Warning: encoder ran {shared.encoder_passes} times for {decoded_windows} windows")
+
+    translated = {
+        'segments': segments,
+        'text': ''.join(segment['text'] for segment in segments),
+        'language': detected,
     }
-    
-    # 2. Tạo phụ đề tiếng Anh
-    print(f"🌍 Creating English caption...")
-    if source_language == 'en':
+    return original, translated
+
+
+def read_cgroup_cpu_quota():
+    """CPU quota của container (số vCPU, có thể lẻ) từ cgroup v2/v1. Không giới hạn → None"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def get_cpu_budget():
+    """
+    Số CPU thực sự dùng được: min(cgroup quota, CPU affinity).
+    Trong Fargate os.cpu_count() trả về số core của host, không phải vCPU của task.
+    """
+    if CPU_BUDGET:
+        return CPU_BUDGET
+    if hasattr(os, "sched_getaffinity"):
+        budget = len(os.sched_getaffinity(0))
+    else:
+        budget = os.cpu_count() or 1
+    quota = read_cgroup_cpu_quota()
+    if quota:
+        budget = min(budget, max(1, int(quota + 0.5)))
+    return budget
+
+def read_available_memory():
+    """RAM còn dùng được (byte): min(giới hạn cgroup - đang dùng, MemAvailable). Không đọc được → None"""
+    available = []
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read())
+            # cgroup v1 không giới hạn → số rất lớn
+            if limit != "max" and int(limit) < 1 << 60:
+                available.append(int(limit) - usage)
+            break
+        except (OSError, ValueError):
+            continue
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available.append(int(line.split()[1]) * 1024)
+    except (OSError, ValueError):
+        pass
+    return min(available) if available else None
+
+def model_memory():
+    """
+    (RAM dùng chung, RAM riêng mỗi process) của model theo engine, byte.
+    whisper + checkpoint mmap: weight là page cache dùng chung → tính 1 lần.
+    whisper-int8 / faster-whisper: weight int8 riêng từng process (~1/4 fp32).
+    """
+    path = os.path.join(WHISPER_MMAP_DIR, f"{MODEL_SIZE}.pt") if WHISPER_MMAP_DIR else None
+    has_mmap = bool(path and os.path.exists(path))
+    if has_mmap:
+        fp32 = os.path.getsize(path)
+    else:
+        fp32 = WHISPER_PARAMS.get(MODEL_SIZE.split('.')[0].split('-')[0], WHISPER_PARAMS['large']) * 4
+    if TRANSCRIBE_ENGINE == 'whisper':
+        return (fp32, 0) if has_mmap else (0, fp32)
+    return 0, fp32 / 4
+
+def transcribe_workers():
+    """
+    Số process transcribe song song: mỗi process TRANSCRIBE_THREADS torch threads,
+    không vượt quá số process RAM còn trống chứa được (mỗi process load model riêng)
+    """
+    if TRANSCRIBE_WORKERS:
+        return TRANSCRIBE_WORKERS
+    workers = max(1, get_cpu_budget() // max(1, TRANSCRIBE_THREADS))
+    available = read_available_memory()
+    if available:
+        shared, private = model_memory()
+        if TRANSCRIBE_WORKER_MEMORY_MB:
+            per_worker = TRANSCRIBE_WORKER_MEMORY_MB * 1024 * 1024
+        else:
+            per_worker = private + WORKER_OVERHEAD_MB * 1024 * 1024
+        workers = min(workers, max(1, int((available - shared) // per_worker)))
+    return workers
+
+
+def detect_speech(audio, sample_rate=16000):
+    """
+    VAD theo năng lượng: RMS (dB) từng frame VAD_FRAME_MS,
+    ngưỡng = nền nhiễu (percentile 10) + VAD_MARGIN_DB, tối đa VAD_MAX_THRESHOLD_DB.
+    Trả về list (start, end) theo sample, đã nối khoảng lặng ngắn và đệm 2 đầu.
+    """
+    import numpy as np
+
+    frame = sample_rate * VAD_FRAME_MS // 1000
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    power_db = 10 * np.log10(np.mean(np.square(frames, dtype=np.float32), axis=1) + 1e-10)
+    threshold = min(np.percentile(power_db, 10) + VAD_MARGIN_DB, VAD_MAX_THRESHOLD_DB)
+    speech = np.concatenate(([False], power_db > threshold, [False]))
+    # Biên của các đoạn liên tục: [start_frame, end_frame)
+    edges = np.flatnonzero(speech[1:] != speech[:-1]).reshape(-1, 2)
+
+    min_gap = VAD_MIN_SILENCE * 1000 / VAD_FRAME_MS
+    spans = []
+    for start, end in edges.tolist():
+        if spans and start - spans[-1][1] < min_gap:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+
+    min_speech = VAD_MIN_SPEECH * 1000 / VAD_FRAME_MS
+    pad = int(VAD_PAD * sample_rate)
+    return [
+        (max(0, start * frame - pad), min(len(audio), end * frame + pad))
+        for start, end in spans if end - start >= min_speech
+    ]
+
+def plan_chunks(spans, max_samples, sample_rate=16000):
+    """
+    Gom đoạn speech liền kề thành chunk <= max_samples, chỉ cắt ở khoảng lặng.
+    Khoảng lặng > CHUNK_MAX_GAP giữa 2 đoạn luôn là ranh giới chunk (phần lặng bị bỏ).
+    Đoạn speech dài hơn max_samples (nói liên tục) bị chia đều.
+    """
+    max_gap = int(CHUNK_MAX_GAP * sample_rate)
+    chunks = []
+    for start, end in spans:
+        pieces = -(-(end - start) // max_samples)
+        step = -(-(end - start) // pieces)
+        for piece_start in range(start, end, step):
+            piece_end = min(end, piece_start + step)
+            if chunks and piece_start - chunks[-1][1] <= max_gap and piece_end - chunks[-1][0] <= max_samples:
+                chunks[-1][1] = piece_end
+            else:
+                chunks.append([piece_start, piece_end])
+    return [tuple(chunk) for chunk in chunks]
+
+def merge_chunk_results(results, offsets, language):
+    """Ghép kết quả các chunk theo thứ tự, timestamp cộng offset (giây) của chunk"""
+    segments = []
+    for result, offset in zip(results, offsets):
+        for segment in result['segments']:
+            segments.append({
+                **segment,
+                'id': len(segments),
+                'start': segment['start'] + offset,
+                'end': segment['end'] + offset,
+            })
+    return {
+        'segments': segments,
+        'text': ''.join(segment['text'] for segment in segments),
+        'language': results[0]['language'] if results else language,
+    }
+
+
+_chunk_pool = None
+_chunk_pool_size = None
+
+def _init_chunk_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+    os.environ['OMP_NUM_THREADS'] = str(threads)  # faster-whisper (cpu_threads)
+    # Checkpoint mmap → các process dùng chung page cache của weight
+    MODEL.start()
+
+def _load_chunk_model():
+    MODEL.wait()
+
+def caption_chunk(audio, language):
+    """
+    Chạy trong process con: caption_pass 1 chunk. METRICS của process con không được emit
+    → trả về kèm các stage (transcribe, model_wait...) để process chính gộp vào metrics của job
+    """
+    global METRICS
+    METRICS = JobMetrics(METRICS_NAMESPACE)
+    result = caption_pass(audio, language)
+    return result, {'pid': os.getpid(), 'stages': METRICS.stages, 'properties': METRICS.properties}
+
+def detect_chunk_language(audio):
+    return MODEL.get().detect_language(audio)
+
+def get_chunk_pool():
+    """
+    Process pool transcribe chunk, giữ lại cho job sau (worker mode). None nếu tài nguyên chỉ đủ
+    1 process → transcribe ngay trong process chính. Số process tính 1 lần (sau đó RAM đã bị pool dùng).
+    spawn thay vì fork: process cha đã có thread (torch/OpenMP, ModelLoader).
+    Process chính không load model khi dùng pool.
+    """
+    global _chunk_pool, _chunk_pool_size
+    if _chunk_pool_size is None:
+        _chunk_pool_size = transcribe_workers()
+        print(f"Transcribe workers: {_chunk_pool_size} x {TRANSCRIBE_THREADS} threads ({TRANSCRIBE_ENGINE})")
+    if _chunk_pool is None and _chunk_pool_size > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _chunk_pool = ProcessPoolExecutor(
+            max_workers=_chunk_pool_size,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_chunk_worker,
+            initargs=(TRANSCRIBE_THREADS,),
+        )
+        # Process con chỉ được tạo khi có task → khởi động + load model ngay, song song với extract audio
+        for _ in range(_chunk_pool_size):
+            _chunk_pool.submit(_load_chunk_model)
+    return _chunk_pool
+
+def use_chunked(seconds):
+    if CHUNKED_TRANSCRIBE == 'auto':
+        return seconds >= CHUNK_MIN_AUDIO
+    return CHUNKED_TRANSCRIBE == '1'
+
+def estimate_duration(bucket, key):
+    """Thời lượng ước lượng theo dung lượng object với DEFAULT_BITRATE (trước khi download/probe)"""
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)['ContentLength'] * 8 / DEFAULT_BITRATE
+    except Exception as e:
+        print(f"Warning: cannot estimate duration: {str(e)}")
+        return None
+
+def start_transcriber(duration):
+    """
+    Bắt đầu load model nền: audio dài + đủ tài nguyên cho nhiều process → chỉ các process con load;
+    ngược lại load trong process chính. Gọi trước download (thời lượng ước lượng) và sau probe
+    (thời lượng thật): đoán sai thì lần sau start thêm phần còn thiếu, phần đã start không start lại
+    """
+    if not (use_chunked(duration or 0) and get_chunk_pool()):
+        MODEL.start()
+
+def transcribe_chunked(audio, language):
+    """
+    VAD → chunk → caption_pass từng chunk song song → ghép lại với timestamp đã cộng offset.
+    Chunk độc lập (không có prompt từ chunk trước) nên chỉ cắt ở khoảng lặng.
+    Trả về như caption_pass: (original, english, is_translation)
+    """
+    import numpy as np
+    from concurrent.futures.process import BrokenProcessPool
+    from whisper.audio import SAMPLE_RATE
+
+    pool = get_chunk_pool()
+    workers = _chunk_pool_size
+    with METRICS.stage('vad') as stage:
+        spans = detect_speech(audio, SAMPLE_RATE)
+        speech = sum(end - start for start, end in spans) / SAMPLE_RATE
+        # ~2 chunk mỗi process để chia tải đều, không ngắn hơn 1 cửa sổ Whisper (30s)
+        chunk_seconds = max(30.0, min(CHUNK_SECONDS, speech / (2 * workers)))
+        chunks = plan_chunks(spans, int(chunk_seconds * SAMPLE_RATE), SAMPLE_RATE)
+        stage.update(audio_s=round(len(audio) / SAMPLE_RATE, 1), speech_s=round(speech, 1), chunks=len(chunks))
+    print(f"VAD: {speech:.0f}s speech / {len(audio) / SAMPLE_RATE:.0f}s audio → {len(chunks)} chunks")
+    METRICS.set(SpeechSeconds=round(speech, 1), Chunks=len(chunks))
+
+    if not chunks:
+        empty = {'segments': [], 'text': '', 'language': language}
+        return empty, empty, language != 'en'
+    # asarray: slice của memmap gửi sang process con như array thường
+    pieces = [np.asarray(audio[start:end]) for start, end in chunks]
+    with METRICS.stage('transcribe_chunks', workers=workers if pool else 1) as stage:
+        if pool:
+            global _chunk_pool
+            try:
+                if language == 'auto':
+                    # Mọi chunk dùng chung ngôn ngữ của đoạn speech đầu tiên
+                    language = pool.submit(detect_chunk_language, pieces[0]).result()
+                outputs = list(pool.map(caption_chunk, pieces, [language] * len(pieces)))
+            except BrokenProcessPool:
+                # Process con chết (OOM...) → job sau tạo pool mới
+                _chunk_pool = None
+                raise
+            results = [result for result, _ in outputs]
+            # Gộp stage của từng chunk vào metrics của job (wall/cpu là của process con)
+            for index, (_, worker_metrics) in enumerate(outputs):
+                for record in worker_metrics['stages']:
+                    METRICS.record(**{**record, 'chunk': index, 'worker': worker_metrics['pid']})
+                # Process con load model lần đầu (chunk đầu tiên của process đó) → lấy lâu nhất
+                properties = worker_metrics['properties']
+                if properties.get('ModelLoadSeconds', -1) > METRICS.properties.get('ModelLoadSeconds', -1):
+                    METRICS.set(ModelLoadSeconds=properties['ModelLoadSeconds'], ModelFormat=properties.get('ModelFormat'))
+        else:
+            if language == 'auto':
+                language = MODEL.get().detect_language(pieces[0])
+            results = [caption_pass(piece, language) for piece in pieces]
+        print(f"Language: {language}")
+        stage.update(chunks=len(chunks), language=language)
+
+    offsets = [start / SAMPLE_RATE for start, _ in chunks]
+    original = merge_chunk_results([result[0] for result in results], offsets, language)
+    english = merge_chunk_results([result[1] for result in results], offsets, language)
+    return original, english, results[0][2]
+
+
+def caption_pass(audio, language):
+    """
+    Phụ đề gốc + tiếng Anh cho 1 đoạn audio (cả file hoặc 1 chunk).
+    Trả về (original, english, is_translation)
+    """
+    # Nguồn không phải tiếng Anh + BILINGUAL_MODE=shared: 1 lượt encoder cho cả 2 phụ đề
+    shared = BILINGUAL_MODE == 'shared' and language != 'en' and MODEL.engine_class.shared_encoder
+    if shared:
+        original, translated = transcribe_bilingual(audio, language)
+    else:
+        original = transcribe_audio(audio, language, "transcribe")
+
+    if language == 'en' or original.get('language') == 'en':
         # Nếu gốc đã là tiếng Anh, chỉ cần copy
-        english_result = original_result
-        is_translation = False
+        return original, original, False
+    if shared:
+        return original, translated, True
+    # Dịch sang tiếng Anh
+    return original, transcribe_audio(audio, language, "translate"), True
+
+
+def generatel_captions(audio, base_filename, source_language):
+    """
+    Tạo phụ đề 2 ngôn ngữ: gốc + tiếng Anh
+    audio: PCM numpy từ extract_audio, hoặc đường dẫn file (AUDIO_MODE=mp3)
+    """
+    if isinstance(audio, str):
+        import whisper
+        # Decode 1 lần, các lượt transcribe/translate dùng chung
+        with METRICS.stage('decode_audio'):
+            audio = whisper.load_audio(audio)
+
+    print(f"🎯 Creating {source_language} + English captions...")
+    if use_chunked(len(audio) / 16000):
+        original_result, english_result, is_translation = transcribe_chunked(audio, source_language)
     else:
-        # Dịch sang tiếng Anh
-        english_result = transcribe_audio(audio_path, source_language, "translate")
-        is_translation = True
-    
-    captions['en'] = {
-        'segments': english_result['segments'],
-        'text': english_result['text'],
-        'is_translation': is_translation
+        original_result, english_result, is_translation = caption_pass(audio, source_language)
+
+    return {
+        source_language: {
+            'segments': original_result['segments'],
+            'text': original_result['text'],
+            'is_translation': False
+        },
+        'en': {
+            'segments': english_result['segments'],
+            'text': english_result['text'],
+            'is_translation': is_translation
+        },
     }
-    
-    return captions
 
 def convert_to_vtt(segments: List[Dict]) -> str:
     """Chuyển đổi segments sang WebVTT format"""
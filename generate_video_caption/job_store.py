@@ -0,0 +1,215 @@
+"""
+Trạng thái job dùng chung cho dispatcher (Lambda) và worker (ECS task):
+dispatch idempotent (retry từ API Gateway/backend không launch task trùng) + tra cứu trạng thái.
+
+JOB_STORE:
+  none     - tắt (mặc định)
+  dynamodb - bảng JOB_TABLE, partition key 'jobKey' (string), TTL theo attribute 'expiresAt'
+  sqlite   - file JOB_STORE_PATH; dùng khi chạy local / test (dispatcher và worker cùng máy)
+
+Mỗi image (video-hls-converter, generate_video_caption) build từ thư mục riêng nên file này có 2 bản:
+hai bản phải giống hệt nhau - sửa bản này thì copy sang bản kia (cmp để kiểm tra).
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from decimal import Decimal
+from contextlib import closing
+
+JOB_STORE = os.environ.get('JOB_STORE', 'none')
+JOB_TABLE = os.environ.get('JOB_TABLE', 'media-jobs')
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', '/tmp/media-jobs.db')
+JOB_TTL = int(os.environ.get('JOB_TTL', str(7 * 86400)))
+# Job dispatched/processing không cập nhật quá lâu (task chết giữa chừng) → cho phép dispatch lại
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', str(3 * 3600)))
+
+# queued: job đã vào SQS, chờ worker lấy
+ACTIVE_STATUSES = ('dispatched', 'queued', 'processing')
+
+
+def job_key(kind, bucket, s3_key, **params):
+    """Khoá idempotency: cùng loại job, cùng video, cùng tham số → cùng job"""
+    raw = json.dumps({'kind': kind, 'bucket': bucket, 's3Key': s3_key, **params}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def worker_environment():
+    """
+    Env cho container worker (ECS containerOverrides): worker cập nhật processing/success/failed
+    vào cùng store với dispatcher. Thiếu → record kẹt ở dispatched/queued tới khi stale.
+    DynamoDB: task role cần quyền GetItem/UpdateItem trên JOB_TABLE
+    """
+    if JOB_STORE == 'none':
+        return []
+    env = {'JOB_STORE': JOB_STORE, 'JOB_TTL': str(JOB_TTL)}
+    if JOB_STORE == 'dynamodb':
+        env['JOB_TABLE'] = JOB_TABLE
+    elif JOB_STORE == 'sqlite':
+        env['JOB_STORE_PATH'] = JOB_STORE_PATH
+    return [{'name': name, 'value': value} for name, value in env.items()]
+
+
+def is_claimable(record, now=None):
+    """Chưa có job, job lỗi, hoặc job đang chạy nhưng đã stale → được dispatch lại"""
+    if not record:
+        return True
+    if record.get('status') == 'failed':
+        return True
+    now = now or time.time()
+    return record.get('status') in ACTIVE_STATUSES and now - record.get('updatedAt', 0) > JOB_STALE_SECONDS
+
+
+class JobStore:
+    """
+    Interface của store. claim() phải atomic: nhiều dispatcher claim cùng 1 key
+    thì chỉ 1 thành công, các dispatcher còn lại nhận record đang có.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def claim(self, key, record):
+        """Trả về (True, record mới) nếu claim được, ngược lại (False, record hiện tại)"""
+        raise NotImplementedError
+
+    def update(self, key, **fields):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    @staticmethod
+    def _new_record(key, record):
+        now = time.time()
+        return {
+            **record,
+            'jobKey': key,
+            'createdAt': int(now),
+            'updatedAt': int(now),
+            'expiresAt': int(now + JOB_TTL),
+        }
+
+
+class SqliteJobStore(JobStore):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get(self, key):
+        with self._lock, closing(self._connect()) as conn:
+            row = conn.execute("SELECT data FROM jobs WHERE job_key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, key, record):
+        with self._lock:
+            conn = self._connect()
+            try:
+                # BEGIN IMMEDIATE: khoá ghi ngay → đọc + ghi atomic giữa các process
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT data FROM jobs WHERE job_key = ?", (key,)).fetchone()
+                existing = json.loads(row[0]) if row else None
+                if not is_claimable(existing):
+                    conn.execute("ROLLBACK")
+                    return False, existing
+                record = self._new_record(key, record)
+                conn.execute(
+                    "INSERT OR REPLACE INTO jobs (job_key, data) VALUES (?, ?)",
+                    (key, json.dumps(record))
+                )
+                conn.execute("COMMIT")
+                return True, record
+            finally:
+                conn.close()
+
+    def update(self, key, **fields):
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT data FROM jobs WHERE job_key = ?", (key,)).fetchone()
+                record = json.loads(row[0]) if row else {'jobKey': key}
+                record.update({k: v for k, v in fields.items() if v is not None}, updatedAt=int(time.time()))
+                conn.execute(
+                    "INSERT OR REPLACE INTO jobs (job_key, data) VALUES (?, ?)",
+                    (key, json.dumps(record))
+                )
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+
+
+class DynamoJobStore(JobStore):
+    def __init__(self, table):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table)
+
+    @staticmethod
+    def _plain(item):
+        # DynamoDB trả số dạng Decimal
+        if not item:
+            return None
+        return {k: (int(v) if v == int(v) else float(v)) if isinstance(v, Decimal) else v
+                for k, v in item.items()}
+
+    def get(self, key):
+        return self._plain(self.table.get_item(Key={'jobKey': key}, ConsistentRead=True).get('Item'))
+
+    def claim(self, key, record):
+        from botocore.exceptions import ClientError
+        record = self._new_record(key, record)
+        try:
+            self.table.put_item(
+                Item={k: v for k, v in record.items() if v is not None},
+                ConditionExpression=(
+                    "attribute_not_exists(jobKey) OR #s = :failed"
+                    " OR (#s IN (:dispatched, :queued, :processing) AND updatedAt < :stale)"
+                ),
+                ExpressionAttributeNames={'#s': 'status'},
+                ExpressionAttributeValues={
+                    ':failed': 'failed',
+                    ':dispatched': 'dispatched',
+                    ':queued': 'queued',
+                    ':processing': 'processing',
+                    ':stale': int(time.time() - JOB_STALE_SECONDS),
+                },
+            )
+            return True, record
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            return False, self.get(key)
+
+    def update(self, key, **fields):
+        fields = {k: v for k, v in fields.items() if v is not None}
+        fields['updatedAt'] = int(time.time())
+        names = {f"#f{i}": name for i, name in enumerate(fields)}
+        self.table.update_item(
+            Key={'jobKey': key},
+            UpdateExpression="SET " + ", ".join(f"#f{i} = :v{i}" for i in range(len(fields))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={f":v{i}": value for i, value in enumerate(fields.values())},
+        )
+
+
+_store = None
+
+
+def get_job_store():
+    """Store theo JOB_STORE (None nếu tắt), tạo 1 lần mỗi process"""
+    global _store
+    if _store is None and JOB_STORE != 'none':
+        if JOB_STORE == 'dynamodb':
+            _store = DynamoJobStore(JOB_TABLE)
+        elif JOB_STORE == 'sqlite':
+            _store = SqliteJobStore(JOB_STORE_PATH)
+        else:
+            raise ValueError(f"Unknown JOB_STORE: {JOB_STORE}")
+    return _store
@@ -1,8 +1,31 @@
 import json
 import boto3
 import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from job_store import job_key, get_job_store, worker_environment
 
-ecs = boto3.client('ecs')
+# Gọi API song song từ DISPATCH_WORKERS thread
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '16'))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE = 0.5       # giây, nhân đôi mỗi lần retry (full jitter)
+BACKOFF_CAP = 20
+RUN_TASK_MAX_COUNT = 10  # Giới hạn count của ecs.run_task
+MAX_KEYS_PER_REQUEST = int(os.environ.get('MAX_KEYS_PER_REQUEST', '500'))
+# Lỗi throttling / tạm thời của API → retry; lỗi khác (sai tham số, quyền) → fail ngay
+RETRYABLE_ERRORS = {
+    'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ServerException', 'ServiceUnavailableException', 'LimitExceededException',
+}
+
+# Retry do dispatch tự làm (có jitter + biết thời gian còn lại của Lambda), botocore không retry thêm
+ecs = boto3.client('ecs', config=Config(
+    retries={'total_max_attempts': 1}, max_pool_connections=DISPATCH_WORKERS
+))
+s3 = boto3.client('s3', config=Config(max_pool_connections=DISPATCH_WORKERS))
 
 CLUSTER_NAME = os.environ.get('CLUSTER_NAME', 'video-processing-cluster')
 TASK_DEFINITION = os.environ.get('TASK_DEFINITION', 'hls-converter:1')
@@ -10,42 +33,94 @@ SUBNETS = os.environ.get('SUBNETS', '').split(',')
 SECURITY_GROUP = os.environ.get('SECURITY_GROUP', '')
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
 
+# Gom nhiều video vào 1 ECS task (worker mode, Whisper chỉ load 1 lần/task) theo thời lượng
+TASK_MAX_SECONDS = int(os.environ.get('TASK_MAX_SECONDS', '1800'))  # Tổng thời lượng video / task
+TASK_MAX_JOBS = int(os.environ.get('TASK_MAX_JOBS', '20'))          # Giữ JOBS dưới giới hạn 8 KB của overrides
+DEFAULT_BITRATE = 2500000  # bps - ước lượng thời lượng khi không đọc được header MP4
+# Có queue → job được gửi vào SQS, số task = số nhóm sau khi gom; task lấy job tới khi queue rỗng
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL', '')
+
 def lambda_handler(event, context):
     """
-    Nhận 10 S3 keys, launch 10 tasks, return ngay
+    Nhận danh sách S3 keys, gom theo thời lượng thành ít task nhất có thể, launch song song rồi return ngay
     KHÔNG chờ đợi gì cả!
+    Event: {"s3Bucket", "s3Keys", "language", "batchId"} (nhận cả dạng snake_case cũ)
+    "action": "status" → chỉ tra cứu trạng thái job, không launch
+    Response có 'results': trạng thái từng key (started | queued | skipped | failed).
+    Có JOB_STORE: key đang chạy / đã xong với cùng tham số bị bỏ qua (skipped) thay vì launch lại
     """
     
     print(f"📨 Received request")
     
     try:
-        s3_bucket = event['s3_bucket']
-        s3_keys = event['s3_keys']
+        s3_bucket = event.get('s3Bucket') or event.get('s3_bucket')
+        s3_keys = event.get('s3Keys') or event.get('s3_keys') or []
         language = event.get('language')
-        batch_id = event.get('batch_id')  
+        batch_id = event.get('batchId') or event.get('batch_id')
         
         # Validate
-        if len(s3_keys) > 10:
-            return error_response("Max 10 videos per batch", 400)
+        if not s3_bucket or not s3_keys:
+            return error_response("s3Bucket and s3Keys are required", 400)
+        if len(s3_keys) > MAX_KEYS_PER_REQUEST:
+            return error_response(f"Max {MAX_KEYS_PER_REQUEST} videos per batch", 400)
     
+        s3_keys = list(dict.fromkeys(s3_keys))  # Bỏ key trùng trong cùng request
+        store = get_job_store()
+        job_keys = {
+            key: job_key('captions', s3_bucket, key, language=language or 'auto', batchId=batch_id)
+            for key in s3_keys
+        }
+
+        if event.get('action') == 'status':
+            return job_status_response(store, s3_keys, job_keys)
+
+        # Idempotency: chỉ launch key claim được (chưa có / lỗi / stale)
+        results = {}
+        to_dispatch = s3_keys
+        if store:
+            to_dispatch = []
+            with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+                claims = executor.map(lambda key: store.claim(job_keys[key], {
+                    'status': 'dispatched', 's3Key': key, 'bucket': s3_bucket, 'batchId': batch_id
+                }), s3_keys)
+                for s3_key, (claimed, record) in zip(s3_keys, claims):
+                    if claimed:
+                        to_dispatch.append(s3_key)
+                    else:
+                        results[s3_key] = skipped_result(s3_key, record)
+                        print(f"⏭️  {s3_key} already {record.get('status')}, skipping")
+
+        try:
+            launched = dispatch_jobs(context, results, to_dispatch, job_keys, s3_bucket, language, batch_id)
+        except Exception as e:
+            # Lỗi giữa chừng: nhả claim của key chưa được launch / đưa vào queue,
+            # nếu không request retry bị bỏ qua (dispatched) tới khi job stale
+            if store:
+                release_claims(store, [
+                    job_keys[key] for key in to_dispatch
+                    if results.get(key, {}).get('status') not in ('started', 'queued')
+                ], str(e))
+            raise
         
-        # Launch tất cả tasks
-        launched = []
-        for i, s3_key in enumerate(s3_keys):
-            try:
-                task_arn = launch_task(
-                    s3_bucket=s3_bucket,
-                    s3_key=s3_key,
-                    language=language,
-                    webhook_url=WEBHOOK_URL,
-                    batch_id=batch_id
-                )
-                launched.append(task_arn)
-                print(f"✅ [{i+1}/{len(s3_keys)}] Launched: {task_arn[-8:]}")
-            except Exception as e:
-                print(f"❌ [{i+1}/{len(s3_keys)}] Failed: {str(e)}")
-        
-        print(f"🎉 Launched {len(launched)}/{len(s3_keys)} tasks")
+        results = [{**results[key], 'jobKey': job_keys[key]} for key in s3_keys]
+        if store:
+            # Ghi lại task / lỗi launch (job lỗi được phép launch lại ở request sau)
+            for r in results:
+                try:
+                    if r['status'] == 'started':
+                        store.update(r['jobKey'], taskArn=r['taskArn'])
+                    elif r['status'] == 'queued':
+                        # Job đã nằm trong queue: không 'failed' kể cả khi chưa có worker,
+                        # request sau chỉ launch lại worker thay vì gửi job trùng
+                        store.update(r['jobKey'], status='queued', error=r.get('reason', ''))
+                    elif r['status'] == 'failed':
+                        store.update(r['jobKey'], status='failed', error=r['reason'])
+                except Exception as e:
+                    print(f"Warning: cannot update job store: {str(e)}")
+        failed = sum(1 for r in results if r['status'] == 'failed')
+        skipped = sum(1 for r in results if r['status'] == 'skipped')
+        print(f"🎉 Launched {len(launched)} tasks for {len(s3_keys) - failed - skipped}/{len(s3_keys)} videos"
+              f" ({skipped} skipped)")
         
         # Return ngay lập tức
         return {
@@ -53,7 +128,10 @@ def lambda_handler(event, context):
             'body': json.dumps({
                 'success': True,
                  #'batch_id': batch_id,
-                'tasks_launched': len(launched)
+                'tasks_launched': len(launched),
+                'failed': failed,
+                'skipped': skipped,
+                'results': results
             })
         }
         
@@ -62,41 +140,305 @@ def lambda_handler(event, context):
         return error_response(str(e), 500)
 
 
-def launch_task(s3_bucket, s3_key, language, webhook_url="", batch_id=""):
-    """Launch ECS task"""
-    import uuid
-    job_id = f"job_{uuid.uuid4().hex[:12]}"
-    
-    response = ecs.run_task(
-        cluster=CLUSTER_NAME,
-        taskDefinition=TASK_DEFINITION,
-        launchType='FARGATE',
-        count=1,
-        networkConfiguration={
-            'awsvpcConfiguration': {
-                'subnets': SUBNETS,
-                'securityGroups': [SECURITY_GROUP],
-                'assignPublicIp': 'ENABLED'
-            }
-        },
-        overrides={
-            'containerOverrides': [{
-                'name': 'generator',
-                'environment': [
-                    {'name': 'S3_BUCKET', 'value': s3_bucket},
-                    {'name': 'S3_KEY', 'value': s3_key},
-                    {'name': 'LANGUAGE', 'value': language or 'auto'},
-                    {'name': 'WEBHOOK_URL', 'value': webhook_url},
-                    {'name': 'BATCH_ID', 'value': batch_id}  # Gửi batch_id
-                ]
-            }]
+def dispatch_jobs(context, results, s3_keys, job_keys, s3_bucket, language, batch_id):
+    """
+    Đo thời lượng, gom video thành các task rồi launch (hoặc đưa vào queue).
+    Ghi kết quả từng key vào results. Trả về danh sách taskArn đã launch
+    """
+    # Đo thời lượng (song song), gom video thành các task
+    videos = []
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        durations = executor.map(lambda key: safe_call(probe_duration, s3_bucket, key), s3_keys)
+        for s3_key, (duration, error) in zip(s3_keys, durations):
+            if error:
+                results[s3_key] = {'s3Key': s3_key, 'status': 'failed', 'reason': error}
+                print(f"❌ Cannot read {s3_key}: {error}")
+            else:
+                videos.append({'s3Key': s3_key, 'jobKey': job_keys[s3_key], 'duration': duration})
+    groups = pack_jobs(videos)
+
+    common_env = [
+        {'name': 'S3_BUCKET', 'value': s3_bucket},
+        {'name': 'LANGUAGE', 'value': language or 'auto'},
+        {'name': 'WEBHOOK_URL', 'value': WEBHOOK_URL},
+        {'name': 'BATCH_ID', 'value': str(batch_id or '')}  # Gửi batch_id
+    ]
+    # Worker cập nhật trạng thái job vào cùng store
+    common_env += worker_environment()
+
+    # Launch tất cả tasks
+    launched = []
+    # Job đã vào queue ở request trước nhưng không launch được worker nào → chỉ launch lại worker
+    pending = [key for key, r in results.items() if r.get('jobStatus') == 'queued' and r.get('error')]
+    if JOB_QUEUE_URL and (videos or pending):
+        # Lô gửi lỗi → job failed (request sau launch lại được); job đã vào queue không bị gửi lại
+        enqueued, enqueue_errors = enqueue_jobs(videos, s3_bucket, language, batch_id)
+        for s3_key, error in enqueue_errors.items():
+            results[s3_key] = {'s3Key': s3_key, 'status': 'failed', 'reason': f"Cannot enqueue: {error}"}
+            print(f"❌ Cannot enqueue {s3_key}: {error}")
+        queued = [video['s3Key'] for video in enqueued] + pending
+        if queued:
+            # Mọi worker giống hệt nhau → gộp bằng run_task count
+            workers = max(1, len(pack_jobs(enqueued)))
+            env = [{'name': 'JOB_QUEUE_URL', 'value': JOB_QUEUE_URL}] + common_env
+            counts = [min(RUN_TASK_MAX_COUNT, workers - i) for i in range(0, workers, RUN_TASK_MAX_COUNT)]
+            with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+                launches = list(executor.map(lambda count: run_task_with_backoff(context, env, count), counts))
+            errors = []
+            for arns, error in launches:
+                launched.extend(arns)
+                if error:
+                    errors.append(error)
+                    print(f"❌ Failed to launch workers: {error}")
+            # Không launch được worker nào: message vẫn trong queue → giữ queued,
+            # lỗi được ghi lại để request sau launch lại worker
+            for s3_key in queued:
+                results[s3_key] = {'s3Key': s3_key, 'status': 'queued'}
+                if not launched:
+                    results[s3_key]['reason'] = f"No worker task started: {'; '.join(errors)}"
+    elif groups:
+        # Mỗi task 1 danh sách JOBS riêng → count=1, các task chạy song song
+        def launch_group(group):
+            jobs = json.dumps([
+                {'s3Key': video['s3Key'], 'jobKey': video['jobKey']} for video in group['jobs']
+            ])
+            return run_task_with_backoff(context, [{'name': 'JOBS', 'value': jobs}] + common_env)
+
+        with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+            launches = list(executor.map(launch_group, groups))
+        for i, (group, (arns, error)) in enumerate(zip(groups, launches)):
+            keys = [video['s3Key'] for video in group['jobs']]
+            if arns:
+                launched.append(arns[0])
+                print(f"✅ [{i+1}/{len(groups)}] Launched: {arns[0][-8:]} ({len(keys)} videos, {group['duration']:.0f}s)")
+            else:
+                print(f"❌ [{i+1}/{len(groups)}] Failed: {error}")
+            for key in keys:
+                results[key] = {'s3Key': key, 'status': 'started', 'taskArn': arns[0]} if arns else {
+                    's3Key': key, 'status': 'failed', 'reason': error
+                }
+    return launched
+
+
+def release_claims(store, keys, reason):
+    """Đánh dấu failed để request sau claim lại được"""
+    for key in keys:
+        try:
+            store.update(key, status='failed', error=reason)
+        except Exception as e:
+            print(f"Warning: cannot release job {key}: {str(e)}")
+
+
+def skipped_result(s3_key, record):
+    """Kết quả cho key đã có job (đang chạy hoặc đã xong) → gắn vào job đó"""
+    record = record or {}
+    return {
+        's3Key': s3_key,
+        'status': 'skipped',
+        'jobStatus': record.get('status'),
+        'taskArn': record.get('taskArn'),
+        'error': record.get('error') or None,
+    }
+
+
+def job_status_response(store, s3_keys, job_keys):
+    """Tra cứu trạng thái job theo key (cùng bucket/language/batchId với lúc launch)"""
+    if not store:
+        return error_response('JOB_STORE is not configured', 400)
+    records = store.get_many([job_keys[key] for key in s3_keys])
+    jobs = []
+    for key in s3_keys:
+        record = records.get(job_keys[key]) or {}
+        jobs.append({
+            's3Key': key,
+            'jobKey': job_keys[key],
+            'status': record.get('status', 'not_found'),
+            'taskArn': record.get('taskArn'),
+            'error': record.get('error'),
+            'updatedAt': record.get('updatedAt'),
+        })
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'success': True, 'jobs': jobs})
+    }
+
+
+# --- Helper dispatch dùng chung với video-hls-converter/lambda_function.py ---
+# safe_call, is_capacity_failure, run_task_with_backoff, read_range, probe_duration, pack_jobs,
+# enqueue_jobs là bản copy (mỗi Lambda deploy từ thư mục riêng): sửa logic ở bên này thì sửa cả bên kia.
+# Khác nhau có chủ ý: tên container trong overrides, nội dung message SQS, TASK_MAX_SECONDS mặc định.
+
+def safe_call(func, *args):
+    """Chạy func trong thread pool: trả về (kết quả, None) hoặc (None, lỗi)"""
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, str(e)
+
+
+def is_capacity_failure(reason):
+    # vd. "Capacity is unavailable at this time. Please try again later or in a different availability zone"
+    return 'capacity' in reason.lower() or reason.startswith('RESOURCE')
+
+
+def run_task_with_backoff(context, environment, count=1):
+    """
+    ecs.run_task có retry khi bị throttle hoặc thiếu capacity: exponential backoff + full jitter.
+    count > 1: ECS có thể chỉ start được 1 phần → lần sau chỉ start phần còn thiếu.
+    Không retry nếu thời gian còn lại của Lambda không đủ chờ.
+    Trả về (list taskArn, lỗi cuối cùng hoặc None)
+    """
+    arns = []
+    error = None
+    for attempt in range(DISPATCH_MAX_ATTEMPTS):
+        if attempt:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if context and context.get_remaining_time_in_millis() < (delay + 5) * 1000:
+                break
+            time.sleep(delay)
+        try:
+            response = ecs.run_task(
+                cluster=CLUSTER_NAME,
+                taskDefinition=TASK_DEFINITION,
+                launchType='FARGATE',
+                count=count - len(arns),
+                networkConfiguration={
+                    'awsvpcConfiguration': {
+                        'subnets': SUBNETS,
+                        'securityGroups': [SECURITY_GROUP],
+                        'assignPublicIp': 'ENABLED'
+                    }
+                },
+                overrides={
+                    'containerOverrides': [{
+                        'name': 'generator',
+                        'environment': environment
+                    }]
+                }
+            )
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code', '')
+            error = f"{code}: {e.response.get('Error', {}).get('Message', '')}"
+            if code not in RETRYABLE_ERRORS:
+                break
+            print(f"⚠️  run_task throttled ({code}), attempt {attempt + 1}/{DISPATCH_MAX_ATTEMPTS}")
+            continue
+        except Exception as e:
+            error = str(e)
+            break
+
+        arns.extend(task['taskArn'] for task in response.get('tasks', []))
+        if len(arns) >= count:
+            return arns, None
+        reasons = [failure.get('reason', '') for failure in response.get('failures', [])]
+        error = '; '.join(reasons) or 'Failed to launch task'
+        if not any(is_capacity_failure(reason) for reason in reasons):
+            break
+        print(f"⚠️  run_task capacity shortage ({error}), attempt {attempt + 1}/{DISPATCH_MAX_ATTEMPTS}")
+    return arns, error
+
+
+def read_range(bucket, key, start, end):
+    return s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")['Body'].read()
+
+
+def probe_duration(bucket, key):
+    """
+    Thời lượng video (giây) từ atom mvhd của MP4/MOV bằng vài range GET - Lambda không có ffprobe.
+    Không đọc được → ước lượng theo dung lượng với DEFAULT_BITRATE
+    """
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    try:
+        offset = 0
+        while offset + 8 <= size:
+            header = read_range(bucket, key, offset, min(offset + 15, size - 1))
+            atom_size = int.from_bytes(header[0:4], 'big')
+            header_size = 8
+            if atom_size == 1 and len(header) >= 16:  # 64-bit size
+                atom_size = int.from_bytes(header[8:16], 'big')
+                header_size = 16
+            elif atom_size == 0:  # Atom kéo dài tới hết file
+                atom_size = size - offset
+            if atom_size < header_size:
+                break
+            if header[4:8] == b'moov':
+                # mvhd luôn nằm đầu moov → 4 KB đầu là đủ
+                start = offset + header_size
+                moov = read_range(bucket, key, start, min(offset + atom_size, start + 4096) - 1)
+                pos = 0
+                while pos + 8 <= len(moov):
+                    child_size = int.from_bytes(moov[pos:pos + 4], 'big')
+                    if moov[pos + 4:pos + 8] == b'mvhd':
+                        body = moov[pos + 8:]
+                        if body[0] == 1:  # version 1: thời gian 64-bit
+                            timescale = int.from_bytes(body[20:24], 'big')
+                            duration = int.from_bytes(body[24:32], 'big')
+                        else:
+                            timescale = int.from_bytes(body[12:16], 'big')
+                            duration = int.from_bytes(body[16:20], 'big')
+                        if timescale:
+                            return duration / timescale
+                        break
+                    if child_size < 8:
+                        break
+                    pos += child_size
+                break
+            offset += atom_size
+    except Exception as e:
+        print(f"Warning: cannot read duration of {key}: {str(e)}")
+    return size * 8 / DEFAULT_BITRATE
+
+
+def pack_jobs(videos, max_seconds=TASK_MAX_SECONDS, max_jobs=TASK_MAX_JOBS):
+    """
+    Gom video thành các task (first-fit decreasing): video dài xếp trước, mỗi task tối đa
+    max_seconds tổng thời lượng và max_jobs video. Video dài hơn max_seconds chạy riêng 1 task.
+    """
+    groups = []
+    for video in sorted(videos, key=lambda v: v['duration'], reverse=True):
+        for group in groups:
+            if len(group['jobs']) < max_jobs and group['duration'] + video['duration'] <= max_seconds:
+                break
+        else:
+            group = {'duration': 0, 'jobs': []}
+            groups.append(group)
+        group['jobs'].append(video)
+        group['duration'] += video['duration']
+    return groups
+
+
+def enqueue_jobs(videos, s3_bucket, language, batch_id):
+    """
+    Gửi job vào SQS theo lô 10 message (giới hạn của send_message_batch), các lô gửi song song.
+    Trả về (video đã vào queue, {s3Key: lỗi}): lô lỗi không ảnh hưởng các lô đã gửi
+    """
+    sqs = boto3.client('sqs', config=Config(max_pool_connections=DISPATCH_WORKERS))
+
+    def send_batch(batch):
+        entries = [{
+            'Id': str(index),
+            'MessageBody': json.dumps({
+                's3Key': video['s3Key'],
+                'jobKey': video['jobKey'],
+                'bucket': s3_bucket,
+                'language': language or 'auto',
+                'batchId': batch_id
+            })
+        } for index, video in enumerate(batch)]
+        try:
+            response = sqs.send_message_batch(QueueUrl=JOB_QUEUE_URL, Entries=entries)
+        except Exception as e:
+            return {video['s3Key']: str(e) for video in batch}
+        return {
+            batch[int(failure['Id'])]['s3Key']: failure.get('Message') or failure.get('Code', 'SendMessage failed')
+            for failure in response.get('Failed', [])
         }
-    )
-    
-    if not response.get('tasks'):
-        raise Exception('Failed to launch task')
-    
-    return response['tasks'][0]['taskArn']
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        for batch_errors in executor.map(send_batch, [videos[i:i + 10] for i in range(0, len(videos), 10)]):
+            errors.update(batch_errors)
+    return [video for video in videos if video['s3Key'] not in errors], errors
 
 
 def error_response(message, status_code):
@@ -0,0 +1,333 @@
+"""
+Benchmark HLS converter offline (không cần ECS / AWS thật)
+
+- Tạo video nguồn tổng hợp bằng FFmpeg lavfi (testsrc/testsrc2 + sine) theo độ phân giải,
+  thời lượng và mức chuyển động
+- Chạy convert_to_hls_parallel + upload_hls_parallel với S3 giả lập (moto server),
+  hoặc S3-compatible endpoint bất kỳ qua --endpoint-url (vd. MinIO)
+- Mỗi cấu hình (preset, số worker, chia thread, độ dài segment, ...) đo:
+  encode fps, realtime factor, upload objects/s, peak disk và peak memory
+- Ghi kết quả ra JSON để so sánh giữa các phiên bản
+
+Cần: ffmpeg/ffprobe trong PATH, boto3, moto[server] (nếu không dùng --endpoint-url)
+
+Ví dụ:
+    python3 benchmark_hls.py --resolutions 720,1080 --durations 60 --motion low,high \\
+        --presets veryfast,faster --encode-modes single_pass,per_profile \\
+        --cpu-budgets 0,4 --hls-times 4,6 --output bench-results.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+
+import convert_to_hls
+
+RESOLUTIONS = {
+    480: (854, 480),
+    720: (1280, 720),
+    1080: (1920, 1080),
+}
+# Mức chuyển động: low - hoạ tiết tĩnh; medium - hoạ tiết chuyển động; high - thêm nhiễu theo thời gian
+MOTION_SOURCES = {
+    "low": "testsrc=size={w}x{h}:rate={fps}",
+    "medium": "testsrc2=size={w}x{h}:rate={fps}",
+    "high": "testsrc2=size={w}x{h}:rate={fps},noise=alls=40:allf=t+u",
+}
+SOURCE_FPS = 30
+BUCKET = "hls-benchmark"
+
+
+def make_source(work_dir, height, duration, motion):
+    """Tạo video nguồn H.264/AAC (faststart) bằng lavfi, dùng lại nếu đã có"""
+    w, h = RESOLUTIONS[height]
+    path = os.path.join(work_dir, f"src_{height}p_{duration}s_{motion}.mp4")
+    if os.path.exists(path):
+        return path
+
+    video = MOTION_SOURCES[motion].format(w=w, h=h, fps=SOURCE_FPS)
+    cmd = [
+        "ffmpeg", "-y",
+        "-f", "lavfi", "-i", video,
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+        "-t", str(duration),
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-movflags", "+faststart",
+        path
+    ]
+    print(f"🎬 Generating source {height}p / {duration}s / {motion} motion...")
+    subprocess.run(cmd, check=True, capture_output=True)
+    return path
+
+
+def start_local_s3(endpoint_url=None):
+    """
+    Khởi động moto server (hoặc dùng endpoint có sẵn) và trỏ client S3 của converter vào đó
+    Trả về: (s3 client, server hoặc None)
+    """
+    server = None
+    if not endpoint_url:
+        from moto.server import ThreadedMotoServer
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        endpoint_url = f"http://{host}:{port}"
+        # moto không kiểm tra credentials nhưng boto3 vẫn cần có
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    client = boto3.client("s3", endpoint_url=endpoint_url, region_name="us-east-1")
+    try:
+        client.create_bucket(Bucket=BUCKET)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    convert_to_hls.s3 = client
+    print(f"🪣 Local S3: {endpoint_url} (bucket {BUCKET})")
+    return client, server
+
+
+class ResourceSampler:
+    """
+    Lấy mẫu định kỳ: dung lượng thư mục làm việc và tổng RSS của process này
+    cộng các process con (FFmpeg), giữ lại giá trị lớn nhất
+    """
+
+    def __init__(self, path, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.peak_disk = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self.peak_disk = max(self.peak_disk, dir_size(self.path))
+        self.peak_rss = max(self.peak_rss, process_tree_rss(os.getpid()))
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass  # File bị xoá/đổi tên giữa chừng
+    return total
+
+
+def read_rss(pid):
+    """VmRSS (bytes) của 1 process từ /proc, 0 nếu không đọc được"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree_rss(root_pid):
+    """Tổng RSS của root_pid và mọi process con cháu (Linux /proc)"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += read_rss(pid)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def apply_config(config):
+    """Cấu hình converter bằng cách gán lại các hằng số module (như khi đặt env var)"""
+    convert_to_hls.X264_PRESET = config["preset"]
+    convert_to_hls.ENCODE_MODE = config["encode_mode"]
+    convert_to_hls.CPU_BUDGET = config["cpu_budget"]
+    convert_to_hls.MAX_CHUNK_WORKERS = config["chunk_workers"]
+    convert_to_hls.UPLOAD_WORKERS = config["upload_workers"]
+    convert_to_hls.HLS_TIME = config["hls_time"]
+    convert_to_hls.HLS_FORMAT = config["hls_format"]
+    convert_to_hls.REMUX_FAST_PATH = config["remux"]
+    convert_to_hls.METRICS = convert_to_hls.JobMetrics(convert_to_hls.METRICS_NAMESPACE)
+    convert_to_hls.PROGRESS = convert_to_hls.ProgressTracker()
+
+
+def run_benchmark(source, source_info, config, work_dir):
+    """Chạy 1 cấu hình trên 1 source, trả về dict kết quả"""
+    apply_config(config)
+    run_dir = tempfile.mkdtemp(prefix="run_", dir=work_dir)
+    output_dir = os.path.join(run_dir, "hls_output")
+    hls_base_path = f"bench/{os.path.basename(run_dir)}"
+    frames = source_info["duration"] * SOURCE_FPS
+
+    result = {"source": source_info, "config": config}
+    try:
+        with ResourceSampler(run_dir) as sampler:
+            started = time.time()
+            profiles = convert_to_hls.convert_to_hls_parallel(
+                source, output_dir, BUCKET, hls_base_path
+            )
+            encode_seconds = time.time() - started
+
+            started = time.time()
+            uploaded, failed = convert_to_hls.upload_hls_parallel(
+                output_dir, BUCKET, hls_base_path, None, profiles
+            )
+            upload_seconds = time.time() - started
+
+        ffmpeg_runs = [s for s in convert_to_hls.METRICS.stages if s["stage"] == "ffmpeg"]
+        result.update({
+            "status": "success",
+            "renditions": [p["name"] for p in profiles],
+            "encode_seconds": round(encode_seconds, 3),
+            "encode_fps": round(frames / encode_seconds, 2),
+            "realtime_factor": round(source_info["duration"] / encode_seconds, 3),
+            "ffmpeg_cpu_seconds": round(sum(s["cpu_s"] for s in ffmpeg_runs), 3),
+            "upload_seconds": round(upload_seconds, 3),
+            "uploaded_objects": uploaded,
+            "failed_uploads": len(failed),
+            "upload_objects_per_s": round(uploaded / upload_seconds, 2) if upload_seconds else None,
+            "output_bytes": dir_size(output_dir),
+            "peak_disk_mb": round(sampler.peak_disk / 1024 / 1024, 1),
+            "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1),
+        })
+    except Exception as e:
+        print(f"❌ Benchmark failed: {str(e)}")
+        result.update({"status": "failed", "error": str(e)})
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return result
+
+
+def parse_list(value, cast=str):
+    return [cast(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark cho HLS converter")
+    parser.add_argument("--resolutions", default="480,720,1080", help="480,720,1080")
+    parser.add_argument("--durations", default="30", help="Thời lượng source (giây)")
+    parser.add_argument("--motion", default="low,high", help="low,medium,high")
+    parser.add_argument("--presets", default=convert_to_hls.X264_PRESET)
+    parser.add_argument("--encode-modes", default=convert_to_hls.ENCODE_MODE,
+                        help="single_pass,per_profile,chunked")
+    parser.add_argument("--cpu-budgets", default="0", help="Số CPU chia cho encode (0 = theo cgroup)")
+    parser.add_argument("--chunk-workers", default="0", help="MAX_CHUNK_WORKERS (chunked)")
+    parser.add_argument("--upload-workers", default=str(convert_to_hls.UPLOAD_WORKERS))
+    parser.add_argument("--hls-times", default=str(convert_to_hls.HLS_TIME), help="Độ dài segment (giây)")
+    parser.add_argument("--hls-formats", default=convert_to_hls.HLS_FORMAT, help="ts,fmp4")
+    parser.add_argument("--remux", default="0", help="REMUX_FAST_PATH: 0,1 (mặc định tắt để đo encode)")
+    parser.add_argument("--endpoint-url", help="S3-compatible endpoint có sẵn thay vì moto server")
+    parser.add_argument("--work-dir", default=None, help="Thư mục tạm (mặc định: mkdtemp)")
+    parser.add_argument("--output", default="hls-benchmark.json")
+    args = parser.parse_args()
+
+    configs = [
+        dict(zip(
+            ["preset", "encode_mode", "cpu_budget", "chunk_workers", "upload_workers",
+             "hls_time", "hls_format", "remux"],
+            values
+        ))
+        for values in itertools.product(
+            parse_list(args.presets),
+            parse_list(args.encode_modes),
+            parse_list(args.cpu_budgets, int),
+            parse_list(args.chunk_workers, int),
+            parse_list(args.upload_workers, int),
+            parse_list(args.hls_times, int),
+            parse_list(args.hls_formats),
+            parse_list(args.remux, lambda v: v == "1"),
+        )
+    ]
+    sources = list(itertools.product(
+        parse_list(args.resolutions, int),
+        parse_list(args.durations, int),
+        parse_list(args.motion),
+    ))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="hls-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    _, server = start_local_s3(args.endpoint_url)
+
+    print(f"📋 {len(sources)} sources x {len(configs)} configs = {len(sources) * len(configs)} runs")
+    results = []
+    try:
+        for height, duration, motion in sources:
+            source = make_source(work_dir, height, duration, motion)
+            source_info = {
+                "height": height, "duration": duration, "motion": motion,
+                "bytes": os.path.getsize(source),
+            }
+            for config in configs:
+                print("\n" + "=" * 60)
+                print(f"▶ {height}p/{duration}s/{motion} | {config}")
+                print("=" * 60)
+                result = run_benchmark(source, source_info, config, work_dir)
+                results.append(result)
+                if result["status"] == "success":
+                    print(f"📊 {result['encode_fps']} fps, {result['realtime_factor']}x realtime, "
+                          f"{result['upload_objects_per_s']} objects/s, "
+                          f"disk {result['peak_disk_mb']} MB, RSS {result['peak_rss_mb']} MB")
+    finally:
+        if server:
+            server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created_at": int(time.time()),
+        "host": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "cgroup_cpu_quota": convert_to_hls.read_cgroup_cpu_quota(),
+            "ffmpeg": subprocess.run(
+                ["ffmpeg", "-version"], capture_output=True, text=True
+            ).stdout.split("\n")[0],
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Saved {len(results)} results to {args.output}")
+
+    failed = [r for r in results if r["status"] != "success"]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
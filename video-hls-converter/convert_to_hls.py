@@ -2,11 +2,21 @@ import boto3
 import subprocess
 import os
 import sys
+import json
+import hashlib
+import re
 from pathlib import Path
 import requests
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import shutil
+import threading
+import resource
+import signal
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from boto3.s3.transfer import TransferConfig
+from job_store import get_job_store
 
 # S3 client với config tối ưu
 transfer_config = TransferConfig(
@@ -18,6 +28,198 @@ transfer_config = TransferConfig(
 
 s3 = boto3.client('s3')
 
+# Chế độ encode:
+#   single_pass - decode 1 lần, split/scale ra tất cả profiles trong 1 FFmpeg (mặc định)
+#   per_profile - mỗi profile 1 FFmpeg riêng
+#   chunked     - cắt source theo keyframe, encode song song từng đoạn rồi ghép playlist
+ENCODE_MODE = os.environ.get('ENCODE_MODE', 'single_pass')
+CHUNK_SECONDS = int(os.environ.get('CHUNK_SECONDS', '120'))
+MAX_CHUNK_WORKERS = int(os.environ.get('MAX_CHUNK_WORKERS', '0'))  # 0 = theo số CPU
+# Source đã là H.264 đúng kích thước 1 rung → stream copy rung đó thay vì encode lại
+REMUX_FAST_PATH = os.environ.get('REMUX_FAST_PATH', '1') == '1'
+REMUX_MAX_BITRATE_RATIO = 1.5   # Bitrate source tối đa so với bitrate của rung
+HLS_TIME = 6             # Độ dài segment (giây)
+X264_PRESET = os.environ.get('X264_PRESET', 'veryfast')
+X264_CRF = os.environ.get('X264_CRF', '23')
+ENCODE_TIMEOUT = 1800    # 30 phút
+# Số CPU dùng cho encode (0 = tự đọc cgroup quota của container)
+CPU_BUDGET = int(os.environ.get('CPU_BUDGET', '0'))
+AUDIO_ENCODE_WEIGHT = 854 * 480 // 10   # Audio encode ~ 1/10 chi phí rung 480p
+# Encode không tiến triển trong STALL_TIMEOUT giây → kill sớm thay vì chờ ENCODE_TIMEOUT
+STALL_TIMEOUT = int(os.environ.get('STALL_TIMEOUT', '180'))
+# Khoảng cách tối thiểu giữa 2 webhook "progress" (giây)
+PROGRESS_INTERVAL = int(os.environ.get('PROGRESS_INTERVAL', '30'))
+# Chế độ upload:
+#   streaming - upload segments trong lúc encode (mặc định)
+#   batch     - encode xong mới upload toàn bộ
+UPLOAD_MODE = os.environ.get('UPLOAD_MODE', 'streaming')
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '10'))
+# Định dạng output:
+#   ts   - MPEG-TS, mỗi segment 1 file (mặc định)
+#   fmp4 - CMAF/fMP4, 1 file .m4s mỗi rendition + playlist EXT-X-BYTERANGE
+HLS_FORMAT = os.environ.get('HLS_FORMAT', 'ts')
+# Audio:
+#   shared - encode audio 1 lần thành audio-only rendition, variants chỉ có video (mặc định)
+#   muxed  - mỗi variant tự encode và mux audio riêng
+AUDIO_MODE = os.environ.get('AUDIO_MODE', 'shared')
+AUDIO_BITRATE = "128k"
+AUDIO_RENDITION = {"name": "audio", "type": "audio", "bitrate": AUDIO_BITRATE}
+# Poster + sprite sheets + WebVTT thumbnail track (seek preview), tạo từ cùng lần decode
+THUMBNAILS = os.environ.get('THUMBNAILS', '1') == '1'
+THUMBNAIL_DIR = "thumbnails"
+THUMB_INTERVAL = int(os.environ.get('THUMB_INTERVAL', '10'))  # giây / thumbnail
+THUMB_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+POSTER_TIME = 5          # Giây lấy poster (video ngắn hơn → giữa video)
+POSTER_MAX_WIDTH = 1280
+# Cách đọc source:
+#   auto     - stream thẳng từ S3 (presigned URL) nếu đọc tuần tự được, ngược lại download
+#   stream   - luôn stream từ S3
+#   download - luôn download về /tmp
+INPUT_MODE = os.environ.get('INPUT_MODE', 'auto')
+PRESIGN_EXPIRES = int(os.environ.get('PRESIGN_EXPIRES', '21600'))  # 6 giờ
+# Cache theo nội dung source: video trùng (upload lại, copy sang khoá học khác)
+# dùng lại output HLS đã có thay vì encode lại
+DEDUP_CACHE = os.environ.get('DEDUP_CACHE', '1') == '1'
+CACHE_PREFIX = os.environ.get('CACHE_PREFIX', '.media-cache')
+CACHE_HASH = os.environ.get('CACHE_HASH', 'metadata')  # metadata | full
+# Giới hạn dung lượng /tmp cho 1 job (MB, 0 = không giới hạn). Bật giới hạn (UPLOAD_MODE=streaming):
+#   - segment đã upload bị xoá khỏi local, source local bị xoá ngay khi encode xong
+#   - source lớn hơn nửa budget luôn được stream từ S3 thay vì download
+#   - dung lượng vượt DISK_HIGH_WATERMARK → tạm dừng (SIGSTOP) các FFmpeg cho tới khi
+#     uploader giải phóng xuống dưới DISK_LOW_WATERMARK
+DISK_BUDGET_MB = int(os.environ.get('DISK_BUDGET_MB', '0'))
+DISK_HIGH_WATERMARK = 0.9
+DISK_LOW_WATERMARK = 0.7
+DISK_MAX_PAUSE = 300     # Dừng quá lâu (uploader không giải phóng được) → chạy tiếp
+# Fast publish: encode + upload rung thấp nhất trước (toàn bộ CPU), publish master chỉ có rung đó
+# và gửi webhook "playable"; các rung cao hơn được thêm vào master khi xong (UPLOAD_MODE=streaming)
+FAST_PUBLISH = os.environ.get('FAST_PUBLISH', '0') == '1'
+# Source dài hơn giới hạn bị từ chối ngay sau ffprobe
+MAX_SOURCE_DURATION = int(os.environ.get('MAX_SOURCE_DURATION', str(6 * 3600)))
+# Ghi manifest job lên S3 → chạy lại chỉ encode/upload phần còn thiếu
+RESUMABLE_JOBS = os.environ.get('RESUMABLE_JOBS', '1') == '1'
+# Metrics mỗi job: 1 dòng JSON (CloudWatch EMF) ra stdout; có METRICS_PREFIX → ghi thêm lên S3
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'HLSConverter')
+METRICS_PREFIX = os.environ.get('METRICS_PREFIX', '')
+
+# Worker mode: 1 task xử lý nhiều video liên tiếp → không trả cold start (pull image, start container) mỗi video
+#   JOBS          - JSON list job do dispatcher gom sẵn: [{"s3Key": ..., "bucket": ..., "jobId": ...}]
+#   JOB_QUEUE_URL - lấy job từ SQS (hoặc service tương thích qua SQS_ENDPOINT_URL) tới khi queue rỗng
+# Không có cả 2 → 1 job từ S3_KEY/BUCKET như cũ
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL', '')
+SQS_ENDPOINT_URL = os.environ.get('SQS_ENDPOINT_URL') or None
+QUEUE_WAIT_SECONDS = 20          # Long polling
+QUEUE_IDLE_POLLS = int(os.environ.get('QUEUE_IDLE_POLLS', '2'))  # Số lần poll rỗng liên tiếp → thoát
+QUEUE_VISIBILITY_TIMEOUT = 300   # Gia hạn định kỳ trong lúc job chạy
+
+class JobMetrics:
+    """
+    Đo từng stage của job: wall time, bytes, CPU time + max RSS của process con
+    (resource.getrusage(RUSAGE_CHILDREN)) và peak RSS của chính process Python.
+    emit() in ra 1 record JSON duy nhất theo CloudWatch Embedded Metric Format.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.started = time.time()
+        self.properties = {}
+        self.stages = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        # Worker mode chạy nhiều job/process: CPU của process con chỉ tính phần phát sinh từ lúc này
+        self._children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def set(self, **properties):
+        self.properties.update(properties)
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, stage, **values):
+        with self._lock:
+            self.stages.append({"stage": stage, **values})
+
+    @contextmanager
+    def stage(self, name, **values):
+        """
+        Đo 1 stage. Caller có thể thêm field vào dict được yield (vd. bytes).
+        Stage chạy song song với stage khác thì child CPU bị tính chồng nhau;
+        FFmpeg dùng số liệu chính xác từ os.wait4() (xem run_ffmpeg).
+        """
+        values = dict(values)
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.time()
+        try:
+            yield values
+        except BaseException:
+            values["error"] = True
+            raise
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            values["wall_s"] = round(time.time() - started, 3)
+            values["child_cpu_s"] = round(
+                (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime), 3
+            )
+            # ru_maxrss (KB trên Linux) của RUSAGE_CHILDREN là max của mọi process con đã kết thúc
+            values["child_max_rss_mb"] = round(after.ru_maxrss / 1024, 1)
+            values["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            self.record(name, **values)
+
+    def to_emf(self):
+        """Record EMF: tổng theo loại stage là metric, chi tiết từng stage nằm trong 'stages'"""
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        before = self._children_before
+        metrics = {
+            "JobWallTime": (round(time.time() - self.started, 3), "Seconds"),
+            "ChildCPUTime": (round(
+                (children.ru_utime + children.ru_stime) - (before.ru_utime + before.ru_stime), 3
+            ), "Seconds"),
+            "ChildMaxRSS": (round(children.ru_maxrss / 1024, 1), "Megabytes"),
+            "PeakRSS": (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "Megabytes"),
+        }
+        with self._lock:
+            stages = list(self.stages)
+            counters = dict(self.counters)
+        for record in stages:
+            name = "".join(part.capitalize() for part in record["stage"].split("_")) + "Time"
+            total = metrics.get(name, (0, "Seconds"))[0] + record["wall_s"]
+            metrics[name] = (round(total, 3), "Seconds")
+        for name, value in counters.items():
+            metrics["".join(part.capitalize() for part in name.split("_"))] = (value, "Bytes")
+
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [[]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+                }],
+            },
+            **{name: value for name, (value, _) in metrics.items()},
+            **self.properties,
+            "stages": stages,
+        }
+
+    def emit(self, bucket=None, key=None):
+        """In record ra stdout (CloudWatch Logs nhận EMF), tuỳ chọn ghi lên S3"""
+        record = self.to_emf()
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+        if bucket and key:
+            try:
+                s3.put_object(
+                    Bucket=bucket, Key=key,
+                    Body=json.dumps(record, ensure_ascii=False).encode('utf-8'),
+                    ContentType='application/json'
+                )
+            except Exception as e:
+                print(f"Warning: cannot save metrics: {str(e)}")
+
+METRICS = JobMetrics(METRICS_NAMESPACE)
+
 def download_from_s3(bucket, key, local_path):
     """Download video từ S3 về local"""
     print(f"📥 Downloading s3://{bucket}/{key}")
@@ -37,24 +239,203 @@ def upload_to_s3(local_path, bucket, key):
     except Exception as e:
         raise Exception(f"Failed to upload to S3: {str(e)}")
     
-def get_video_resolution(input_file):
-    """Lấy độ phân giải gốc của video (width, height)"""
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height",
-        "-of", "csv=s=x:p=0",
-        input_file
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    resolution = result.stdout.strip()
-    
-    if not resolution:
-        raise Exception("Không lấy được thông tin độ phân giải video.")
-    
-    width, height = map(int, resolution.split('x'))
-    return width, height
+def is_remote_input(input_file):
+    return input_file.startswith(("http://", "https://"))
+
+def input_args(input_file):
+    """Tham số input cho FFmpeg (thêm reconnect khi đọc qua HTTP)"""
+    if is_remote_input(input_file):
+        return [
+            "-reconnect", "1",
+            "-reconnect_streamed", "1",
+            "-reconnect_delay_max", "5",
+            "-i", input_file,
+        ]
+    return ["-i", input_file]
+
+def is_streamable_mp4(bucket, key, size):
+    """
+    Đọc header các top-level atom bằng range GET (16 bytes mỗi atom).
+    True nếu 'moov' nằm trước 'mdat' (faststart) → FFmpeg đọc tuần tự qua HTTP được.
+    moov nằm cuối file thì FFmpeg phải seek qua lại liên tục → nên download.
+    """
+    offset = 0
+    while offset + 8 <= size:
+        end = min(offset + 15, size - 1)
+        header = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{end}")['Body'].read()
+        atom_size = int.from_bytes(header[0:4], 'big')
+        atom_type = header[4:8]
+        if atom_type == b'moov':
+            return True
+        if atom_type == b'mdat':
+            return False
+        if atom_size == 1 and len(header) >= 16:  # 64-bit size
+            atom_size = int.from_bytes(header[8:16], 'big')
+        if atom_size < 8:  # size 0 = atom kéo dài đến hết file
+            return False
+        offset += atom_size
+    return False
+
+def resolve_input(bucket, key, local_path):
+    """
+    Chọn nguồn input cho FFmpeg/ffprobe theo INPUT_MODE.
+    Trả về: (input, is_local) - input là presigned URL hoặc đường dẫn local
+    """
+    mode = INPUT_MODE
+    if mode == 'auto':
+        size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        ext = os.path.splitext(key)[1].lower()
+        if DISK_BUDGET_MB and size > DISK_BUDGET_MB * 1024 * 1024 / 2:
+            print("Source lớn hơn nửa disk budget → stream")
+            mode = 'stream'
+        elif ext in ('.mp4', '.m4v', '.mov') and not is_streamable_mp4(bucket, key, size):
+            print("moov atom nằm cuối file → download")
+            mode = 'download'
+        else:
+            mode = 'stream'
+
+    if mode == 'stream':
+        url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=PRESIGN_EXPIRES
+        )
+        print(f"📡 Streaming s3://{bucket}/{key} (presigned URL)")
+        return url, False
+
+    with METRICS.stage("download") as stage:
+        download_from_s3(bucket, key, local_path)
+        stage["bytes"] = os.path.getsize(local_path)
+    METRICS.count("bytes_downloaded", stage["bytes"])
+    return local_path, True
+
+class MediaInfo:
+    """
+    Thông tin source từ 1 lần ffprobe (JSON): stream video/audio đầu tiên, thời lượng,
+    rotation, fps, codec, bitrate. Dùng chung cho chọn ladder, remux, tiến độ, chunking.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        streams = data.get("streams", [])
+        # Ảnh bìa (attached_pic) trong file audio không phải video
+        self.video = next((st for st in streams if st.get("codec_type") == "video"
+                           and not st.get("disposition", {}).get("attached_pic")), None)
+        self.audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+        self.format = data.get("format", {})
+
+    @property
+    def width(self):
+        return int((self.video or {}).get("width") or 0)
+
+    @property
+    def height(self):
+        return int((self.video or {}).get("height") or 0)
+
+    @property
+    def rotation(self):
+        """Góc xoay khi hiển thị (0/90/180/270) - tag rotate (FFmpeg 4.x) hoặc display matrix"""
+        video = self.video or {}
+        rotation = video.get("tags", {}).get("rotate")
+        if rotation is None:
+            rotation = next((sd.get("rotation") for sd in video.get("side_data_list", [])
+                             if "rotation" in sd), 0)
+        try:
+            return int(float(rotation)) % 360
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def display_size(self):
+        """(width, height) sau khi xoay - FFmpeg tự xoay khi decode (autorotate)"""
+        if self.rotation in (90, 270):
+            return self.height, self.width
+        return self.width, self.height
+
+    @property
+    def is_portrait(self):
+        width, height = self.display_size
+        return height > width
+
+    @property
+    def duration(self):
+        for value in (self.format.get("duration"), (self.video or {}).get("duration")):
+            try:
+                if value and float(value) > 0:
+                    return float(value)
+            except ValueError:
+                pass
+        return None
+
+    @property
+    def fps(self):
+        video = self.video or {}
+        for value in (video.get("avg_frame_rate"), video.get("r_frame_rate")):
+            try:
+                num, den = (value or "0/0").split("/")
+                if int(den):
+                    return int(num) / int(den)
+            except ValueError:
+                pass
+        return None
+
+    @property
+    def has_audio(self):
+        return self.audio is not None
+
+    @property
+    def video_bitrate(self):
+        """Bitrate video: lấy từ stream, không có (MKV) thì lấy tổng trừ audio. 0 = không rõ"""
+        try:
+            bitrate = int((self.video or {}).get("bit_rate") or 0)
+            if not bitrate:
+                bitrate = int(self.format.get("bit_rate") or 0) - int((self.audio or {}).get("bit_rate") or 0)
+        except ValueError:
+            return 0
+        return max(bitrate, 0)
+
+    def validate(self):
+        """Từ chối sớm input không xử lý được (thay vì đợi encode lỗi)"""
+        if not self.video:
+            raise Exception("Source không có video stream")
+        if not self.width or not self.height or self.video.get("codec_name") in (None, "none"):
+            raise Exception(f"Video stream không đọc được (codec: {self.video.get('codec_name')})")
+        if not self.duration:
+            raise Exception("Không xác định được thời lượng video")
+        if self.duration > MAX_SOURCE_DURATION:
+            raise Exception(f"Video quá dài ({self.duration:.0f}s > {MAX_SOURCE_DURATION}s)")
+        return self
+
+    def summary(self):
+        width, height = self.display_size
+        audio = self.audio["codec_name"] if self.audio else "no audio"
+        return (f"{width}x{height} ({self.video.get('codec_name')}"
+                f"{f', rotate {self.rotation}' if self.rotation else ''}), "
+                f"{self.duration or 0:.1f}s @ {self.fps or 0:.2f}fps, {audio}")
+
+_media_info = {}
+
+def probe_media(input_file):
+    """ffprobe source 1 lần cho cả job (cache theo input)"""
+    if input_file not in _media_info:
+        cmd = [
+            "ffprobe",
+            "-v", "error",
+            "-show_format",
+            "-show_streams",
+            "-of", "json",
+            input_file
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        try:
+            data = json.loads(result.stdout or "{}")
+        except ValueError:
+            data = {}
+        if result.returncode != 0 or not data.get("streams"):
+            error = (result.stderr or "").strip()[-300:] or "no streams"
+            raise Exception(f"Không đọc được thông tin video: {error}")
+        _media_info[input_file] = MediaInfo(data)
+    return _media_info[input_file]
 
 
 def get_valid_profiles(input_height):
@@ -67,134 +448,1220 @@ def get_valid_profiles(input_height):
     # Chỉ chọn những mức ≤ độ cao gốc
     return [p for p in profiles if p["height"] <= input_height]
 
-def encode_single_profile(args):
+def get_ladder(media):
+    """
+    Ladder theo cạnh ngắn của khung hình hiển thị.
+    Video dọc (kể cả quay điện thoại có rotation) → rung dọc (vd. 480p = 480x854)
+    """
+    width, height = media.display_size
+    profiles = get_valid_profiles(min(width, height))
+    if media.is_portrait:
+        profiles = [{**p, "width": p["height"], "height": p["width"]} for p in profiles]
+    return profiles
+
+def build_video_args(profile, index=None):
+    """
+    Tham số x264 cho 1 profile.
+    index != None → thêm stream specifier (v:index) khi 1 output có nhiều video stream
+    """
+    spec = ":v" if index is None else f":v:{index}"
+    bitrate = profile["bitrate"]
+    return [
+        f"-c{spec}", "libx264",
+        f"-preset{spec}", X264_PRESET,  # ← TỐI ƯU: Fast preset
+        f"-crf{spec}", X264_CRF,        # ← TỐI ƯU: Reasonable quality
+        f"-b{spec}", bitrate,
+        f"-maxrate{spec}", bitrate,
+        f"-bufsize{spec}", str(int(bitrate.replace("k", "")) * 2) + "k",
+    ]
+
+def build_audio_args(index=None):
+    """Tham số AAC (stereo 128k) - giống nhau cho mọi profile"""
+    spec = ":a" if index is None else f":a:{index}"
+    return [
+        f"-c{spec}", "aac",
+        f"-b{spec}", AUDIO_BITRATE,
+        f"-ac{spec}", "2",              # Stereo
+        f"-ar{spec}", "48000",          # Sample rate
+    ]
+
+def build_hls_args():
+    """Tham số HLS muxer dùng chung"""
+    args = [
+        "-hls_time", str(HLS_TIME),   # ← TỐI ƯU: Segment nhỏ hơn
+        "-hls_list_size", "0",
+    ]
+    if HLS_FORMAT == 'fmp4':
+        # CMAF: 1 file .m4s / rendition, playlist dùng EXT-X-BYTERANGE
+        args += [
+            "-hls_segment_type", "fmp4",
+            "-hls_flags", "independent_segments+single_file",
+        ]
+    else:
+        args += ["-hls_flags", "independent_segments"]
+    return args + ["-f", "hls"]
+
+def hls_segment_filename(prefix):
+    """Tên file segment: TS → {prefix}0.ts, {prefix}1.ts...; fMP4 → {prefix}.m4s (single file)"""
+    if HLS_FORMAT == 'fmp4':
+        return f"{prefix.rstrip('_')}.m4s"
+    return f"{prefix}%d.ts"
+
+def hls_playlist_version():
+    return 7 if HLS_FORMAT == 'fmp4' else 3
+
+def thumbnail_size(width, height):
+    """Kích thước 1 thumbnail trong sprite (giữ tỉ lệ, chiều cao chẵn)"""
+    return THUMB_WIDTH, max(2, round(THUMB_WIDTH * height / width / 2) * 2)
+
+def build_thumbnail_graph(input_label, output_dir, spec):
+    """
+    Nhánh filter tạo poster + sprite sheets từ 1 stream video đã decode.
+    spec: {"width", "height", "duration"} của source
+    Trả về: (filters, output_args) để ghép vào lệnh FFmpeg
+    """
+    thumb_dir = os.path.join(output_dir, THUMBNAIL_DIR)
+    os.makedirs(thumb_dir, exist_ok=True)
+    tw, th = thumbnail_size(spec["width"], spec["height"])
+    duration = spec.get("duration") or 0
+    poster_time = POSTER_TIME if duration > 2 * POSTER_TIME else duration / 2
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+
+    filters = [
+        f"{input_label}split=2[tposter][tsprite]",
+        # Chỉ chọn đúng 1 frame (prev_selected_t = NAN cho tới frame đầu tiên được chọn)
+        f"[tposter]select='gte(t\\,{poster_time:.3f})*isnan(prev_selected_t)',"
+        f"scale='min({POSTER_MAX_WIDTH}\\,iw)':-2[poster]",
+        f"[tsprite]fps=1/{THUMB_INTERVAL},scale={tw}:{th},"
+        f"tile={SPRITE_COLUMNS}x{SPRITE_ROWS}[sprite]",
+    ]
+    output_args = [
+        "-map", "[poster]", "-frames:v", "1", "-c:v", "mjpeg", "-q:v", "3",
+        os.path.join(thumb_dir, "poster.jpg"),
+        # 1 sheet mỗi THUMB_INTERVAL * per_sheet giây: -r đúng nhịp đó để không bị nhân frame
+        "-map", "[sprite]", "-r", f"1/{THUMB_INTERVAL * per_sheet}",
+        "-c:v", "mjpeg", "-q:v", "5", "-f", "image2",
+        os.path.join(thumb_dir, "sprite_%03d.jpg"),
+    ]
+    return filters, output_args
+
+def write_thumbnail_track(output_dir, spec):
+    """
+    Ghi thumbnails.vtt: mỗi cue THUMB_INTERVAL giây trỏ tới 1 ô trong sprite (#xywh).
+    URL tương đối theo file VTT → vẫn đúng khi output được copy sang path khác (cache)
+    Trả về: đường dẫn VTT, hoặc None nếu không có sprite
+    """
+    thumb_dir = os.path.join(output_dir, THUMBNAIL_DIR)
+    sheets = sorted(f for f in os.listdir(thumb_dir) if f.startswith("sprite_")) \
+        if os.path.isdir(thumb_dir) else []
+    duration = spec.get("duration")
+    if not sheets or not duration:
+        return None
+
+    tw, th = thumbnail_size(spec["width"], spec["height"])
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    count = min(len(sheets) * per_sheet, int((duration + THUMB_INTERVAL - 1) // THUMB_INTERVAL))
+
+    def timestamp(seconds):
+        ms = int(round(seconds * 1000))
+        return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+    lines = ["WEBVTT", ""]
+    for i in range(count):
+        sheet, cell = sheets[i // per_sheet], i % per_sheet
+        x, y = (cell % SPRITE_COLUMNS) * tw, (cell // SPRITE_COLUMNS) * th
+        lines.append(f"{timestamp(i * THUMB_INTERVAL)} --> {timestamp(min((i + 1) * THUMB_INTERVAL, duration))}")
+        lines.append(f"{sheet}#xywh={x},{y},{tw},{th}")
+        lines.append("")
+
+    vtt_path = os.path.join(thumb_dir, "thumbnails.vtt")
+    with open(vtt_path, "w") as f:
+        f.write("\n".join(lines))
+    return vtt_path
+
+def generate_thumbnails(input_file, output_dir, spec):
+    """
+    Tạo poster + sprites bằng lệnh riêng, chỉ decode keyframes (-skip_frame nokey).
+    Dùng khi không ghép được vào lần encode (per_profile, chunked, resume, chỉ remux)
+    """
+    filters, output_args = build_thumbnail_graph("[0:v]", output_dir, spec)
+    cmd = [
+        "ffmpeg",
+        "-skip_frame", "nokey",
+        *input_args(input_file),
+        "-filter_complex", ";".join(filters),
+        *output_args,
+    ]
+    print("[thumbnails] Generating from keyframes...")
+    return run_ffmpeg(cmd, "thumbnails")
+
+def get_thumbnails(output_dir):
+    """Đường dẫn tương đối (theo hls_base_path) của poster và thumbnail track, nếu có"""
+    thumbnails = {}
+    for key, name in (("poster", "poster.jpg"), ("track", "thumbnails.vtt")):
+        if os.path.exists(os.path.join(output_dir, THUMBNAIL_DIR, name)):
+            thumbnails[key] = f"{THUMBNAIL_DIR}/{name}"
+    return thumbnails or None
+
+def is_profile_complete(out_dir):
+    """Playlist đã được ffmpeg ghi xong (có #EXT-X-ENDLIST)"""
+    playlist = os.path.join(out_dir, "playlist.m3u8")
+    if not os.path.exists(playlist):
+        return False
+    with open(playlist) as f:
+        return "#EXT-X-ENDLIST" in f.read()
+
+def is_audio_rendition(profile):
+    return profile.get("type") == "audio"
+
+def read_cgroup_cpu_quota():
+    """CPU quota của container (số vCPU, có thể lẻ) từ cgroup v2/v1. Không giới hạn → None"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def get_cpu_budget():
+    """
+    Số CPU thực sự dùng được: min(cgroup quota, CPU affinity).
+    Trong Fargate os.cpu_count() trả về số core của host, không phải vCPU của task.
+    """
+    if CPU_BUDGET:
+        return CPU_BUDGET
+    if hasattr(os, "sched_getaffinity"):
+        budget = len(os.sched_getaffinity(0))
+    else:
+        budget = os.cpu_count() or 1
+    quota = read_cgroup_cpu_quota()
+    if quota:
+        budget = min(budget, max(1, int(quota + 0.5)))
+    return budget
+
+def encode_weight(profile):
+    """Chi phí encode tương đối ~ pixel rate (cùng fps với source nên chỉ cần số pixel)"""
+    if is_audio_rendition(profile):
+        return AUDIO_ENCODE_WEIGHT
+    return profile["width"] * profile["height"]
+
+def allocate_threads(renditions, budget):
+    """
+    Chia budget threads cho các encode chạy đồng thời theo tỉ lệ pixel rate
+    (tối thiểu 1 thread mỗi encode). Trả về: {name: threads}
+    """
+    total = sum(encode_weight(r) for r in renditions) or 1
+    shares = {r["name"]: budget * encode_weight(r) / total for r in renditions}
+    threads = {name: max(1, int(share)) for name, share in shares.items()}
+    # Phần dư chia cho các encode có phần lẻ lớn nhất
+    spare = budget - sum(threads.values())
+    for name in sorted(shares, key=lambda n: shares[n] - int(shares[n]), reverse=True):
+        if spare <= 0:
+            break
+        threads[name] += 1
+        spare -= 1
+    return threads
+
+def encode_single_profile(input_file, output_dir, profile, threads):
     """
-    Encode 1 profile - chạy trong process riêng
+    Encode 1 profile (hoặc audio rendition dùng chung) - 1 process FFmpeg riêng
     Trả về: (profile_name, success, error_message)
     """
-    input_file, output_dir, profile = args
-    
     profile_name = profile["name"]
     out_dir = os.path.join(output_dir, profile_name)
     os.makedirs(out_dir, exist_ok=True)
     output_playlist = os.path.join(out_dir, "playlist.m3u8")
     
-    # Số threads cho mỗi FFmpeg instance
-    cpu_count = os.cpu_count() or 4
-    threads_per_profile = max(1, cpu_count // 4)  # Chia CPU cho các profiles
-    
+    if is_audio_rendition(profile):
+        stream_args = ["-map", "0:a:0", "-vn", *build_audio_args()]
+    else:
+        stream_args = [
+            "-vf", f"scale={profile['width']}:{profile['height']}",
+            *build_video_args(profile),
+            # Audio shared (hoặc source không có audio) → variant chỉ có video
+            *(build_audio_args() if AUDIO_MODE != 'shared' and probe_media(input_file).has_audio
+              else ["-an"]),
+        ]
+
     cmd = [
         "ffmpeg",
-        "-i", input_file,
-        "-threads", str(threads_per_profile),
-        "-vf", f"scale={profile['width']}:{profile['height']}",
-        "-c:v", "libx264",
-        "-preset", "veryfast",  # ← TỐI ƯU: Fast preset
-        "-crf", "23",            # ← TỐI ƯU: Reasonable quality
-        "-b:v", profile["bitrate"],
-        "-maxrate", profile["bitrate"],
-        "-bufsize", str(int(profile["bitrate"].replace("k", "")) * 2) + "k",
-        "-c:a", "aac",
-        "-b:a", "128k",
-        "-ac", "2",              # Stereo
-        "-ar", "48000",          # Sample rate
-        "-hls_time", "6",        # ← TỐI ƯU: Segment nhỏ hơn
-        "-hls_list_size", "0",
-        "-hls_flags", "independent_segments",
-        "-f", "hls",
+        *input_args(input_file),
+        "-threads", str(threads),
+        *stream_args,
+        *build_hls_args(),
         output_playlist
     ]
     
-    print(f"[{profile_name}] Starting encode...")
+    print(f"[{profile_name}] Starting encode ({threads} threads)...")
+    
+    error_msg = run_ffmpeg(cmd, profile_name, progress_weight=1)
+    if error_msg:
+        return (profile_name, False, error_msg)
+    
+    # Kiểm tra output files
+    files = os.listdir(out_dir)
+    if not files or 'playlist.m3u8' not in files:
+        print(f"[{profile_name}] No output files generated")
+        return (profile_name, False, "No output files")
+    
+    print(f"[{profile_name}] Completed! Generated {len(files)} files")
+    return (profile_name, True, None)
+
+def encode_profiles_parallel(input_file, output_dir, profiles, on_complete=None):
+    """
+    Mỗi profile 1 process FFmpeg riêng (mỗi process tự decode lại source).
+    Scheduler theo CPU budget của container: profile nặng nhất chạy trước, threads
+    chia theo pixel rate trên số CPU còn trống; khi 1 encode xong, CPU được trả lại
+    và chia cho các encode chưa chạy.
+    on_complete(profile_name, success): gọi ngay khi từng profile xong (fast publish)
+    Trả về: {profile_name: (success, error)}
+    """
+    budget = get_cpu_budget()
+    PROGRESS.add_work(len(profiles))
+    pending = sorted(profiles, key=encode_weight, reverse=True)
+    running = {}   # future -> threads
+    free = budget
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+        while pending or running:
+            while pending:
+                threads = allocate_threads(pending, free)[pending[0]["name"]] if free > 0 else 1
+                # Hết CPU trống → chờ encode đang chạy trả CPU
+                if running and threads > free:
+                    break
+                profile = pending.pop(0)
+                future = executor.submit(encode_single_profile, input_file, output_dir, profile, threads)
+                running[future] = threads
+                free -= threads
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                free += running.pop(future)
+                profile_name, success, error = future.result()
+                results[profile_name] = (success, error)
+                if on_complete:
+                    on_complete(profile_name, success)
     
+    return results
+
+class WorkspaceGuard:
+    """
+    Giữ dung lượng thư mục làm việc dưới disk budget bằng backpressure:
+    vượt high watermark → SIGSTOP mọi FFmpeg đang chạy, xuống dưới low watermark → SIGCONT.
+    Thời gian bị dừng không tính vào stall/timeout của run_ffmpeg.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.budget = 0
+        self.paused = False
+        self.paused_seconds = 0
+        self.peak = 0
+        self._paused_since = None
+        self._cooldown_until = 0
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, path, budget_mb, poll_interval=1):
+        self.path = path
+        self.budget = budget_mb * 1024 * 1024
+        self._thread = threading.Thread(target=self._watch, args=(poll_interval,), daemon=True)
+        self._thread.start()
+        print(f"💾 Disk budget: {budget_mb} MB")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self.paused:
+            self._resume()
+
+    def register(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if self.paused:
+                self._signal(process, signal.SIGSTOP)
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def usage(self):
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass  # File vừa bị xoá (đã upload) / đổi tên
+        return total
+
+    def _watch(self, poll_interval):
+        while not self._stop.wait(poll_interval):
+            used = self.usage()
+            self.peak = max(self.peak, used)
+            now = time.time()
+            if not self.paused:
+                if used > self.budget * DISK_HIGH_WATERMARK and now >= self._cooldown_until:
+                    print(f"⏸️  Disk {used / 1024 / 1024:.0f}/{self.budget / 1024 / 1024:.0f} MB → pausing encoders")
+                    self._pause()
+            elif used < self.budget * DISK_LOW_WATERMARK:
+                print(f"▶️  Disk {used / 1024 / 1024:.0f} MB → resuming encoders")
+                self._resume()
+            elif now - self._paused_since > DISK_MAX_PAUSE:
+                print(f"⚠️  Encoders paused > {DISK_MAX_PAUSE}s but disk not freed → resuming anyway")
+                self._resume()
+                self._cooldown_until = now + DISK_MAX_PAUSE
+
+    def _pause(self):
+        with self._lock:
+            self.paused = True
+            self._paused_since = time.time()
+            for process in self._processes:
+                self._signal(process, signal.SIGSTOP)
+
+    def _resume(self):
+        with self._lock:
+            self.paused = False
+            self.paused_seconds += time.time() - self._paused_since
+            for process in self._processes:
+                self._signal(process, signal.SIGCONT)
+
+    @staticmethod
+    def _signal(process, sig):
+        # os.kill thay vì send_signal: send_signal có thể poll() và reap process trước wait4
+        if process.returncode is None:
+            try:
+                os.kill(process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+WORKSPACE = WorkspaceGuard()
+
+class ProgressTracker:
+    """
+    Gom tiến độ các lệnh FFmpeg đang chạy (đọc từ -progress) thành % của cả job
+    và gửi webhook "progress" không quá 1 lần mỗi PROGRESS_INTERVAL giây.
+    Mỗi lệnh đóng góp fraction * weight; tổng weight được khai báo trước bằng add_work().
+    """
+
+    def __init__(self):
+        self.s3_key = None
+        self.job_id = None
+        self.duration = None
+        self._work = 0
+        self._tasks = {}   # label -> (fraction, weight, speed)
+        self._lock = threading.Lock()
+        self._last_sent = 0
+        self._sending = False
+
+    def start(self, s3_key, job_id):
+        self.s3_key = s3_key
+        self.job_id = job_id
+
+    def set_duration(self, duration):
+        self.duration = duration
+
+    def add_work(self, weight):
+        with self._lock:
+            self._work += weight
+
+    def update(self, label, fraction, weight, speed):
+        with self._lock:
+            self._tasks[label] = (min(1.0, max(0.0, fraction)), weight, speed)
+            total = max(self._work, sum(w for _, w, _ in self._tasks.values())) or 1
+            percent = 100 * sum(f * w for f, w, _ in self._tasks.values()) / total
+            speeds = [sp for f, _, sp in self._tasks.values() if sp and f < 1.0]
+            now = time.time()
+            if self._sending or now - self._last_sent < PROGRESS_INTERVAL:
+                return
+            self._last_sent = now
+            self._sending = True
+
+        progress = {
+            'percent': round(percent, 1),
+            'speed': round(min(speeds), 2) if speeds else None,  # encode chậm nhất (x realtime)
+        }
+        print(f"⏳ Progress: {progress['percent']}% (speed: {progress['speed'] or '?'}x)")
+        threading.Thread(target=self._send, args=(progress,), daemon=True).start()
+
+    def _send(self, progress):
+        try:
+            if self.s3_key:
+                notify_webhook(self.s3_key, 'progress', self.job_id, progress=progress, max_retries=1)
+        finally:
+            with self._lock:
+                self._sending = False
+
+PROGRESS = ProgressTracker()
+
+def run_ffmpeg(cmd, label, duration=None, progress_weight=None, time_offset=0):
+    """
+    Chạy 1 lệnh FFmpeg, đọc tiến độ qua -progress.
+    - Báo tiến độ cho PROGRESS (nếu có progress_weight) theo duration (mặc định: thời lượng source)
+    - Dừng sớm nếu out_time không tăng trong STALL_TIMEOUT giây, hoặc quá ENCODE_TIMEOUT
+    Trả về: None nếu thành công, ngược lại là thông báo lỗi
+    """
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    duration = duration or PROGRESS.duration
     try:
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True,
-            timeout=1800  # 30 phút timeout
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
         )
-        
-        if result.returncode != 0:
-            error_msg = result.stderr[-500:] if result.stderr else "Unknown error"
-            print(f"[{profile_name}] Failed: {error_msg}")
-            return (profile_name, False, error_msg)
-        
-        # Kiểm tra output files
-        files = os.listdir(out_dir)
-        if not files or 'playlist.m3u8' not in files:
-            print(f"[{profile_name}] No output files generated")
-            return (profile_name, False, "No output files")
-        
-        print(f"[{profile_name}] Completed! Generated {len(files)} files")
-        return (profile_name, True, None)
-        
-    except subprocess.TimeoutExpired:
-        print(f"[{profile_name}] Timeout after 30 minutes")
-        return (profile_name, False, "Timeout")
     except Exception as e:
-        print(f"[{profile_name}] Exception: {str(e)}")
-        return (profile_name, False, str(e))
+        print(f"[{label}] Exception: {str(e)}")
+        return str(e)
+    WORKSPACE.register(process)
+
+    # Đọc stderr ở thread riêng (tránh đầy pipe), chỉ giữ phần cuối để báo lỗi
+    stderr_tail = deque(maxlen=50)
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_tail.extend(process.stderr), daemon=True
+    )
+    stderr_thread.start()
+
+    started = time.time()
+    state = {"last_advance": started, "deadline": started + ENCODE_TIMEOUT, "out_time": -1, "killed": None}
+    done = threading.Event()
+
+    def watchdog():
+        last_check = started
+        while not done.is_set():
+            now = time.time()
+            if WORKSPACE.paused:
+                # Đang bị dừng vì disk budget: không tính là stall/timeout
+                state["last_advance"] += now - last_check
+                state["deadline"] += now - last_check
+            last_check = now
+            if now > state["deadline"]:
+                state["killed"] = "Timeout"
+            elif now - state["last_advance"] > STALL_TIMEOUT:
+                state["killed"] = f"Stalled (no progress for {STALL_TIMEOUT}s)"
+            if state["killed"]:
+                process.kill()
+                return
+            time.sleep(1)
+
+    threading.Thread(target=watchdog, daemon=True).start()
+
+    block = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        try:
+            out_time = int(block.get("out_time_us") or block.get("out_time_ms") or 0) / 1e6
+        except ValueError:
+            out_time = 0
+        if out_time > state["out_time"]:
+            state["out_time"] = out_time
+            state["last_advance"] = time.time()
+        if progress_weight and duration:
+            # Chunk có -output_ts_offset: out_time có thể đã cộng offset
+            if time_offset and out_time > duration + HLS_TIME:
+                out_time -= time_offset
+            try:
+                speed = float(block.get("speed", "").rstrip("x"))
+            except ValueError:
+                speed = None
+            fraction = 1.0 if value == "end" else out_time / duration
+            PROGRESS.update(label, fraction, progress_weight, speed)
+        block = {}
+
+    # Tự reap bằng wait4 để lấy CPU time + max RSS của riêng process này
+    usage = None
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    except ChildProcessError:  # Đã được reap (poll khi kill)
+        process.wait()
+    WORKSPACE.unregister(process)
+    done.set()
+    stderr_thread.join(timeout=5)
+    if usage:
+        METRICS.record(
+            "ffmpeg", label=label,
+            wall_s=round(time.time() - started, 3),
+            cpu_s=round(usage.ru_utime + usage.ru_stime, 3),
+            max_rss_mb=round(usage.ru_maxrss / 1024, 1),
+            exit_code=process.returncode,
+        )
+
+    if state["killed"]:
+        print(f"[{label}] {state['killed']}, killed")
+        return state["killed"]
+    if process.returncode != 0:
+        error = "".join(stderr_tail)[-500:] or "Unknown error"
+        print(f"[{label}] Failed: {error}")
+        return error
+    return None
+
+def build_single_pass_cmd(source_args, output_dir, renditions, threads,
+                          segment_prefix="playlist", output_args=(), thumbnails=None,
+                          has_audio=True):
+    """
+    Lệnh FFmpeg decode 1 lần → split/scale → encode tất cả profiles,
+    ghi ra output_dir/<profile>/playlist.m3u8 (var_stream_map).
+    threads: tổng số threads cho lệnh này, chia cho từng encoder theo pixel rate.
+    thumbnails: spec source (xem build_thumbnail_graph) → thêm nhánh poster/sprites từ cùng decode.
+    AUDIO_MODE=muxed: mỗi variant có audio riêng (nếu source có audio - has_audio).
+    AUDIO_MODE=shared: audio encode 1 lần thành rendition riêng (nếu có trong renditions),
+    các variant chỉ có video và tham chiếu nhóm audio "aud".
+    """
+    profiles = [r for r in renditions if not is_audio_rendition(r)]
+    shared_audio = next((r for r in renditions if is_audio_rendition(r)), None)
+    muxed_audio = AUDIO_MODE != 'shared' and has_audio
+    n = len(profiles)
+    for r in renditions:
+        os.makedirs(os.path.join(output_dir, r["name"]), exist_ok=True)
+
+    cmd = [
+        "ffmpeg",
+        *source_args,
+        "-filter_complex_threads", str(max(1, threads // 4)),
+    ]
+    thumbnail_outputs = []
+    if profiles:
+        # [0:v] → split → scale cho từng profile (+ 1 nhánh thumbnails)
+        branches = n + 1 if thumbnails else n
+        split_labels = "".join(f"[s{i}]" for i in range(branches))
+        filters = [f"[0:v]split={branches}{split_labels}"]
+        for i, p in enumerate(profiles):
+            filters.append(f"[s{i}]scale={p['width']}:{p['height']}[v{i}]")
+        if thumbnails:
+            thumbnail_filters, thumbnail_outputs = build_thumbnail_graph(f"[s{n}]", output_dir, thumbnails)
+            filters += thumbnail_filters
+        cmd += ["-filter_complex", ";".join(filters)]
+
+    for i in range(n):
+        cmd += ["-map", f"[v{i}]"]
+    if muxed_audio:
+        for i in range(n):
+            cmd += ["-map", "0:a:0"]
+    elif shared_audio:
+        cmd += ["-map", "0:a:0"]
+
+    encoder_threads = allocate_threads(profiles, threads) if profiles else {}
+    for i, p in enumerate(profiles):
+        cmd += build_video_args(p, index=i)
+        cmd += [f"-threads:v:{i}", str(encoder_threads[p["name"]])]
+        if muxed_audio:
+            cmd += build_audio_args(index=i)
+    if shared_audio:
+        cmd += build_audio_args(index=0)
+
+    if profiles:
+        # Keyframe cố định để segment của các profile thẳng hàng nhau
+        cmd += ["-force_key_frames", f"expr:gte(t,n_forced*{HLS_TIME})"]
+
+    if muxed_audio:
+        stream_map = [f"v:{i},a:{i},name:{p['name']}" for i, p in enumerate(profiles)]
+    elif shared_audio:
+        stream_map = [f"v:{i},agroup:aud,name:{p['name']}" for i, p in enumerate(profiles)]
+        stream_map.append(f"a:0,agroup:aud,name:{shared_audio['name']}")
+    else:
+        stream_map = [f"v:{i},name:{p['name']}" for i, p in enumerate(profiles)]
+
+    cmd += list(output_args)
+    cmd += build_hls_args()
+    cmd += [
+        "-hls_segment_filename", os.path.join(output_dir, "%v", hls_segment_filename(segment_prefix)),
+        "-var_stream_map", " ".join(stream_map),
+        os.path.join(output_dir, "%v", "playlist.m3u8"),
+    ]
+    return cmd + thumbnail_outputs
+
+def retry_incomplete_profiles(input_file, output_dir, profiles, results, error, label):
+    """
+    Profile nào chưa có trong results được encode lại riêng lẻ (per-profile)
+    để vẫn có báo cáo lỗi theo từng profile
+    """
+    retry_profiles = [p for p in profiles if p["name"] not in results]
+    if not retry_profiles:
+        return results
+
+    print(f"[{label}] Retrying {len(retry_profiles)} profiles separately...")
+    for p in retry_profiles:
+        shutil.rmtree(os.path.join(output_dir, p["name"]), ignore_errors=True)
+    retry_results = encode_profiles_parallel(input_file, output_dir, retry_profiles)
+    for name, (success, retry_error) in retry_results.items():
+        if not success and error:
+            retry_error = f"{retry_error} ({label}: {error})"
+        results[name] = (success, retry_error)
+    return results
+
+def encode_profiles_single_pass(input_file, output_dir, profiles, thumbnails=None):
+    """
+    Decode source 1 lần, split/scale ra tất cả profiles trong cùng 1 FFmpeg graph
+    và ghi tất cả variant playlists cùng lúc (var_stream_map).
+    Profile nào không ra được playlist hoàn chỉnh sẽ được encode lại riêng lẻ.
+    Trả về: {profile_name: (success, error)}
+    """
+    cmd = build_single_pass_cmd(
+        input_args(input_file), output_dir, profiles, get_cpu_budget(), thumbnails=thumbnails,
+        has_audio=probe_media(input_file).has_audio
+    )
+
+    names = ", ".join(p["name"] for p in profiles)
+    print(f"[single-pass] Starting encode: {names}")
+    PROGRESS.add_work(1)
+    error = run_ffmpeg(cmd, "single-pass", progress_weight=1)
+
+    results = {}
+    for p in profiles:
+        out_dir = os.path.join(output_dir, p["name"])
+        if is_profile_complete(out_dir):
+            print(f"[{p['name']}] Completed! Generated {len(os.listdir(out_dir))} files")
+            results[p["name"]] = (True, None)
+
+    return retry_incomplete_profiles(input_file, output_dir, profiles, results, error, "single-pass")
+
+def probe_keyframes(input_file, read_intervals):
+    """
+    Thời điểm các keyframe của video stream trong read_intervals
+    (chỉ đọc packet, không decode)
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-read_intervals", read_intervals,
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        input_file
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        parts = line.split(",")
+        if len(parts) >= 2 and "K" in parts[1]:
+            try:
+                keyframes.append(float(parts[0]))
+            except ValueError:
+                pass
+    return sorted(keyframes)
+
+def plan_chunks(input_file, duration, chunk_seconds):
+    """
+    Chia [0, duration) thành các đoạn ~chunk_seconds, ranh giới đặt tại keyframe
+    đầu tiên sau mỗi mốc (chỉ đọc packet quanh các mốc bằng -read_intervals, không decode).
+    Trả về: [(start, end), ...]
+    """
+    targets = []
+    t = chunk_seconds
+    while t < duration - chunk_seconds / 2:  # Không tạo chunk cuối quá ngắn
+        targets.append(t)
+        t += chunk_seconds
+    if not targets:
+        return [(0.0, duration)]
+
+    window = max(HLS_TIME * 2, 10)
+    keyframes = probe_keyframes(input_file, ",".join(f"{t}%+{window}" for t in targets))
+
+    boundaries = [0.0]
+    for t in targets:
+        # Không tìm thấy keyframe gần mốc → vẫn cắt tại mốc (input seek + re-encode vẫn chính xác)
+        boundary = next((k for k in keyframes if t <= k < t + window), t)
+        if boundary - boundaries[-1] >= HLS_TIME and duration - boundary >= HLS_TIME:
+            boundaries.append(boundary)
+    boundaries.append(duration)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def encode_chunk(input_file, chunk_dir, index, start, end, profiles, threads):
+    """
+    Encode 1 đoạn [start, end) cho tất cả profiles (single-pass).
+    -output_ts_offset giữ timestamp liên tục với các chunk trước.
+    Trả về: (index, {profile_name: error hoặc None})
+    """
+    source_args = ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", *input_args(input_file)]
+    cmd = build_single_pass_cmd(
+        source_args, chunk_dir, profiles, threads,
+        segment_prefix=f"c{index:04d}_",
+        output_args=["-output_ts_offset", f"{start:.3f}"],
+        has_audio=probe_media(input_file).has_audio
+    )
+    label = f"chunk {index}"
+    progress_args = dict(duration=end - start, progress_weight=end - start, time_offset=start)
+    error = run_ffmpeg(cmd, label, **progress_args)
+    if error:
+        # Thử lại 1 lần (lỗi tạm thời khi đọc S3, ...)
+        for p in profiles:
+            shutil.rmtree(os.path.join(chunk_dir, p["name"]), ignore_errors=True)
+        error = run_ffmpeg(cmd, label, **progress_args)
+
+    status = {}
+    for p in profiles:
+        if is_profile_complete(os.path.join(chunk_dir, p["name"])):
+            status[p["name"]] = None
+        else:
+            status[p["name"]] = error or "Incomplete playlist"
+    return index, status
+
+def write_stitched_playlist(out_dir, entries, target_duration, final):
+    """Ghi variant playlist đã ghép (ghi file tạm rồi rename → không bao giờ đọc phải file dở)"""
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-VERSION:{hls_playlist_version()}",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        *entries,
+    ]
+    if final:
+        lines.append("#EXT-X-ENDLIST")
+    tmp_path = os.path.join(out_dir, "playlist.m3u8.tmp")
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, os.path.join(out_dir, "playlist.m3u8"))
+
+def append_chunk_playlist(chunk_profile_dir, out_dir, entries, first):
+    """
+    Chuyển segments của 1 chunk vào thư mục profile và nối các dòng media của playlist chunk.
+    Giữa các chunk chèn #EXT-X-DISCONTINUITY (AAC priming, encoder reset tại ranh giới chunk).
+    fMP4 có init riêng (init_N.mp4, cùng tên ở mọi chunk) → đổi tên theo chunk để không ghi đè nhau.
+    Trả về: target duration của chunk
+    """
+    with open(os.path.join(chunk_profile_dir, "playlist.m3u8")) as f:
+        lines = f.read().splitlines()
+
+    media = {line for line in lines if line and not line.startswith("#")}
+    chunk_name = os.path.basename(os.path.dirname(chunk_profile_dir.rstrip(os.sep)))
+    renames = {}
+
+    def rename_init(match):
+        uri = match.group(1)
+        if uri in media:
+            return match.group(0)  # single_file: init nằm trong file segment (đã là tên riêng của chunk)
+        renames[uri] = f"{chunk_name}_{uri}"
+        return f'URI="{renames[uri]}"'
+
+    target_duration = HLS_TIME
+    if not first:
+        entries.append("#EXT-X-DISCONTINUITY")
+    for line in lines:
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            target_duration = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MAP"):
+            entries.append(re.sub(r'URI="([^"]+)"', rename_init, line))
+        elif line.startswith(("#EXTINF", "#EXT-X-BYTERANGE")):
+            entries.append(line)
+        elif line and not line.startswith("#"):
+            entries.append(line)
+
+    for name in os.listdir(chunk_profile_dir):
+        if name != "playlist.m3u8":
+            shutil.move(os.path.join(chunk_profile_dir, name), os.path.join(out_dir, renames.get(name, name)))
+    return target_duration
+
+def encode_profiles_chunked(input_file, output_dir, profiles):
+    """
+    Chunked encoding: cắt source tại keyframe thành các đoạn ~CHUNK_SECONDS,
+    encode song song các chunk (mỗi chunk 1 FFmpeg single-pass), rồi ghép lại
+    thành variant playlists liên tục. Playlists được ghép dần theo thứ tự chunk
+    hoàn thành để streaming uploader upload segments sớm.
+    Trả về: {profile_name: (success, error)}
+    """
+    duration = probe_media(input_file).duration
+    chunks = plan_chunks(input_file, duration, CHUNK_SECONDS)
+    chunk_root = os.path.join(os.path.dirname(output_dir), "chunks")
+    PROGRESS.add_work(duration)
+
+    budget = get_cpu_budget()
+    workers = MAX_CHUNK_WORKERS or max(1, budget // 2)
+    workers = min(workers, len(chunks))
+    threads = max(1, budget // workers)
+    print(f"[chunked] {len(chunks)} chunks (~{CHUNK_SECONDS}s), {workers} workers")
+
+    entries = {p["name"]: [] for p in profiles}
+    target_durations = {p["name"]: HLS_TIME for p in profiles}
+    errors = {}
+    finished = {}
+    next_index = 0
+
+    for p in profiles:
+        os.makedirs(os.path.join(output_dir, p["name"]), exist_ok=True)
+
+    # Mỗi chunk là 1 process FFmpeg - thread pool chỉ điều phối các process
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                encode_chunk, input_file, os.path.join(chunk_root, f"chunk_{i:04d}"),
+                i, start, end, profiles, threads
+            )
+            for i, (start, end) in enumerate(chunks)
+        ]
+        for future in as_completed(futures):
+            index, status = future.result()
+            finished[index] = status
+            print(f"[chunked] Chunk {index + 1}/{len(chunks)} done")
+
+            # Ghép các chunk liên tiếp đã xong vào playlist của từng profile
+            while next_index in finished:
+                chunk_dir = os.path.join(chunk_root, f"chunk_{next_index:04d}")
+                for p in profiles:
+                    name = p["name"]
+                    if name in errors:
+                        continue
+                    if finished[next_index][name]:
+                        errors[name] = f"Chunk {next_index}: {finished[next_index][name]}"
+                        continue
+                    out_dir = os.path.join(output_dir, name)
+                    target = append_chunk_playlist(
+                        os.path.join(chunk_dir, name), out_dir, entries[name], next_index == 0
+                    )
+                    target_durations[name] = max(target_durations[name], target)
+                    write_stitched_playlist(
+                        out_dir, entries[name], target_durations[name],
+                        final=next_index == len(chunks) - 1
+                    )
+                shutil.rmtree(chunk_dir, ignore_errors=True)
+                next_index += 1
+
+    shutil.rmtree(chunk_root, ignore_errors=True)
+
+    results = {}
+    for p in profiles:
+        name = p["name"]
+        if name in errors:
+            print(f"[{name}] Failed: {errors[name]}")
+            results[name] = (False, errors[name])
+        else:
+            print(f"[{name}] Completed! Stitched {len(chunks)} chunks")
+            results[name] = (True, None)
+    return results
 
 def create_master_playlist(output_dir, successful_profiles, bucket, hls_base_path):
-    """Tạo master.m3u8 với full S3 URLs"""
+    """
+    Tạo master.m3u8 với full S3 URLs.
+    Có audio rendition dùng chung → EXT-X-MEDIA TYPE=AUDIO, variants tham chiếu AUDIO="aud"
+    Ghi ra file tạm rồi rename (fast publish ghi lại master trong lúc uploader đang đọc)
+    """
     master_path = os.path.join(output_dir, "master.m3u8")
+    tmp_path = master_path + ".tmp"
     
     # S3 base URL
     region = os.environ.get('AWS_REGION', 'ap-southeast-1')
     s3_base_url = f"https://{bucket}.s3.{region}.amazonaws.com/{hls_base_path}"
     
-    with open(master_path, "w") as f:
+    audio = next((p for p in successful_profiles if is_audio_rendition(p)), None)
+
+    with open(tmp_path, "w") as f:
         f.write("#EXTM3U\n")
-        f.write("#EXT-X-VERSION:3\n")
+        f.write(f"#EXT-X-VERSION:{hls_playlist_version()}\n")
+
+        if audio:
+            audio_url = f"{s3_base_url}/{audio['name']}/playlist.m3u8"
+            f.write(
+                '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="default",'
+                f'DEFAULT=YES,AUTOSELECT=YES,URI="{audio_url}"\n'
+            )
         
         for p in successful_profiles:
+            if is_audio_rendition(p):
+                continue
             bandwidth = int(p["bitrate"].replace("k", "000"))
+            codecs = p.get("codecs")
+            if audio:
+                bandwidth += int(audio["bitrate"].replace("k", "000"))
+                codecs = f"{codecs},{audio['codecs']}" if codecs and audio.get("codecs") else None
             resolution = f"{p['width']}x{p['height']}"
             
             # ✅ DÙNG FULL URL
             playlist_url = f"{s3_base_url}/{p['name']}/playlist.m3u8"
             
-            f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={resolution}\n")
+            attributes = f"BANDWIDTH={bandwidth},RESOLUTION={resolution}"
+            if codecs:
+                attributes += f',CODECS="{codecs}"'
+            if audio:
+                attributes += ',AUDIO="aud"'
+            f.write(f"#EXT-X-STREAM-INF:{attributes}\n")
             f.write(f"{playlist_url}\n")  # ← Full URL thay vì relative path
+    os.replace(tmp_path, master_path)
     
     print(f"\n✅ Master playlist created: {master_path}")
     return master_path
 
-def convert_to_hls_parallel(input_file, output_dir, bucket, hls_base_path ):
+AVC_PROFILE_IDC = {
+    "Constrained Baseline": "42e0",
+    "Baseline": "4200",
+    "Main": "4d40",
+    "High": "6400",
+}
+
+def get_codecs_string(out_dir):
+    """
+    Chuỗi CODECS (RFC 6381) cho EXT-X-STREAM-INF, đọc từ output của rendition
+    (vd. avc1.64001f,mp4a.40.2). Không xác định được → None
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=codec_name,profile,level",
+        "-of", "json",
+        os.path.join(out_dir, "playlist.m3u8")
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        streams = json.loads(result.stdout or "{}").get("streams", [])
+    except Exception:
+        return None
+
+    codecs = []
+    for st in streams:
+        if st.get("codec_name") == "h264":
+            profile_idc = AVC_PROFILE_IDC.get(st.get("profile"))
+            level = st.get("level")
+            if not profile_idc or not isinstance(level, int) or level <= 0:
+                return None
+            codecs.append(f"avc1.{profile_idc}{level:02x}")
+        elif st.get("codec_name") == "aac":
+            codecs.append("mp4a.40.5" if st.get("profile") == "HE-AAC" else "mp4a.40.2")
+    return ",".join(codecs) or None
+
+def find_remux_profile(input_file, profiles):
+    """
+    Source đã là H.264 8-bit 4:2:0 đúng kích thước 1 rung, bitrate hợp lý và GOP ngắn
+    → rung đó chỉ cần stream copy (không encode lại).
+    Trả về: (profile với bitrate thực tế, copy_audio) hoặc (None, False)
+    """
+    media = probe_media(input_file)
+    video, audio = media.video, media.audio
+    if not video or video.get("codec_name") != "h264":
+        return None, False
+    # Stream copy sang HLS làm mất rotation metadata
+    if media.rotation:
+        return None, False
+    if video.get("pix_fmt") not in ("yuv420p", "yuvj420p"):
+        return None, False
+    if "10" in (video.get("profile") or "") or "4:4" in (video.get("profile") or ""):
+        return None, False
+
+    profile = next(
+        (p for p in profiles
+         if p["width"] == video.get("width") and p["height"] == video.get("height")),
+        None
+    )
+    if not profile:
+        return None, False
+
+    bitrate = media.video_bitrate
+    max_bitrate = int(profile["bitrate"].replace("k", "")) * 1000 * REMUX_MAX_BITRATE_RATIO
+    if bitrate <= 0 or bitrate > max_bitrate:
+        return None, False
+
+    # GOP: khoảng cách keyframe (trong 60s đầu) không quá 2 segment
+    keyframes = probe_keyframes(input_file, "%+60")
+    if len(keyframes) < 2:
+        return None, False
+    max_gap = max(b - a for a, b in zip(keyframes, keyframes[1:]))
+    if max_gap > HLS_TIME * 2:
+        return None, False
+
+    kbps = (bitrate + 999) // 1000
+    copy_audio = audio is None or audio.get("codec_name") == "aac"
+    return {**profile, "bitrate": f"{kbps}k", "remux": True}, copy_audio
+
+def remux_single_profile(input_file, output_dir, profile, copy_audio):
+    """
+    Tạo rung bằng stream copy, cắt segment tại keyframe sẵn có của source
+    Trả về: (profile_name, success, error_message)
+    """
+    profile_name = profile["name"]
+    out_dir = os.path.join(output_dir, profile_name)
+    os.makedirs(out_dir, exist_ok=True)
+
+    cmd = [
+        "ffmpeg",
+        *input_args(input_file),
+        "-map", "0:v:0",
+        "-c:v", "copy",
+        # Audio shared → audio rendition riêng, rung remux chỉ có video
+        *(["-an"] if AUDIO_MODE == 'shared' else
+          ["-map", "0:a:0?", *(["-c:a", "copy"] if copy_audio else build_audio_args())]),
+        *build_hls_args(),
+        os.path.join(out_dir, "playlist.m3u8")
+    ]
+
+    print(f"[{profile_name}] Starting remux (stream copy)...")
+    error = run_ffmpeg(cmd, profile_name)
+    if error:
+        return (profile_name, False, error)
+    if not is_profile_complete(out_dir):
+        return (profile_name, False, "Incomplete playlist")
+
+    print(f"[{profile_name}] Remux completed! Generated {len(os.listdir(out_dir))} files")
+    return (profile_name, True, None)
+
+def encode_profiles(input_file, output_dir, profiles, include_audio=False, thumbnails=None,
+                    on_complete=None):
+    """
+    Encode các profiles theo ENCODE_MODE.
+    include_audio (AUDIO_MODE=shared): encode thêm audio rendition dùng chung
+    thumbnails: spec source → single_pass tạo luôn poster/sprites trong cùng lệnh
+    on_complete: per_profile báo từng profile xong (mode khác: tất cả xong cùng lúc)
+    Trả về: {profile_name: (success, error)} (audio rendition có tên "audio")
+    """
+    renditions = list(profiles)
+    if include_audio and AUDIO_MODE == 'shared':
+        renditions.append(AUDIO_RENDITION)
+    if not renditions:
+        return {}
+    if ENCODE_MODE == 'per_profile':
+        return encode_profiles_parallel(input_file, output_dir, renditions, on_complete)
+    if ENCODE_MODE == 'chunked':
+        return encode_profiles_chunked(input_file, output_dir, renditions)
+    return encode_profiles_single_pass(input_file, output_dir, renditions, thumbnails)
+
+def convert_to_hls_parallel(input_file, output_dir, bucket, hls_base_path, completed_profiles=(),
+                            on_publish=None):
     """
     Tạo nhiều phiên bản HLS SONG SONG
+    completed_profiles: profiles đã xong từ lần chạy trước (resume) → không encode lại
+    on_publish(renditions): fast publish - encode rung thấp nhất trước, mỗi lần master.m3u8
+    được ghi lại với các rung đã xong thì gọi on_publish để upload ngay
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    width, height = get_video_resolution(input_file)
-    print(f"Video gốc: {width}x{height}")
+    media = probe_media(input_file).validate()
+    print(f"Video gốc: {media.summary()}")
+    PROGRESS.set_duration(media.duration)
+    width, height = media.display_size
+    thumbnails = {"width": width, "height": height, "duration": media.duration} if THUMBNAILS else None
     
-    valid_profiles = get_valid_profiles(height)
+    ladder = get_ladder(media)
+    if not ladder:
+        raise Exception(f"Độ phân giải {width}x{height} thấp hơn profile nhỏ nhất")
+    valid_profiles = list(ladder)
     print(f"Sẽ tạo {len(valid_profiles)} profiles:")
     for p in valid_profiles:
         print(f"   - {p['name']} ({p['width']}x{p['height']} @ {p['bitrate']})")
 
-    print(f"\nEncoding {len(valid_profiles)} profiles in parallel...")
+    # Resume: giữ nguyên profiles đã xong (kể cả bitrate thực tế của rung remux)
+    completed = {p["name"]: p for p in completed_profiles}
+    if completed:
+        print(f"Đã xong từ lần chạy trước: {', '.join(completed)}")
+    all_profiles = [completed.get(p["name"], p) for p in valid_profiles]
+    valid_profiles = [p for p in valid_profiles if p["name"] not in completed]
+    need_audio = (AUDIO_MODE == 'shared' and media.has_audio
+                  and AUDIO_RENDITION["name"] not in completed)
+    if not media.has_audio:
+        print("🔇 Source không có audio → variants chỉ có video")
 
-    encode_args = [(input_file, output_dir, p) for p in valid_profiles]
- 
-    max_workers = min(len(valid_profiles), 4)
-    
-    results = {}
-    
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_profile = {
-            executor.submit(encode_single_profile, args): args[2]['name']
-            for args in encode_args
-        }
-        
-        for future in as_completed(future_to_profile):
-            profile_name, success, error = future.result()
-            results[profile_name] = (success, error)
+    published = [completed[p["name"]] for p in ladder if p["name"] in completed]
+
+    def publish(profile_name=None, success=True):
+        """Thêm rung vừa xong vào master.m3u8 (ghi atomic) và gọi on_publish"""
+        if profile_name:
+            profile = next((p for p in valid_profiles if p["name"] == profile_name), None)
+            if not success or not profile or is_audio_rendition(profile):
+                return
+            out_dir = os.path.join(output_dir, profile_name)
+            published.append({**profile, "codecs": get_codecs_string(out_dir)})
+            published.sort(key=lambda p: p["width"] * p["height"])
+        audio = completed.get(AUDIO_RENDITION["name"])
+        create_master_playlist(output_dir, published + ([audio] if audio else []), bucket, hls_base_path)
+        on_publish(published + ([audio] if audio else []))
+
+    # Fast publish: rung thấp nhất (+ audio) encode trước với toàn bộ CPU → publish ngay,
+    # sau đó xử lý như resume (rung này coi như đã xong)
+    if on_publish and len(valid_profiles) > 1 and not published:
+        first = valid_profiles[0]
+        print(f"\n🚀 Fast publish: encoding {first['name']} first...")
+        first_results = encode_profiles(input_file, output_dir, [first], include_audio=need_audio)
+        if first_results.get(first["name"], (False, None))[0]:
+            completed[first["name"]] = {
+                **first, "codecs": get_codecs_string(os.path.join(output_dir, first["name"]))
+            }
+            if need_audio and first_results.get(AUDIO_RENDITION["name"], (False, None))[0]:
+                audio_dir = os.path.join(output_dir, AUDIO_RENDITION["name"])
+                completed[AUDIO_RENDITION["name"]] = {**AUDIO_RENDITION, "codecs": get_codecs_string(audio_dir)}
+            elif need_audio:
+                print("⚠️  Audio rendition failed, variants without audio")
+            need_audio = False
+            all_profiles = [completed.get(p["name"], p) for p in all_profiles]
+            valid_profiles = valid_profiles[1:]
+            published.append(completed[first["name"]])
+            publish()
+        else:
+            print(f"[{first['name']}] Fast publish encode failed → encoding all profiles together")
+            shutil.rmtree(os.path.join(output_dir, first["name"]), ignore_errors=True)
+    on_complete = publish if on_publish and published else None
+
+    remux_profile, copy_audio = (None, False)
+    if REMUX_FAST_PATH and valid_profiles:
+        remux_profile, copy_audio = find_remux_profile(input_file, valid_profiles)
+
+    if not remux_profile:
+        print(f"\nEncoding {len(valid_profiles)} profiles ({ENCODE_MODE})...")
+        results = encode_profiles(input_file, output_dir, valid_profiles,
+                                  include_audio=need_audio, thumbnails=thumbnails,
+                                  on_complete=on_complete)
+    else:
+        # Rung trùng với source: stream copy chạy song song với encode các rung thấp hơn
+        valid_profiles = [remux_profile if p["name"] == remux_profile["name"] else p
+                          for p in valid_profiles]
+        encode_list = [p for p in valid_profiles if p["name"] != remux_profile["name"]]
+        print(f"\n⚡ {remux_profile['name']}: source compatible → stream copy")
+        print(f"Encoding {len(encode_list)} profiles ({ENCODE_MODE})...")
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            remux_future = executor.submit(
+                remux_single_profile, input_file, output_dir, remux_profile, copy_audio
+            )
+            results = encode_profiles(input_file, output_dir, encode_list,
+                                      include_audio=need_audio, thumbnails=thumbnails,
+                                      on_complete=on_complete)
+            profile_name, success, error = remux_future.result()
+
+        if success:
+            results[profile_name] = (True, None)
+        else:
+            # Remux lỗi → encode lại rung này như bình thường
+            print(f"[{profile_name}] Remux failed, falling back to encode")
+            fallback = next(p for p in ladder if p["name"] == profile_name)
+            valid_profiles = [fallback if p["name"] == profile_name else p for p in valid_profiles]
+            shutil.rmtree(os.path.join(output_dir, profile_name), ignore_errors=True)
+            results.update(encode_profiles(input_file, output_dir, [fallback]))
     
-    successful_profiles = [p for p in valid_profiles if results.get(p['name'], (False, None))[0]]
-    failed_profiles = [p for p in valid_profiles if not results.get(p['name'], (False, None))[0]]
+    # Audio rendition dùng chung: lỗi (vd. video không có tiếng) → variants không có audio
+    audio_rendition = completed.get(AUDIO_RENDITION["name"])
+    if need_audio:
+        audio_ok, audio_error = results.pop(AUDIO_RENDITION["name"], (False, "Not encoded"))
+        if audio_ok:
+            audio_dir = os.path.join(output_dir, AUDIO_RENDITION["name"])
+            audio_rendition = {**AUDIO_RENDITION, "codecs": get_codecs_string(audio_dir)}
+        else:
+            print(f"⚠️  Audio rendition failed, variants without audio: {audio_error}")
+
+    for name in completed:
+        results[name] = (True, None)
+    # Thứ tự theo ladder, profile mới encode (vd. remux) thay thế bản gốc
+    encoded = {p["name"]: p for p in valid_profiles}
+    all_profiles = [encoded.get(p["name"], p) for p in all_profiles]
+
+    successful_profiles = [p for p in all_profiles if results.get(p['name'], (False, None))[0]]
+    failed_profiles = [p for p in all_profiles if not results.get(p['name'], (False, None))[0]]
     
     print(f"\n📊 Encoding results:")
     print(f"   ✅ Successful: {len(successful_profiles)}")
@@ -207,7 +1674,24 @@ def convert_to_hls_parallel(input_file, output_dir, bucket, hls_base_path ):
     
     if not successful_profiles:
         raise Exception("All profiles failed to encode!")
+
+    # Thumbnails không có sẵn từ lần encode (mode khác single_pass, resume, ...) → pass riêng
+    if thumbnails:
+        if not os.path.exists(os.path.join(output_dir, THUMBNAIL_DIR, "poster.jpg")):
+            shutil.rmtree(os.path.join(output_dir, THUMBNAIL_DIR), ignore_errors=True)
+            error = generate_thumbnails(input_file, output_dir, thumbnails)
+            if error:
+                print(f"⚠️  Thumbnails failed: {error}")
+        if write_thumbnail_track(output_dir, thumbnails):
+            print(f"🖼️  Thumbnails: poster + {THUMB_INTERVAL}s sprite track")
+
+    for p in successful_profiles:
+        if "codecs" not in p:
+            p["codecs"] = get_codecs_string(os.path.join(output_dir, p["name"]))
     
+    if audio_rendition:
+        successful_profiles.append(audio_rendition)
+
     master_path = create_master_playlist(
         output_dir, 
         successful_profiles,
@@ -216,14 +1700,114 @@ def convert_to_hls_parallel(input_file, output_dir, bucket, hls_base_path ):
     )
     
     print(f"\n✅ Master playlist created: {master_path}")
-    print(f"🎉 Adaptive HLS completed! ({len(successful_profiles)} profiles)")
+    print(f"🎉 Adaptive HLS completed! ({len(successful_profiles)} renditions)")
     
     return successful_profiles
 
-def upload_hls_parallel(output_dir, bucket, hls_base_path):
-    """Upload tất cả HLS files song song"""
-    from concurrent.futures import ThreadPoolExecutor
-    
+class JobManifest:
+    """
+    Manifest của job trên S3 ({CACHE_PREFIX}/jobs/{hls_base_path}.json) để chạy lại
+    (Fargate task chết, timeout) chỉ làm phần còn thiếu:
+      - job_key: hash nội dung source + tham số encode (khác → bỏ manifest cũ)
+      - profiles: profile đã encode và upload xong (kèm thông tin để tạo master)
+      - objects: file đã upload {relative_path: {"md5", "size"}}
+    """
+
+    SAVE_INTERVAL = 10  # giây giữa 2 lần ghi manifest khi đang upload
+
+    def __init__(self, bucket, hls_base_path, job_key):
+        self.bucket = bucket
+        self.key = f"{CACHE_PREFIX}/jobs/{hls_base_path}.json"
+        self.data = {"job_key": job_key, "profiles": {}, "objects": {}}
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @classmethod
+    def load(cls, bucket, hls_base_path, job_key):
+        manifest = cls(bucket, hls_base_path, job_key)
+        try:
+            data = json.loads(s3.get_object(Bucket=bucket, Key=manifest.key)['Body'].read())
+        except Exception:
+            return manifest
+        if data.get("job_key") == job_key:
+            manifest.data = data
+            print(f"♻️  Resuming job: {len(data['profiles'])} profiles done, "
+                  f"{len(data['objects'])} files uploaded")
+        return manifest
+
+    def completed_profiles(self):
+        return list(self.data["profiles"].values())
+
+    def is_uploaded(self, relative_path, md5, size):
+        entry = self.data["objects"].get(relative_path)
+        return entry is not None and entry["md5"] == md5 and entry["size"] == size
+
+    def mark_uploaded(self, relative_path, md5, size):
+        with self._lock:
+            self.data["objects"][relative_path] = {"md5": md5, "size": size}
+            due = time.time() - self._last_save >= self.SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def mark_profiles_complete(self, profiles, failed_paths):
+        """Profile hoàn thành khi mọi file của nó (kể cả playlist) upload thành công"""
+        with self._lock:
+            for p in profiles:
+                prefix = p["name"] + os.sep
+                if not any(path.startswith(prefix) for path in failed_paths):
+                    self.data["profiles"][p["name"]] = p
+        self.save()
+
+    def save(self):
+        with self._lock:
+            body = json.dumps(self.data).encode('utf-8')
+            self._last_save = time.time()
+        try:
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=body, ContentType='application/json')
+        except Exception as e:
+            print(f"Warning: failed to save job manifest: {str(e)}")
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Content-Type cho file không phải HLS (trình duyệt đọc trực tiếp từ S3)
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".vtt": "text/vtt",
+}
+
+def upload_hls_file(output_dir, bucket, hls_base_path, relative_path, manifest=None):
+    """
+    Upload 1 file HLS. Có manifest: bỏ qua file đã upload với cùng nội dung (md5 + size)
+    Trả về: (success, relative_path)
+    """
+    local_path = os.path.join(output_dir, relative_path)
+    s3_key = f"{hls_base_path}/{relative_path}"
+    try:
+        if manifest:
+            md5, size = file_md5(local_path), os.path.getsize(local_path)
+            if manifest.is_uploaded(relative_path, md5, size):
+                return (True, relative_path)
+        content_type = CONTENT_TYPES.get(os.path.splitext(local_path)[1])
+        s3.upload_file(local_path, bucket, s3_key, Config=transfer_config,
+                       ExtraArgs={'ContentType': content_type} if content_type else None)
+        METRICS.count("bytes_uploaded", os.path.getsize(local_path))
+        if manifest:
+            manifest.mark_uploaded(relative_path, md5, size)
+        return (True, relative_path)
+    except Exception as e:
+        print(f"Upload failed: {s3_key} - {str(e)}")
+        return (False, relative_path)
+
+def upload_hls_parallel(output_dir, bucket, hls_base_path, manifest=None, profiles=None):
+    """
+    Upload tất cả HLS files song song
+    Trả về: (số file upload thành công, list file upload lỗi)
+    """
     print(f"\n📤 Uploading HLS files to s3://{bucket}/{hls_base_path}/")
     
     files_to_upload = []
@@ -233,35 +1817,219 @@ def upload_hls_parallel(output_dir, bucket, hls_base_path):
         for file in files:
             local_path = os.path.join(root, file)
             relative_path = os.path.relpath(local_path, output_dir)
-            s3_key = f"{hls_base_path}/{relative_path}"
-            files_to_upload.append((local_path, s3_key))
+            files_to_upload.append(relative_path)
     
     print(f"   Found {len(files_to_upload)} files to upload")
     
-    def upload_one(local_file, s3_key):
-        try:
-            s3.upload_file(local_file, bucket, s3_key, Config=transfer_config)
-            return (True, s3_key)
-        except Exception as e:
-            print(f"Upload failed: {s3_key} - {str(e)}")
-            return (False, s3_key)
-    
     uploaded_count = 0
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(upload_one, local, s3key) 
-                   for local, s3key in files_to_upload]
+    failed_paths = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_hls_file, output_dir, bucket, hls_base_path, path, manifest)
+                   for path in files_to_upload]
         
         for future in as_completed(futures):
-            success, s3_key = future.result()
+            success, relative_path = future.result()
             if success:
                 uploaded_count += 1
                 if uploaded_count % 10 == 0:
                     print(f"   Uploaded {uploaded_count}/{len(files_to_upload)} files...")
+            else:
+                failed_paths.append(relative_path)
     
+    if manifest and profiles:
+        manifest.mark_profiles_complete(profiles, failed_paths)
+
     print(f"✅ Uploaded {uploaded_count}/{len(files_to_upload)} files")
-    return uploaded_count
+    return uploaded_count, failed_paths
     
-def notify_webhook(s3_key, status, job_id, hls_path=None, error=None, max_retries=3):
+class StreamingUploader:
+    """
+    Upload HLS song song với encode: theo dõi thư mục output của từng profile và
+    upload mỗi segment ngay khi FFmpeg đóng file (segment đã xuất hiện trong playlist).
+    Variant playlists và master.m3u8 được upload sau cùng để player không bao giờ
+    đọc phải playlist đang ghi dở.
+    """
+
+    def __init__(self, output_dir, bucket, hls_base_path, manifest=None,
+                 poll_interval=2, max_workers=None, delete_uploaded=False):
+        self.output_dir = output_dir
+        self.bucket = bucket
+        self.hls_base_path = hls_base_path
+        self.manifest = manifest
+        self.poll_interval = poll_interval
+        # Xoá segment local sau khi upload xong (disk budget). Giữ segment đầu của mỗi
+        # rendition: get_codecs_string cần ffprobe playlist sau khi encode
+        self.delete_uploaded = delete_uploaded
+        self._keep = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or UPLOAD_WORKERS)
+        self._submitted = {}   # relative path -> mtime_ns đã upload
+        self._futures = []
+        self._failed = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def start(self):
+        print(f"\n📤 Streaming upload to s3://{self.bucket}/{self.hls_base_path}/")
+        self._thread.start()
+        return self
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._scan()
+            except Exception as e:
+                print(f"Upload watcher error: {str(e)}")
+
+    def _closed_segments(self, profile_dir):
+        """
+        Segments đã được liệt kê trong playlist → FFmpeg đã ghi xong.
+        fMP4: init segment (#EXT-X-MAP) đứng trước, FFmpeg ghi xong init trước segment đầu.
+        Playlist byte-range (fMP4 single file): file chỉ đóng khi playlist đã
+        chuyển sang file khác hoặc đã có #EXT-X-ENDLIST (init nằm trong cùng file)
+        """
+        try:
+            with open(os.path.join(profile_dir, "playlist.m3u8")) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        segments = []
+        for line in lines:
+            line = line.strip()
+            if line.startswith("#EXT-X-MAP:"):
+                match = re.search(r'URI="([^"]+)"', line)
+                line = match.group(1) if match else ""
+            if line and not line.startswith("#") and line not in segments:
+                segments.append(line)
+        if any("BYTERANGE" in line for line in lines) and "#EXT-X-ENDLIST" not in lines:
+            return segments[:-1]
+        return segments
+
+    def _keep_first(self, name, segments):
+        """Giữ init + segment media đầu tiên: get_codecs_string ffprobe playlist sau khi encode"""
+        for segment in segments:
+            self._keep.add(os.path.join(name, segment))
+            if not segment.endswith(".mp4"):  # init fMP4 (init_N.mp4 / chunk_XXXX_init_N.mp4)
+                break
+
+    def _scan(self):
+        if not os.path.isdir(self.output_dir):
+            return
+        for name in sorted(os.listdir(self.output_dir)):
+            profile_dir = os.path.join(self.output_dir, name)
+            if not os.path.isdir(profile_dir):
+                continue
+            segments = self._closed_segments(profile_dir)
+            self._keep_first(name, segments)
+            for segment in segments:
+                if os.path.exists(os.path.join(profile_dir, segment)):
+                    self._submit(os.path.join(name, segment))
+
+    def _submit(self, relative_path):
+        local_path = os.path.join(self.output_dir, relative_path)
+        try:
+            mtime = os.stat(local_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            # Profile bị encode lại (fallback) → file mới, upload lại
+            if self._submitted.get(relative_path) == mtime:
+                return
+            self._submitted[relative_path] = mtime
+            self._futures.append(self._executor.submit(self._upload_one, relative_path))
+
+    def _upload_one(self, relative_path):
+        success, relative_path = upload_hls_file(
+            self.output_dir, self.bucket, self.hls_base_path, relative_path, self.manifest
+        )
+        if success and self.delete_uploaded and not relative_path.endswith(".m3u8") \
+                and relative_path not in self._keep:
+            try:
+                os.remove(os.path.join(self.output_dir, relative_path))
+            except OSError:
+                pass
+        return success, relative_path
+
+    def _wait(self):
+        with self._lock:
+            futures, self._futures = self._futures, []
+        results = [f.result() for f in futures]
+        self._failed += [path for success, path in results if not success]
+        return sum(1 for success, _ in results if success), len(results)
+
+    def publish(self, renditions):
+        """
+        Fast publish: upload ngay các rendition đã encode xong (segments → playlist),
+        sau đó master.m3u8 hiện tại. PUT S3 là atomic nên player luôn đọc được master đầy đủ.
+        Trả về: True nếu tất cả upload thành công
+        """
+        playlists = []
+        for r in renditions:
+            # Gồm cả init segment (fMP4) → có trên S3 trước khi playlist được publish
+            segments = self._closed_segments(os.path.join(self.output_dir, r["name"]))
+            self._keep_first(r["name"], segments)
+            for segment in segments:
+                self._submit(os.path.join(r["name"], segment))
+            playlists.append(os.path.join(r["name"], "playlist.m3u8"))
+        failed = len(self._failed)
+        self._wait()
+        for relative_path in playlists:
+            self._submit(relative_path)
+        self._wait()
+        if len(self._failed) > failed:
+            return False
+        self._submit("master.m3u8")
+        self._wait()
+        return len(self._failed) == failed
+
+    def finish(self, profiles=None):
+        """
+        Gọi sau khi encode xong: upload nốt segments còn lại,
+        sau đó variant playlists, cuối cùng master.m3u8
+        Trả về: (số file upload thành công, list file upload lỗi - kể cả lỗi trong lúc encode)
+        """
+        self._stop.set()
+        self._thread.join()
+
+        playlists = []
+        for root, dirs, files in os.walk(self.output_dir):
+            for file in files:
+                relative_path = os.path.relpath(os.path.join(root, file), self.output_dir)
+                if file.endswith(".m3u8"):
+                    playlists.append(relative_path)
+                else:
+                    self._submit(relative_path)
+
+        uploaded, total = self._wait()
+
+        for relative_path in playlists:
+            if relative_path != "master.m3u8":
+                self._submit(relative_path)
+        done, count = self._wait()
+        uploaded, total = uploaded + done, total + count
+
+        if self.manifest and profiles:
+            self.manifest.mark_profiles_complete(profiles, self._failed)
+
+        if "master.m3u8" in playlists:
+            self._submit("master.m3u8")
+            done, count = self._wait()
+            uploaded, total = uploaded + done, total + count
+
+        self._executor.shutdown()
+        print(f"✅ Uploaded {uploaded}/{total} files (streaming)")
+        return uploaded, list(dict.fromkeys(self._failed))
+
+    def abort(self):
+        """Dừng watcher và huỷ các upload chưa chạy (khi job lỗi)"""
+        self._stop.set()
+        with self._lock:
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown(wait=False)
+
+def notify_webhook(s3_key, status, job_id, hls_path=None, error=None, progress=None,
+                   thumbnails=None, max_retries=3):
     WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
     """Gọi webhook với retry logic"""
     if not WEBHOOK_URL:
@@ -274,6 +2042,11 @@ def notify_webhook(s3_key, status, job_id, hls_path=None, error=None, max_retrie
         'jobId': job_id,
         'error': error
     }
+    if progress is not None:
+        payload['progress'] = progress
+    if thumbnails:
+        payload['posterURL'] = thumbnails.get('poster')
+        payload['thumbnailTrackURL'] = thumbnails.get('track')
     
     for attempt in range(max_retries):
         try:
@@ -305,25 +2078,121 @@ def notify_webhook(s3_key, status, job_id, hls_path=None, error=None, max_retrie
     print(f"Failed to call webhook after {max_retries} attempts")
     return False
 
-def main():
-    print("=" * 60)
-    print("HLS Converter Started")
-    print("=" * 60)
-    
-    # Lấy thông tin từ environment variables
-    s3_key = os.environ.get('S3_KEY')
-    bucket = os.environ.get('BUCKET')
-    output_prefix = os.environ.get('OUTPUT_PREFIX', 'hls-output')
-    job_id = os.environ.get('JOB_ID')
-    
-    print()
+def get_content_id(bucket, key):
+    """
+    Định danh nội dung source.
+    metadata: SHA-256 checksum của S3 nếu có, ngược lại ETag + kích thước (không đọc object)
+    full: đọc toàn bộ object và tính SHA-256
+    """
+    if CACHE_HASH == 'full':
+        digest = hashlib.sha256()
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        for chunk in iter(lambda: body.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+
+    head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    checksum = head.get('ChecksumSHA256')
+    if checksum:
+        return f"sha256:{checksum}"
+    etag = head['ETag'].strip('"')
+    return f"etag:{etag}:{head['ContentLength']}"
+
+def get_cache_key(bucket, key):
+    """Hash của nội dung source + tham số encode (đổi tham số → cache key mới)"""
+    params = {
+        "content": get_content_id(bucket, key),
+        "profiles": get_valid_profiles(sys.maxsize),
+        "hls_time": HLS_TIME,
+        "hls_format": HLS_FORMAT,
+        "audio_mode": AUDIO_MODE,
+        "preset": X264_PRESET,
+        "crf": X264_CRF,
+        "remux": REMUX_FAST_PATH,
+        "thumbnails": THUMB_INTERVAL if THUMBNAILS else None,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def cache_index_key(cache_key):
+    return f"{CACHE_PREFIX}/hls/{cache_key}.json"
+
+def restore_from_cache(cache_key, bucket, hls_base_path, output_dir):
+    """
+    Cache hit → copy output HLS cũ sang hls_base_path (S3 → S3) và tạo lại master.m3u8
+    (master chứa full URL nên không copy được).
+    Trả về: (profiles, thumbnails), hoặc (None, None) nếu không có cache dùng được
+    """
+    try:
+        entry = json.loads(s3.get_object(Bucket=bucket, Key=cache_index_key(cache_key))['Body'].read())
+        cached_path = entry["hls_base_path"]
+        s3.head_object(Bucket=bucket, Key=f"{cached_path}/master.m3u8")
+    except Exception:
+        return None, None
+
+    print(f"♻️  Cache hit: s3://{bucket}/{cached_path}")
+    profiles = entry["profiles"]
+    thumbnails = entry.get("thumbnails")
+    if cached_path == hls_base_path:
+        return profiles, thumbnails
+
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{cached_path}/"):
+        for obj in page.get('Contents', []):
+            relative_path = obj['Key'][len(cached_path) + 1:]
+            if relative_path != "master.m3u8":
+                keys.append(relative_path)
+
+    def copy_one(relative_path):
+        s3.copy(
+            {'Bucket': bucket, 'Key': f"{cached_path}/{relative_path}"},
+            bucket,
+            f"{hls_base_path}/{relative_path}",
+            Config=transfer_config
+        )
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(copy_one, keys))
+    print(f"✅ Copied {len(keys)} files from cache")
+
+    os.makedirs(output_dir, exist_ok=True)
+    master_path = create_master_playlist(output_dir, profiles, bucket, hls_base_path)
+    upload_to_s3(master_path, bucket, f"{hls_base_path}/master.m3u8")
+    return profiles, thumbnails
+
+def save_cache_entry(cache_key, bucket, hls_base_path, profiles, thumbnails=None):
+    """Ghi index cache (lỗi cache không làm hỏng job)"""
+    entry = {
+        "hls_base_path": hls_base_path,
+        "profiles": profiles,
+        "thumbnails": thumbnails,
+        "created_at": int(time.time()),
+    }
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=cache_index_key(cache_key),
+            Body=json.dumps(entry).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Warning: failed to write cache entry: {str(e)}")
+
+def process_job(s3_key, bucket, output_prefix='hls-output', job_id=None):
+    """Convert 1 video. Trả về True nếu thành công (lỗi đã được báo qua webhook)"""
     # Validate
     if not s3_key or not bucket:
-        print("ERROR: S3_KEY and BUCKET environment variables are required")
-        sys.exit(1)
+        print("ERROR: S3_KEY and BUCKET are required")
+        return False
     
     print(f"📋 Input: s3://{bucket}/{s3_key}")
     print(f"📋 Output prefix: {output_prefix}")
+    PROGRESS.start(s3_key, job_id)
+    METRICS.set(
+        JobId=job_id, S3Key=s3_key,
+        EncodeMode=ENCODE_MODE, HlsFormat=HLS_FORMAT, AudioMode=AUDIO_MODE,
+        UploadMode=UPLOAD_MODE, CpuBudget=get_cpu_budget(),
+    )
     
     # Tạo working directory
     work_dir = '/tmp/video_processing'
@@ -333,21 +2202,108 @@ def main():
     _, ext = os.path.splitext(s3_key)
     input_file = f'{work_dir}/input_video{ext}'
     output_dir = f'{work_dir}/hls_output'
+    uploader = None
+    video_name = Path(s3_key).stem
+    original_dir = os.path.dirname(s3_key)
+    hls_base_path = f'{original_dir}/{output_prefix}/{video_name}'
+    master_url = f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{hls_base_path}/master.m3u8"
+    publisher = None
     
     try:
-        print(f"\n📥 Downloading s3://{bucket}/{s3_key}")
-        s3.download_file(bucket, s3_key, input_file, Config=transfer_config)
-        file_size = os.path.getsize(input_file) / (1024 * 1024)
-        print(f"✅ Downloaded: {file_size:.2f} MB")
-        
-        video_name = Path(s3_key).stem
-        original_dir = os.path.dirname(s3_key)
-        hls_base_path = f'{original_dir}/{output_prefix}/{video_name}'
-        # Convert (parallel)
-        successful_profiles = convert_to_hls_parallel(input_file, output_dir, bucket, hls_base_path)
-        
-        # Upload (parallel)
-        uploaded_count = upload_hls_parallel(output_dir, bucket, hls_base_path)
+        cache_key = None
+        successful_profiles = None
+        thumbnails = None
+        uploaded_count = 0
+        if DEDUP_CACHE or RESUMABLE_JOBS:
+            try:
+                cache_key = get_cache_key(bucket, s3_key)
+            except Exception as e:
+                print(f"Warning: cannot compute cache key: {str(e)}")
+        if DEDUP_CACHE and cache_key:
+            try:
+                with METRICS.stage("cache_restore"):
+                    successful_profiles, thumbnails = restore_from_cache(
+                        cache_key, bucket, hls_base_path, output_dir
+                    )
+                METRICS.set(CacheHit=bool(successful_profiles))
+            except Exception as e:
+                print(f"Warning: cache lookup failed: {str(e)}")
+
+        if not successful_profiles:
+            manifest = None
+            completed_profiles = []
+            if RESUMABLE_JOBS and cache_key:
+                manifest = JobManifest.load(bucket, hls_base_path, cache_key)
+                completed_profiles = manifest.completed_profiles()
+
+            input_file, is_local = resolve_input(bucket, s3_key, input_file)
+            # ffprobe 1 lần cho cả job; input không xử lý được → báo lỗi ngay, không encode
+            with METRICS.stage("probe"):
+                media = probe_media(input_file).validate()
+            METRICS.set(Duration=media.duration, SourceResolution="x".join(map(str, media.display_size)))
+
+            if UPLOAD_MODE == 'streaming':
+                uploader = StreamingUploader(
+                    output_dir, bucket, hls_base_path, manifest,
+                    delete_uploaded=bool(DISK_BUDGET_MB)
+                ).start()
+                if DISK_BUDGET_MB:
+                    WORKSPACE.start(work_dir, DISK_BUDGET_MB)
+            elif DISK_BUDGET_MB:
+                print("Warning: DISK_BUDGET_MB cần UPLOAD_MODE=streaming → bỏ qua")
+
+            # Fast publish: upload rung đã xong + webhook "playable" chạy nền (1 thread, giữ thứ tự)
+            # để encode các rung cao hơn bắt đầu ngay
+            on_publish = None
+            if FAST_PUBLISH and uploader:
+                publisher = ThreadPoolExecutor(max_workers=1)
+                playable_sent = []
+
+                def publish(renditions):
+                    if not uploader.publish(renditions):
+                        print("Warning: fast publish upload failed")
+                        return
+                    print(f"🚀 Published: {', '.join(r['name'] for r in renditions)}")
+                    if not playable_sent:
+                        playable_sent.append(True)
+                        METRICS.set(PlayableSeconds=round(time.time() - METRICS.started, 1))
+                        notify_webhook(s3_key=s3_key, status='playable', job_id=job_id, hls_path=master_url)
+
+                on_publish = lambda renditions: publisher.submit(publish, list(renditions))
+            elif FAST_PUBLISH:
+                print("Warning: FAST_PUBLISH cần UPLOAD_MODE=streaming → bỏ qua")
+
+            # Convert (parallel)
+            with METRICS.stage("convert"):
+                successful_profiles = convert_to_hls_parallel(
+                    input_file, output_dir, bucket, hls_base_path, completed_profiles, on_publish
+                )
+            if publisher:
+                publisher.shutdown(wait=True)
+            thumbnails = get_thumbnails(output_dir)
+
+            # Encode xong → source local không còn cần nữa
+            if is_local and os.path.exists(input_file):
+                os.remove(input_file)
+                print("🗑️  Released local source")
+            
+            # Upload (parallel) - streaming: chỉ còn phần chưa upload trong lúc encode
+            with METRICS.stage("upload") as stage:
+                if uploader:
+                    uploaded_count, failed_paths = uploader.finish(successful_profiles)
+                else:
+                    uploaded_count, failed_paths = upload_hls_parallel(
+                        output_dir, bucket, hls_base_path, manifest, successful_profiles
+                    )
+                stage["files"] = uploaded_count
+            # Thiếu file trên S3 → không cache, báo lỗi; manifest giữ phần đã upload để retry tiếp
+            if failed_paths:
+                raise Exception(
+                    f"Upload failed for {len(failed_paths)} file(s): {', '.join(failed_paths[:5])}"
+                )
+
+            if cache_key:
+                save_cache_entry(cache_key, bucket, hls_base_path, successful_profiles, thumbnails)
         
         print("\n" + "=" * 70)
         print(f"✅ SUCCESS!")
@@ -356,33 +2312,185 @@ def main():
         print(f"   Master playlist: s3://{bucket}/{hls_base_path}/master.m3u8")
         print("=" * 70)
 
-
-        notify_webhook(
-            s3_key=s3_key,
-            status='success',
-            job_id=job_id,
-            hls_path=f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{hls_base_path}/master.m3u8"
-        )
+        METRICS.set(Status='success', Profiles=[p["name"] for p in successful_profiles])
+        with METRICS.stage("webhook"):
+            notify_webhook(
+                s3_key=s3_key,
+                status='success',
+                job_id=job_id,
+                hls_path=master_url,
+                thumbnails={
+                    key: f"https://{bucket}.s3.ap-southeast-1.amazonaws.com/{hls_base_path}/{path}"
+                    for key, path in (thumbnails or {}).items()
+                }
+            )
         
     except Exception as e:
+        if publisher:
+            publisher.shutdown(wait=True)
+        if uploader:
+            uploader.abort()
         print("=" * 60)
         print(f"ERROR: {str(e)}")
         print("=" * 60)
-        notify_webhook(
-            s3_key=s3_key,
-            status='failed',
-            job_id=job_id,
-            error=str(e)
-        )
-        sys.exit(1)
+        METRICS.set(Status='failed', Error=str(e))
+        with METRICS.stage("webhook"):
+            notify_webhook(
+                s3_key=s3_key,
+                status='failed',
+                job_id=job_id,
+                error=str(e)
+            )
+        return False
     
     finally:
         # Cleanup
+        WORKSPACE.stop()
+        if WORKSPACE.budget:
+            METRICS.set(PeakDiskMB=round(WORKSPACE.peak / 1024 / 1024, 1),
+                        DiskPausedSeconds=round(WORKSPACE.paused_seconds, 1))
         print("Cleaning up temporary files...")
         if os.path.exists(work_dir):
-            import shutil
             shutil.rmtree(work_dir)
         print("Cleanup completed")
+        METRICS.emit(bucket, f"{METRICS_PREFIX}/{hls_base_path}.json" if METRICS_PREFIX else None)
+    return True
+
+def reset_job_state():
+    """Worker mode: làm mới state theo job (metrics, progress, disk guard, cache ffprobe) giữa các job"""
+    global METRICS, PROGRESS, WORKSPACE
+    METRICS = JobMetrics(METRICS_NAMESPACE)
+    PROGRESS = ProgressTracker()
+    WORKSPACE = WorkspaceGuard()
+    _media_info.clear()
+
+def set_job_status(job_key, **fields):
+    """Cập nhật job store (JOB_STORE) của dispatcher; lỗi store không làm hỏng job"""
+    try:
+        store = get_job_store()
+        if store and job_key:
+            store.update(job_key, **fields)
+        elif job_key:
+            # Dispatcher có store (job có jobKey) nhưng task không có JOB_STORE → trạng thái không được cập nhật
+            print(f"Warning: JOB_STORE is not configured, job {job_key} status stays as dispatched")
+    except Exception as e:
+        print(f"Warning: cannot update job store: {str(e)}")
+
+def is_job_done(job_key):
+    """Message SQS giao lại sau khi job đã xong (chưa kịp xoá) → không encode + webhook lần 2"""
+    try:
+        store = get_job_store()
+        record = store.get(job_key) if store and job_key else None
+        return bool(record) and record.get('status') == 'success'
+    except Exception as e:
+        print(f"Warning: cannot read job store: {str(e)}")
+        return False
+
+def run_job(job):
+    """1 job của worker: dict (s3Key, bucket, outputPrefix, jobId, jobKey) hoặc chỉ S3 key"""
+    if isinstance(job, str):
+        job = {"s3Key": job}
+    print("\n" + "-" * 60)
+    print(f"▶️  Job: {job.get('s3Key')}")
+    key = job.get('jobKey')
+    if is_job_done(key):
+        print("⏭️  Job already completed, skipping")
+        return True
+    set_job_status(key, status='processing')
+    ok = False
+    try:
+        ok = process_job(
+            s3_key=job.get('s3Key'),
+            bucket=job.get('bucket') or os.environ.get('BUCKET'),
+            output_prefix=job.get('outputPrefix') or os.environ.get('OUTPUT_PREFIX', 'hls-output'),
+            job_id=job.get('jobId') or os.environ.get('JOB_ID'),
+        )
+        return ok
+    finally:
+        set_job_status(key, status='success' if ok else 'failed')
+        reset_job_state()
+
+def run_job_list(jobs):
+    """Xử lý lần lượt danh sách job (dispatcher đã gom theo thời lượng). Trả về số job lỗi"""
+    failed = 0
+    for index, job in enumerate(jobs):
+        print(f"\n📦 Job {index + 1}/{len(jobs)}")
+        if not run_job(job):
+            failed += 1
+    print(f"\n📦 Worker finished: {len(jobs) - failed}/{len(jobs)} jobs succeeded")
+    return failed
+
+def run_queue_worker(queue_url):
+    """
+    Lấy job từ SQS tới khi queue rỗng QUEUE_IDLE_POLLS lần liên tiếp. Trả về số job lỗi.
+    Visibility timeout được gia hạn trong lúc job chạy; message bị xoá sau khi xử lý
+    (kể cả lỗi - đã báo webhook). Task chết giữa chừng → message hiện lại, job sau resume từ manifest.
+    """
+    sqs = boto3.client('sqs', endpoint_url=SQS_ENDPOINT_URL)
+    processed = failed = idle = 0
+    while idle < QUEUE_IDLE_POLLS:
+        messages = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=QUEUE_WAIT_SECONDS,
+            VisibilityTimeout=QUEUE_VISIBILITY_TIMEOUT,
+        ).get('Messages', [])
+        if not messages:
+            idle += 1
+            continue
+        idle = 0
+        receipt = messages[0]['ReceiptHandle']
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(QUEUE_VISIBILITY_TIMEOUT / 2):
+                try:
+                    sqs.change_message_visibility(
+                        QueueUrl=queue_url, ReceiptHandle=receipt,
+                        VisibilityTimeout=QUEUE_VISIBILITY_TIMEOUT
+                    )
+                except Exception as e:
+                    print(f"Warning: cannot extend message visibility: {str(e)}")
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            ok = run_job(json.loads(messages[0]['Body']))
+        except ValueError as e:
+            print(f"ERROR: invalid job message: {str(e)}")
+            ok = False
+        finally:
+            stop.set()
+            thread.join()
+        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt)
+        processed += 1
+        if not ok:
+            failed += 1
+    print(f"\n📦 Queue empty, worker finished: {processed - failed}/{processed} jobs succeeded")
+    return failed
+
+def main():
+    print("=" * 60)
+    print("HLS Converter Started")
+    print("=" * 60)
+    print()
+
+    if JOB_QUEUE_URL:
+        failed = run_queue_worker(JOB_QUEUE_URL)
+    elif os.environ.get('JOBS'):
+        failed = run_job_list(json.loads(os.environ['JOBS']))
+    else:
+        # Lấy thông tin từ environment variables
+        failed = not process_job(
+            s3_key=os.environ.get('S3_KEY'),
+            bucket=os.environ.get('BUCKET'),
+            output_prefix=os.environ.get('OUTPUT_PREFIX', 'hls-output'),
+            job_id=os.environ.get('JOB_ID'),
+        )
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
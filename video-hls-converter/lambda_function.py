@@ -1,8 +1,30 @@
 import json
 import boto3
 import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from job_store import job_key, get_job_store, worker_environment
 
-ecs = boto3.client('ecs')
+# Gọi API song song từ DISPATCH_WORKERS thread
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '16'))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE = 0.5       # giây, nhân đôi mỗi lần retry (full jitter)
+BACKOFF_CAP = 20
+RUN_TASK_MAX_COUNT = 10  # Giới hạn count của ecs.run_task
+# Lỗi throttling / tạm thời của API → retry; lỗi khác (sai tham số, quyền) → fail ngay
+RETRYABLE_ERRORS = {
+    'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ServerException', 'ServiceUnavailableException', 'LimitExceededException',
+}
+
+# Retry do dispatch tự làm (có jitter + biết thời gian còn lại của Lambda), botocore không retry thêm
+ecs = boto3.client('ecs', config=Config(
+    retries={'total_max_attempts': 1}, max_pool_connections=DISPATCH_WORKERS
+))
+s3 = boto3.client('s3', config=Config(max_pool_connections=DISPATCH_WORKERS))
 
 CLUSTER_NAME = os.environ.get('CLUSTER_NAME', 'video-processing-cluster')
 TASK_DEFINITION = os.environ.get('TASK_DEFINITION', 'hls-converter:1')
@@ -10,14 +32,25 @@ SUBNETS = os.environ.get('SUBNETS', '').split(',')
 SECURITY_GROUP = os.environ.get('SECURITY_GROUP', '')
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
 
+# Gom nhiều video vào 1 ECS task (worker mode của convert_to_hls.py) theo thời lượng source
+TASK_MAX_SECONDS = int(os.environ.get('TASK_MAX_SECONDS', '3600'))  # Tổng thời lượng video / task
+TASK_MAX_JOBS = int(os.environ.get('TASK_MAX_JOBS', '20'))          # Giữ JOBS dưới giới hạn 8 KB của overrides
+DEFAULT_BITRATE = 2500000  # bps - ước lượng thời lượng khi không đọc được header MP4
+# Có queue → job được gửi vào SQS, số task = số nhóm sau khi gom; task lấy job tới khi queue rỗng
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL', '')
+
 def lambda_handler(event, context):
     """
     Expected event format:
     {
         "s3Keys": ["path/video1.mp4", "path/video2.mp4"],
         "bucket": "my-video-bucket",
-        "outputPrefix": "hls-output"  # optional
+        "outputPrefix": "hls-output",  # optional
+        "jobId": "...",                # optional, gửi lại trong webhook
+        "action": "status"             # optional: chỉ tra cứu trạng thái job, không dispatch
     }
+    Response có 'results': trạng thái từng key (started | queued | skipped | failed).
+    Có JOB_STORE: key đang chạy / đã xong với cùng tham số bị bỏ qua (skipped) thay vì launch lại
     """
     
     print(f"Received event: {json.dumps(event)}")
@@ -34,6 +67,7 @@ def lambda_handler(event, context):
         s3_keys = body.get('s3Keys', [])
         bucket = body.get('bucket')
         output_prefix = body.get('outputPrefix', 'hls-output')
+        job_id = body.get('jobId')
         
         # Validate input
         if not s3_keys:
@@ -45,67 +79,74 @@ def lambda_handler(event, context):
         if not isinstance(s3_keys, list):
             return response_error(400, 's3Keys must be an array')
         
+        s3_keys = list(dict.fromkeys(s3_keys))  # Bỏ key trùng trong cùng request
+        store = get_job_store()
+        job_keys = {
+            key: job_key('hls', bucket, key, outputPrefix=output_prefix, jobId=job_id)
+            for key in s3_keys
+        }
+
+        if body.get('action') == 'status':
+            return job_status_response(store, s3_keys, job_keys)
+
         print(f"Processing {len(s3_keys)} videos from bucket: {bucket}")
+
+        # Idempotency: chỉ dispatch key claim được (chưa có / lỗi / stale)
+        results = {}
+        to_dispatch = s3_keys
+        if store:
+            to_dispatch = []
+            with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+                claims = executor.map(lambda key: store.claim(job_keys[key], {
+                    'status': 'dispatched', 's3Key': key, 'bucket': bucket, 'jobId': job_id
+                }), s3_keys)
+                for s3_key, (claimed, record) in zip(s3_keys, claims):
+                    if claimed:
+                        to_dispatch.append(s3_key)
+                    else:
+                        results[s3_key] = skipped_result(s3_key, record)
+                        print(f"⏭️  {s3_key} already {record.get('status')}, skipping")
         
-        # Start ECS tasks
-        task_arns = []
-        failed_videos = []
-        
-        for s3_key in s3_keys:
-            try:
-                print(f"Starting ECS task for: {s3_key}")
-                
-                response = ecs.run_task(
-                    cluster=CLUSTER_NAME,
-                    taskDefinition=TASK_DEFINITION,
-                    launchType='FARGATE',
-                    networkConfiguration={
-                        'awsvpcConfiguration': {
-                            'subnets': SUBNETS,
-                            'securityGroups': [SECURITY_GROUP],
-                            'assignPublicIp': 'ENABLED'
-                        }
-                    },
-                    overrides={
-                        'containerOverrides': [{
-                            'name': 'converter',
-                            'environment': [
-                                {'name': 'S3_KEY', 'value': s3_key},
-                                {'name': 'BUCKET', 'value': bucket},
-                                {'name': 'OUTPUT_PREFIX', 'value': output_prefix},
-                                {'name': 'WEBHOOK_URL', 'value': WEBHOOK_URL}
-                            ]
-                        }]
-                    }
-                )
-                
-                if response['tasks']:
-                    task_arn = response['tasks'][0]['taskArn']
-                    task_arns.append({
-                        's3Key': s3_key,
-                        'taskArn': task_arn
-                    })
-                    print(f"✅ Started task: {task_arn}")
-                else:
-                    failed_videos.append({
-                        's3Key': s3_key,
-                        'reason': 'No task created'
-                    })
-                    print(f"❌ Failed to start task for {s3_key}")
-                    
-            except Exception as e:
-                failed_videos.append({
-                    's3Key': s3_key,
-                    'reason': str(e)
-                })
-                print(f"❌ Error starting task for {s3_key}: {str(e)}")
+        try:
+            task_arns = dispatch_jobs(context, results, to_dispatch, job_keys, bucket, output_prefix, job_id)
+        except Exception as e:
+            # Lỗi giữa chừng: nhả claim của key chưa được launch / đưa vào queue,
+            # nếu không request retry bị bỏ qua (dispatched) tới khi job stale
+            if store:
+                release_claims(store, [
+                    job_keys[key] for key in to_dispatch
+                    if results.get(key, {}).get('status') not in ('started', 'queued')
+                ], str(e))
+            raise
+
+        results = [{**results[key], 'jobKey': job_keys[key]} for key in s3_keys]
+        if store:
+            # Ghi lại task / lỗi dispatch (job lỗi được phép dispatch lại ở request sau)
+            for r in results:
+                try:
+                    if r['status'] == 'started':
+                        store.update(r['jobKey'], taskArn=r['taskArn'])
+                    elif r['status'] == 'queued':
+                        # Job đã nằm trong queue: không 'failed' kể cả khi chưa có worker,
+                        # request sau chỉ launch lại worker thay vì gửi job trùng
+                        store.update(r['jobKey'], status='queued', error=r.get('reason', ''))
+                    elif r['status'] == 'failed':
+                        store.update(r['jobKey'], status='failed', error=r['reason'])
+                except Exception as e:
+                    print(f"Warning: cannot update job store: {str(e)}")
+        failed_videos = [
+            {'s3Key': r['s3Key'], 'reason': r['reason']} for r in results if r['status'] == 'failed'
+        ]
+        skipped = sum(1 for r in results if r['status'] == 'skipped')
         
         # Prepare response
         result = {
             'message': f'Started {len(task_arns)} conversion tasks',
-            'successful': len(task_arns),
+            'successful': len(results) - len(failed_videos) - skipped,
+            'skipped': skipped,
             'failed': len(failed_videos),
             'tasks': task_arns,
+            'results': results,
             'bucket': bucket,
             'outputPrefix': output_prefix
         }
@@ -130,6 +171,307 @@ def lambda_handler(event, context):
         traceback.print_exc()
         return response_error(500, str(e))
 
+def dispatch_jobs(context, results, s3_keys, job_keys, bucket, output_prefix, job_id):
+    """
+    Đo thời lượng, gom video thành các task rồi launch (hoặc đưa vào queue).
+    Ghi kết quả từng key vào results. Trả về danh sách task đã start
+    """
+    # Đo thời lượng từng video (song song) rồi gom thành các task
+    videos = []
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        durations = executor.map(lambda key: safe_call(probe_duration, bucket, key), s3_keys)
+        for s3_key, (duration, error) in zip(s3_keys, durations):
+            if error:
+                results[s3_key] = {'s3Key': s3_key, 'status': 'failed', 'reason': error}
+                print(f"❌ Cannot read {s3_key}: {error}")
+            else:
+                videos.append({'s3Key': s3_key, 'jobKey': job_keys[s3_key], 'duration': duration})
+
+    groups = pack_jobs(videos)
+    print(f"Packed {len(videos)} videos into {len(groups)} tasks")
+
+    common_env = [
+        {'name': 'BUCKET', 'value': bucket},
+        {'name': 'OUTPUT_PREFIX', 'value': output_prefix},
+        {'name': 'WEBHOOK_URL', 'value': WEBHOOK_URL}
+    ]
+    if job_id:
+        common_env.append({'name': 'JOB_ID', 'value': str(job_id)})
+    # Worker cập nhật trạng thái job vào cùng store
+    common_env += worker_environment()
+
+    # Start ECS tasks
+    task_arns = []
+    # Job đã vào queue ở request trước nhưng không start được worker nào → chỉ launch lại worker
+    pending = [key for key, r in results.items() if r.get('jobStatus') == 'queued' and r.get('error')]
+    if JOB_QUEUE_URL and (videos or pending):
+        # Lô gửi lỗi → job failed (request sau dispatch lại được); job đã vào queue không bị gửi lại
+        enqueued, enqueue_errors = enqueue_jobs(videos, bucket, output_prefix, job_id)
+        for s3_key, error in enqueue_errors.items():
+            results[s3_key] = {'s3Key': s3_key, 'status': 'failed', 'reason': f"Cannot enqueue: {error}"}
+            print(f"❌ Cannot enqueue {s3_key}: {error}")
+        queued = [video['s3Key'] for video in enqueued] + pending
+        if queued:
+            # Mọi worker giống hệt nhau → gộp bằng run_task count
+            workers = max(1, len(pack_jobs(enqueued)))
+            env = [{'name': 'JOB_QUEUE_URL', 'value': JOB_QUEUE_URL}] + common_env
+            counts = [min(RUN_TASK_MAX_COUNT, workers - i) for i in range(0, workers, RUN_TASK_MAX_COUNT)]
+            with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+                launches = list(executor.map(lambda count: run_task_with_backoff(context, env, count), counts))
+            errors = []
+            for arns, error in launches:
+                task_arns.extend({'taskArn': arn} for arn in arns)
+                if error:
+                    errors.append(error)
+                    print(f"❌ Error starting workers: {error}")
+            # Job nằm trong queue: còn ít nhất 1 worker là sẽ được xử lý; không có worker nào
+            # thì vẫn là queued (message còn trong queue), lỗi được ghi lại để request sau launch lại worker
+            for s3_key in queued:
+                results[s3_key] = {'s3Key': s3_key, 'status': 'queued'}
+                if not task_arns:
+                    results[s3_key]['reason'] = f"No worker task started: {'; '.join(errors)}"
+    elif groups:
+        # Mỗi task 1 danh sách JOBS riêng → count=1, các task chạy song song
+        def start_group(group):
+            jobs = json.dumps([
+                {'s3Key': video['s3Key'], 'jobKey': video['jobKey']} for video in group['jobs']
+            ])
+            return run_task_with_backoff(context, [{'name': 'JOBS', 'value': jobs}] + common_env)
+
+        with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+            launches = list(executor.map(start_group, groups))
+        for group, (arns, error) in zip(groups, launches):
+            s3_keys_in_task = [video['s3Key'] for video in group['jobs']]
+            if arns:
+                task_arns.append({
+                    's3Keys': s3_keys_in_task,
+                    'duration': round(group['duration'], 1),
+                    'taskArn': arns[0]
+                })
+                print(f"✅ Started task: {arns[0]} ({len(s3_keys_in_task)} videos)")
+            else:
+                print(f"❌ Failed to start task for {len(s3_keys_in_task)} videos: {error}")
+            for key in s3_keys_in_task:
+                results[key] = {'s3Key': key, 'status': 'started', 'taskArn': arns[0]} if arns else {
+                    's3Key': key, 'status': 'failed', 'reason': error
+                }
+    return task_arns
+
+def release_claims(store, keys, reason):
+    """Đánh dấu failed để request sau claim lại được"""
+    for key in keys:
+        try:
+            store.update(key, status='failed', error=reason)
+        except Exception as e:
+            print(f"Warning: cannot release job {key}: {str(e)}")
+
+def skipped_result(s3_key, record):
+    """Kết quả cho key đã có job (đang chạy hoặc đã xong) → gắn vào job đó"""
+    record = record or {}
+    return {
+        's3Key': s3_key,
+        'status': 'skipped',
+        'jobStatus': record.get('status'),
+        'taskArn': record.get('taskArn'),
+        'error': record.get('error') or None,
+    }
+
+def job_status_response(store, s3_keys, job_keys):
+    """Tra cứu trạng thái job theo key (cùng bucket/outputPrefix/jobId với lúc dispatch)"""
+    if not store:
+        return response_error(400, 'JOB_STORE is not configured')
+    records = store.get_many([job_keys[key] for key in s3_keys])
+    jobs = []
+    for key in s3_keys:
+        record = records.get(job_keys[key]) or {}
+        jobs.append({
+            's3Key': key,
+            'jobKey': job_keys[key],
+            'status': record.get('status', 'not_found'),
+            'taskArn': record.get('taskArn'),
+            'error': record.get('error'),
+            'updatedAt': record.get('updatedAt'),
+        })
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'jobs': jobs})
+    }
+
+# --- Helper dispatch dùng chung với generate_video_caption/lambda_function.py ---
+# safe_call, is_capacity_failure, run_task_with_backoff, read_range, probe_duration, pack_jobs,
+# enqueue_jobs là bản copy (mỗi Lambda deploy từ thư mục riêng): sửa logic ở bên này thì sửa cả bên kia.
+# Khác nhau có chủ ý: tên container trong overrides, nội dung message SQS, TASK_MAX_SECONDS mặc định.
+
+def safe_call(func, *args):
+    """Chạy func trong thread pool: trả về (kết quả, None) hoặc (None, lỗi)"""
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, str(e)
+
+def is_capacity_failure(reason):
+    # vd. "Capacity is unavailable at this time. Please try again later or in a different availability zone"
+    return 'capacity' in reason.lower() or reason.startswith('RESOURCE')
+
+def run_task_with_backoff(context, environment, count=1):
+    """
+    ecs.run_task có retry khi bị throttle hoặc thiếu capacity: exponential backoff + full jitter.
+    count > 1: ECS có thể chỉ start được 1 phần → lần sau chỉ start phần còn thiếu.
+    Không retry nếu thời gian còn lại của Lambda không đủ chờ.
+    Trả về (list taskArn, lỗi cuối cùng hoặc None)
+    """
+    arns = []
+    error = None
+    for attempt in range(DISPATCH_MAX_ATTEMPTS):
+        if attempt:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if context and context.get_remaining_time_in_millis() < (delay + 5) * 1000:
+                break
+            time.sleep(delay)
+        try:
+            response = ecs.run_task(
+                cluster=CLUSTER_NAME,
+                taskDefinition=TASK_DEFINITION,
+                launchType='FARGATE',
+                count=count - len(arns),
+                networkConfiguration={
+                    'awsvpcConfiguration': {
+                        'subnets': SUBNETS,
+                        'securityGroups': [SECURITY_GROUP],
+                        'assignPublicIp': 'ENABLED'
+                    }
+                },
+                overrides={
+                    'containerOverrides': [{
+                        'name': 'converter',
+                        'environment': environment
+                    }]
+                }
+            )
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code', '')
+            error = f"{code}: {e.response.get('Error', {}).get('Message', '')}"
+            if code not in RETRYABLE_ERRORS:
+                break
+            print(f"⚠️  run_task throttled ({code}), attempt {attempt + 1}/{DISPATCH_MAX_ATTEMPTS}")
+            continue
+        except Exception as e:
+            error = str(e)
+            break
+
+        arns.extend(task['taskArn'] for task in response.get('tasks', []))
+        if len(arns) >= count:
+            return arns, None
+        reasons = [failure.get('reason', '') for failure in response.get('failures', [])]
+        error = '; '.join(reasons) or 'No task created'
+        if not any(is_capacity_failure(reason) for reason in reasons):
+            break
+        print(f"⚠️  run_task capacity shortage ({error}), attempt {attempt + 1}/{DISPATCH_MAX_ATTEMPTS}")
+    return arns, error
+
+def read_range(bucket, key, start, end):
+    return s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")['Body'].read()
+
+def probe_duration(bucket, key):
+    """
+    Thời lượng video (giây) từ atom mvhd của MP4/MOV bằng vài range GET - Lambda không có ffprobe.
+    Không đọc được (định dạng khác, moov quá lớn...) → ước lượng theo dung lượng với DEFAULT_BITRATE
+    """
+    size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    try:
+        offset = 0
+        while offset + 8 <= size:
+            header = read_range(bucket, key, offset, min(offset + 15, size - 1))
+            atom_size = int.from_bytes(header[0:4], 'big')
+            header_size = 8
+            if atom_size == 1 and len(header) >= 16:  # 64-bit size
+                atom_size = int.from_bytes(header[8:16], 'big')
+                header_size = 16
+            elif atom_size == 0:  # Atom kéo dài tới hết file
+                atom_size = size - offset
+            if atom_size < header_size:
+                break
+            if header[4:8] == b'moov':
+                # mvhd luôn nằm đầu moov → 4 KB đầu là đủ
+                start = offset + header_size
+                moov = read_range(bucket, key, start, min(offset + atom_size, start + 4096) - 1)
+                pos = 0
+                while pos + 8 <= len(moov):
+                    child_size = int.from_bytes(moov[pos:pos + 4], 'big')
+                    if moov[pos + 4:pos + 8] == b'mvhd':
+                        body = moov[pos + 8:]
+                        if body[0] == 1:  # version 1: thời gian 64-bit
+                            timescale = int.from_bytes(body[20:24], 'big')
+                            duration = int.from_bytes(body[24:32], 'big')
+                        else:
+                            timescale = int.from_bytes(body[12:16], 'big')
+                            duration = int.from_bytes(body[16:20], 'big')
+                        if timescale:
+                            return duration / timescale
+                        break
+                    if child_size < 8:
+                        break
+                    pos += child_size
+                break
+            offset += atom_size
+    except Exception as e:
+        print(f"Warning: cannot read duration of {key}: {str(e)}")
+    return size * 8 / DEFAULT_BITRATE
+
+def pack_jobs(videos, max_seconds=TASK_MAX_SECONDS, max_jobs=TASK_MAX_JOBS):
+    """
+    Gom video thành các task (first-fit decreasing): video dài xếp trước, mỗi task tối đa
+    max_seconds tổng thời lượng và max_jobs video. Video dài hơn max_seconds chạy riêng 1 task.
+    """
+    groups = []
+    for video in sorted(videos, key=lambda v: v['duration'], reverse=True):
+        for group in groups:
+            if len(group['jobs']) < max_jobs and group['duration'] + video['duration'] <= max_seconds:
+                break
+        else:
+            group = {'duration': 0, 'jobs': []}
+            groups.append(group)
+        group['jobs'].append(video)
+        group['duration'] += video['duration']
+    return groups
+
+def enqueue_jobs(videos, bucket, output_prefix, job_id=None):
+    """
+    Gửi job vào SQS theo lô 10 message (giới hạn của send_message_batch), các lô gửi song song.
+    Trả về (video đã vào queue, {s3Key: lỗi}): lô lỗi không ảnh hưởng các lô đã gửi
+    """
+    sqs = boto3.client('sqs', config=Config(max_pool_connections=DISPATCH_WORKERS))
+
+    def send_batch(batch):
+        entries = [{
+            'Id': str(index),
+            'MessageBody': json.dumps({
+                's3Key': video['s3Key'],
+                'jobKey': video['jobKey'],
+                'bucket': bucket,
+                'outputPrefix': output_prefix,
+                'jobId': job_id
+            })
+        } for index, video in enumerate(batch)]
+        try:
+            response = sqs.send_message_batch(QueueUrl=JOB_QUEUE_URL, Entries=entries)
+        except Exception as e:
+            return {video['s3Key']: str(e) for video in batch}
+        return {
+            batch[int(failure['Id'])]['s3Key']: failure.get('Message') or failure.get('Code', 'SendMessage failed')
+            for failure in response.get('Failed', [])
+        }
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        for batch_errors in executor.map(send_batch, [videos[i:i + 10] for i in range(0, len(videos), 10)]):
+            errors.update(batch_errors)
+    return [video for video in videos if video['s3Key'] not in errors], errors
+
 def response_error(status_code, message):
     """Helper function for error responses"""
     return {